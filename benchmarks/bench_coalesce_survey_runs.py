@@ -0,0 +1,96 @@
+"""
+Benchmarks CombineRawDatasets.coalesce_traced_runs_by_key against the previous implementation, which made one
+append_data per repeated run, on a synthetic survey flow where most respondents completed the survey several times.
+
+Usage, from the root of this repository:
+
+    $ pipenv run python -m benchmarks.bench_coalesce_survey_runs [--respondents N] [--repeats N]
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.util import TimeUtils
+
+from src.combine_raw_datasets import CombineRawDatasets
+
+USER = "benchmark"
+SURVEY_KEYS = ["location (Text) - csap_demog", "gender (Text) - csap_demog", "age (Text) - csap_demog",
+               "recently_displaced (Text) - csap_demog", "in_idp_camp (Text) - csap_demog"]
+
+
+def coalesce_traced_runs_by_key_reference(user, traced_runs, coalesce_key):
+    """
+    The implementation of CombineRawDatasets.coalesce_traced_runs_by_key before it grouped the runs by key, which
+    appended each repeated run to the first run with that key separately.
+    """
+    coalesced_runs = dict()
+
+    for run in traced_runs:
+        if run[coalesce_key] not in coalesced_runs:
+            coalesced_runs[run[coalesce_key]] = run
+        else:
+            coalesced_runs[run[coalesce_key]].append_data(
+                dict(run.items()), Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+
+    return list(coalesced_runs.values())
+
+
+def make_traced_runs(respondents, repeats):
+    """
+    Makes a survey flow's runs, where every other respondent completed the survey `repeats` times and the rest
+    completed it once.
+    """
+    traced_runs = []
+    for repeat in range(repeats):
+        for respondent in range(respondents):
+            if repeat > 0 and respondent % 2 == 1:
+                continue
+
+            run = {"avf_phone_id": f"avf-phone-uuid-{respondent}"}
+            for key in SURVEY_KEYS:
+                run[key] = f"answer {repeat}"
+                run[key.replace("(Text)", "(Time)")] = f"2019-08-{26 + repeat % 10}T10:00:00+03:00"
+            traced_runs.append(TracedData(run, Metadata(USER, Metadata.get_call_location(), time.time())))
+    return traced_runs
+
+
+def run_benchmark(name, coalesce_fn, traced_runs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    coalesced_runs = coalesce_fn(USER, traced_runs, "avf_phone_id")
+    duration = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    max_history_depth = max(len(td.get_history(SURVEY_KEYS[0])) for td in coalesced_runs)
+    serialized = [json.dumps(td.serialize()) for td in coalesced_runs]
+    serialized_size = sum(len(s) for s in serialized)
+
+    print(f"{name}: {duration:.3f}s, peak memory {peak_memory / 2 ** 20:.1f} MiB, "
+          f"max history depth {max_history_depth}, serialized size {serialized_size / 2 ** 20:.1f} MiB")
+    return coalesced_runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks coalescing repeated survey runs")
+    parser.add_argument("--respondents", type=int, default=20000, help="Number of survey respondents")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of times each repeat respondent completed the survey")
+    args = parser.parse_args()
+
+    reference_runs = make_traced_runs(args.respondents, args.repeats)
+    grouped_runs = make_traced_runs(args.respondents, args.repeats)
+    print(f"Coalescing {len(reference_runs)} runs from {args.respondents} respondents")
+
+    reference_output = run_benchmark("Per-run appends", coalesce_traced_runs_by_key_reference, reference_runs)
+    grouped_output = run_benchmark("Grouped appends", CombineRawDatasets.coalesce_traced_runs_by_key, grouped_runs)
+
+    assert [dict(td.items()) for td in reference_output] == [dict(td.items()) for td in grouped_output], \
+        "Coalesced runs differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmarks the number of timestamps parsed by translate_rapid_pro_keys and the time range filter in auto_code, which
+share TimestampParser's memo, against the number the previous implementations parsed, on a synthetic season of
+activation messages and recovered messages.
+
+Previously, translate_rapid_pro_keys parsed the time key of each TracedData once for every timestamp remapping of that
+time key, and the time range filter parsed the time of each message again.
+
+Usage, from the root of this repository:
+
+    $ pipenv run python -m benchmarks.bench_timestamp_parsing [--activation-messages N] [--recovered-messages N]
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from core_data_modules.traced_data import Metadata, TracedData
+from dateutil.parser import isoparse
+
+from src.lib import MessageFilters, PipelineConfiguration, TimestampParser
+from src.lib import timestamp_parser
+from src.translate_rapid_pro_keys import TranslateRapidProKeys
+
+USER = "benchmark"
+PIPELINE_CONFIGURATION_PATH = "pipeline_config.json"
+
+
+def make_data(pipeline_configuration, activation_messages, recovered_messages):
+    """
+    Makes activation messages with Rapid Pro's microsecond-precision times, and recovered messages with second-precision
+    times, some of which were received in the same second, spread across the project.
+    """
+    rng = random.Random(0)
+    project_seconds = int((pipeline_configuration.project_end_date -
+                           pipeline_configuration.project_start_date).total_seconds())
+
+    def random_time(resolution):
+        offset = timedelta(seconds=rng.randrange(project_seconds))
+        if resolution == "microseconds":
+            offset += timedelta(microseconds=rng.randrange(10 ** 6))
+        return (pipeline_configuration.project_start_date + offset).isoformat()
+
+    data = []
+    for i in range(activation_messages):
+        episode = rng.choice(["S04E01", "S04E02"])
+        data.append({
+            "avf_phone_id": f"avf-phone-uuid-{i}",
+            f"Rqa_{episode} (Text) - csap_{episode.lower()}_activation": "message",
+            f"Rqa_{episode} (Time) - csap_{episode.lower()}_activation": random_time("microseconds")
+        })
+    recovered_times = [random_time("seconds") for _ in range(recovered_messages // 2)]
+    for i in range(recovered_messages):
+        data.append({
+            "avf_phone_id": f"avf-phone-uuid-recovered-{i}",
+            "message": "recovered message",
+            "received_on": rng.choice(recovered_times)
+        })
+
+    return [TracedData(d, Metadata(USER, Metadata.get_call_location(), time.time())) for d in data]
+
+
+def count_reference_parses(pipeline_configuration, data, time_keys):
+    """
+    Counts the timestamps the previous implementations parsed: one per remapping of a time key for each TracedData
+    with that time key, followed by one per message in the time range filter.
+    """
+    translate_parses = 0
+    for remapping in pipeline_configuration.timestamp_remappings:
+        translate_parses += sum(1 for td in data if remapping.time_key in td)
+    return translate_parses + sum(1 for td in data if any(time_key in td for time_key in time_keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the number of timestamps parsed by the pipeline")
+    parser.add_argument("--activation-messages", type=int, default=80000,
+                        help="Number of activation messages to generate")
+    parser.add_argument("--recovered-messages", type=int, default=20000,
+                        help="Number of recovered messages to generate")
+    args = parser.parse_args()
+
+    with open(PIPELINE_CONFIGURATION_PATH) as f:
+        pipeline_configuration = PipelineConfiguration.from_configuration_file(f)
+    time_keys = {plan.time_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
+
+    data = make_data(pipeline_configuration, args.activation_messages, args.recovered_messages)
+
+    # Count the parses which reach dateutil, i.e. which weren't answered by the memo.
+    parse_count = 0
+
+    def counting_isoparse(timestamp):
+        nonlocal parse_count
+        parse_count += 1
+        return isoparse(timestamp)
+    timestamp_parser.isoparse = counting_isoparse
+
+    start = time.perf_counter()
+    data = TranslateRapidProKeys.translate_rapid_pro_keys(USER, data, pipeline_configuration)
+    translate_parse_count = parse_count
+    reference_parse_count = count_reference_parses(pipeline_configuration, data, time_keys)
+    filtered = MessageFilters.filter_time_range(data, time_keys, pipeline_configuration.project_start_date,
+                                                pipeline_configuration.project_end_date)
+    duration = time.perf_counter() - start
+
+    cache_info = TimestampParser.isoparse.cache_info()
+    print(f"Translated and filtered {len(data)} messages ({len(filtered)} in range) in {duration:.3f}s")
+    print(f"Previous implementations: {reference_parse_count} parses")
+    print(f"TimestampParser: {parse_count} parses ({translate_parse_count} in translate_rapid_pro_keys, "
+          f"{parse_count - translate_parse_count} in the time range filter), {cache_info.hits} cache hits")
+
+    timestamps = [td[time_key] for td in data for time_key in time_keys if time_key in td]
+    start = time.perf_counter()
+    for timestamp in timestamps:
+        isoparse(timestamp)
+    print(f"Parsing each of the {len(timestamps)} message times once takes {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
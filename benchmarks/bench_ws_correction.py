@@ -0,0 +1,94 @@
+"""
+Benchmarks WS correction run in a single process against WS correction sharded across process pools of
+different sizes, on synthetic uids whose messages and survey answers are labelled as being in the wrong scheme at
+roughly the rates seen in Coda.
+
+Sharding only pays off once the time spent correcting the messages outweighs the time spent pickling the TracedData
+to and from the worker processes, so this also reports the size of the pickled input.
+
+Usage, from the root of this repository:
+
+    $ pipenv run python -m benchmarks.bench_ws_correction [--uids N] [--workers 1,2,4,8]
+"""
+import argparse
+import pickle
+import random
+import time
+
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.lib.code_schemes import CodeSchemes
+from src.ws_correction import WSCorrection
+
+USER = "benchmark"
+SURVEY_FIELDS = [("location_raw", "location_time"), ("gender_raw", "gender_time"), ("age_raw", "age_time"),
+                 ("recently_displaced_raw", "recently_displaced_time"), ("in_idp_camp_raw", "in_idp_camp_time")]
+RQA_FIELDS = ["rqa_s04e01_raw", "rqa_s04e02_raw"]
+
+# Roughly 1 in 20 labels moves a message to another RQA or survey field.
+WS_CORRECT_DATASET_VALUES = ["NR"] * 19 + ["s04e01", "s04e02", "gender", "age", "location"]
+
+
+def make_groups(uid_count):
+    rng = random.Random(0)
+
+    def ws_label():
+        value = rng.choice(WS_CORRECT_DATASET_VALUES)
+        if value == "NR":
+            code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(value)
+        else:
+            code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_match_value(value)
+        return {"CodeID": code.code_id}
+
+    groups = []
+    for uid in range(uid_count):
+        survey = {"uid": f"avf-phone-uuid-{uid}"}
+        for raw_field, time_field in SURVEY_FIELDS:
+            if rng.random() < 0.7:
+                survey[raw_field] = f"{raw_field} answer"
+                survey[time_field] = "2019-08-27T10:00:00+03:00"
+                survey[f"{raw_field}_WS_correct_dataset"] = ws_label()
+
+        group = []
+        for message in range(1 + int(rng.expovariate(0.5))):
+            rqa_field = rng.choice(RQA_FIELDS)
+            d = dict(survey)
+            d[rqa_field] = f"message {message} from uid {uid}"
+            d["sent_on"] = "2019-08-28T10:00:00+03:00"
+            d[f"{rqa_field}_WS_correct_dataset"] = ws_label()
+            group.append(TracedData(d, Metadata(USER, Metadata.get_call_location(), time.time())))
+        groups.append(group)
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks sharding WS correction across processes")
+    parser.add_argument("--uids", type=int, default=50000, help="Number of uids to generate messages for")
+    parser.add_argument("--workers", default="1,2,4,8",
+                        help="Comma-separated numbers of worker processes to benchmark. 1 runs in this process")
+    args = parser.parse_args()
+
+    groups = make_groups(args.uids)
+    print(f"Correcting {sum(len(group) for group in groups)} messages from {len(groups)} uids, "
+          f"{len(pickle.dumps(groups)) / 2 ** 20:.1f} MiB pickled")
+
+    serial_output = None
+    for max_workers in [int(workers) for workers in args.workers.split(",")]:
+        groups = make_groups(args.uids)
+        start = time.perf_counter()
+        if max_workers == 1:
+            corrected_data, _ = WSCorrection._correct_uid_groups(USER, groups)
+        else:
+            corrected_data, _ = WSCorrection._correct_uid_groups_in_parallel(USER, groups, max_workers)
+        duration = time.perf_counter() - start
+        print(f"{max_workers} workers: {duration:.3f}s")
+
+        output = [dict(td.items()) for td in corrected_data]
+        if serial_output is None:
+            serial_output = output
+        else:
+            assert output == serial_output, f"Output with {max_workers} workers differs from the first output"
+
+
+if __name__ == "__main__":
+    main()
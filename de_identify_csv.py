@@ -7,7 +7,7 @@ from core_data_modules.logging import Logger
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from storage.google_cloud import google_cloud_utils
 
-from src.lib import PipelineConfiguration
+from src.lib import PipelineConfiguration, CachedUuidTable
 
 log = Logger(__name__)
 
@@ -16,6 +16,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="De-identifies a CSV by converting the phone numbers in "
                                                  "the specified column to avf phone ids")
 
+    parser.add_argument("--phone-number-uuid-cache-path",
+                        help="Path to a local phone number <-> uuid cache to use in front of the Firestore UUID table. "
+                             "Requires 'CacheEncryptionKeyFileURL' to be set in the pipeline configuration's "
+                             "'PhoneNumberUuidTable'")
+
     parser.add_argument("csv_input_path", metavar="recovered-csv-input-url",
                         help="Path to a CSV file to de-identify a column of")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
@@ -35,6 +40,7 @@ if __name__ == "__main__":
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     column_to_de_identify = args.column_to_de_identify
     de_identified_csv_output_path = args.de_identified_csv_output_path
+    phone_number_uuid_cache_path = args.phone_number_uuid_cache_path
 
     # Read the settings from the configuration file
     log.info("Loading Pipeline Configuration File...")
@@ -54,6 +60,19 @@ if __name__ == "__main__":
     )
     log.info("Initialised the Firestore UUID table")
 
+    if phone_number_uuid_cache_path is not None:
+        assert pipeline_configuration.phone_number_uuid_table.cache_encryption_key_file_url is not None, \
+            "A phone number uuid cache path was provided, but the pipeline configuration does not specify a " \
+            "'CacheEncryptionKeyFileURL'"
+        log.info("Downloading the phone number <-> uuid cache encryption key...")
+        cache_encryption_key = google_cloud_utils.download_blob_to_string(
+            google_cloud_credentials_file_path,
+            pipeline_configuration.phone_number_uuid_table.cache_encryption_key_file_url
+        ).strip()
+        phone_number_uuid_table = CachedUuidTable(phone_number_uuid_table, phone_number_uuid_cache_path,
+                                                  cache_encryption_key)
+        log.info("Initialised the local phone number <-> uuid cache")
+
     log.info(f"Loading csv from '{csv_input_path}'...")
     with open(csv_input_path, "r", encoding='utf-8-sig') as f:
         raw_data = list(csv.DictReader(f))
@@ -14,6 +14,13 @@ while [[ $# -gt 0 ]]; do
             PROFILE_MEMORY=true
             MEMORY_PROFILE_OUTPUT_PATH="$2"
             shift 2;;
+        --checkpoint-dir)
+            CHECKPOINT_DIR="$2"
+            CHECKPOINT_DIR_ARG="--checkpoint-dir /data/checkpoints"
+            shift 2;;
+        --resume-from)
+            RESUME_FROM_ARG="--resume-from $2"
+            shift 2;;
         --)
             shift
             break;;
@@ -27,6 +34,7 @@ done
 if [[ $# -ne 12 ]]; then
     echo "Usage: ./docker-run.sh
     [--profile-cpu <profile-output-path>] [--profile-memory <profile-output-path>]
+    [--checkpoint-dir <checkpoint-dir> [--resume-from <stage>]]
     <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path>
     <raw-data-dir> <prev-coded-dir> <messages-json-output-path> <individuals-json-output-path>
     <icr-output-dir> <coded-output-dir> <messages-output-csv> <individuals-output-csv> <production-output-csv>"
@@ -59,6 +67,7 @@ if [[ "$PROFILE_MEMORY" = true ]]; then
     PROFILE_MEMORY_CMD="mprof run -o /data/memory.prof"
 fi
 CMD="pipenv run $PROFILE_MEMORY_CMD python -u $PROFILE_CPU_CMD generate_outputs.py \
+    ${CHECKPOINT_DIR_ARG} ${RESUME_FROM_ARG} \
     \"$USER\" /credentials/google-cloud-credentials.json /data/pipeline_configuration.json \
     /data/raw-data /data/prev-coded \
     /data/output-messages.jsonl /data/output-individuals.jsonl /data/output-icr /data/coded \
@@ -73,6 +82,9 @@ docker cp "$INPUT_RAW_DATA_DIR" "$container:/data/raw-data"
 if [[ -d "$PREV_CODED_DIR" ]]; then
     docker cp "$PREV_CODED_DIR" "$container:/data/prev-coded"
 fi
+if [[ -d "$CHECKPOINT_DIR" ]]; then
+    docker cp "$CHECKPOINT_DIR" "$container:/data/checkpoints"
+fi
 
 # Run the container
 docker start -a -i "$container"
@@ -99,6 +111,11 @@ docker cp "$container:/data/output-messages.csv" "$OUTPUT_MESSAGES_CSV"
 mkdir -p "$(dirname "$OUTPUT_INDIVIDUALS_CSV")"
 docker cp "$container:/data/output-individuals.csv" "$OUTPUT_INDIVIDUALS_CSV"
 
+if [[ -n "$CHECKPOINT_DIR" ]]; then
+    mkdir -p "$CHECKPOINT_DIR"
+    docker cp "$container:/data/checkpoints/." "$CHECKPOINT_DIR"
+fi
+
 if [[ "$PROFILE_CPU" = true ]]; then
     mkdir -p "$(dirname "$CPU_PROFILE_OUTPUT_PATH")"
     docker cp "$container:/data/cpu.prof" "$CPU_PROFILE_OUTPUT_PATH"
@@ -1,8 +1,12 @@
 import argparse
 import csv
+import itertools
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from io import StringIO
 
 import pytz
@@ -12,43 +16,420 @@ from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata, TracedData
 from core_data_modules.traced_data.io import TracedDataJsonIO
 from core_data_modules.util import IOUtils, TimeUtils, SHAUtils
+from dateutil.parser import isoparse
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from rapid_pro_tools.rapid_pro_client import RapidProClient
 from storage.google_cloud import google_cloud_utils
-from temba_client.v2 import Contact, Run
+from temba_client.v2 import Contact
 
-from src.lib import PipelineConfiguration, CodeSchemes
+from src.lib import PipelineConfiguration, CodeSchemes, RawRunStore, CachedUuidTable, BlobDownloadManager, \
+    GCloudBlobStore
 from src.lib.pipeline_configuration import RapidProSource, GCloudBucketSource, ShaqadoonCSVSource
 
 Logger.set_project_name("OCHA")
 log = Logger(__name__)
 
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SHAQADOON_CSV_CHUNK_SIZE = 10000
+
+# Version of the conversion from raw runs to TracedData recorded in each flow's conversion cache.
+# Increment this whenever that conversion changes (including the operator labelling of activation flows), so that
+# runs converted by the previous version are converted again rather than re-used.
+TRACED_RUNS_CACHE_VERSION = 1
+
+# Libraries which do the conversion from raw runs to TracedData. The versions of these libraries pinned in
+# Pipfile.lock are also recorded in each flow's conversion cache, so that upgrading them invalidates the cache.
+CONVERSION_LIBRARIES = ["coredatamodules", "rapidprotools"]
+
+
+def _make_operator_label(operator_raw, origin, labels_by_code_id):
+    operator_code = PhoneCleaner.clean_operator(operator_raw)
+    if operator_code == Codes.NOT_CODED:
+        code = CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED)
+    else:
+        code = CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator_code)
+
+    if code.code_id not in labels_by_code_id:
+        labels_by_code_id[code.code_id] = \
+            CleaningUtils.make_label_from_cleaner_code(CodeSchemes.SOMALIA_OPERATOR, code, origin)
+    return labels_by_code_id[code.code_id]
+
 
 def label_somalia_operator(user, traced_runs, phone_number_uuid_table):
     # Set the operator codes for each message.
     uuids = {td["avf_phone_id"] for td in traced_runs}
     uuid_to_phone_lut = phone_number_uuid_table.uuid_to_data_batch(uuids)
+
+    # Each prefix seen in this batch is cleaned once, and prefixes which map to the same code share the same label.
+    # Every TracedData gets its own copy of its label's dict.
+    origin = Metadata.get_call_location()
+    operator_labels_by_prefix = dict()  # of prefix -> Label
+    labels_by_code_id = dict()  # of code id -> Label
+
+    # All the appends in this batch share the same Metadata.
+    metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
     for td in traced_runs:
         operator_raw = uuid_to_phone_lut[td["avf_phone_id"]][:5]  # Returns the country code 252 and the next two digits
 
-        operator_code = PhoneCleaner.clean_operator(operator_raw)
-        if operator_code == Codes.NOT_CODED:
-            operator_label = CleaningUtils.make_label_from_cleaner_code(
-                CodeSchemes.SOMALIA_OPERATOR,
-                CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED),
-                Metadata.get_call_location()
-            )
-        else:
-            operator_label = CleaningUtils.make_label_from_cleaner_code(
-                CodeSchemes.SOMALIA_OPERATOR,
-                CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator_code),
-                Metadata.get_call_location()
-            )
+        if operator_raw not in operator_labels_by_prefix:
+            operator_labels_by_prefix[operator_raw] = _make_operator_label(operator_raw, origin, labels_by_code_id)
 
         td.append_data({
             "operator_raw": operator_raw,
-            "operator_coded": operator_label.to_dict()
-        }, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            "operator_coded": operator_labels_by_prefix[operator_raw].to_dict()
+        }, metadata)
+
+
+def sync_rapid_pro_contacts(rapid_pro, raw_data_dir, rapid_pro_source):
+    """
+    Brings the local export of a Rapid Pro source's contacts up to date, fetching only the contacts modified since
+    the high-water mark recorded by the previous sync.
+
+    :param rapid_pro: Client for the Rapid Pro instance to fetch contacts from.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param raw_data_dir: Directory to read the previous export from and write the new export to.
+    :type raw_data_dir: str
+    :param rapid_pro_source: Configuration for the Rapid Pro source to sync the contacts of.
+    :type rapid_pro_source: RapidProSource
+    :return: Dictionary of contact uuid -> contact for every contact in this source.
+    :rtype: dict of str -> temba_client.v2.Contact
+    """
+    raw_contacts_path = f"{raw_data_dir}/{rapid_pro_source.contacts_file_name}_raw.json"
+    contacts_log_path = f"{raw_data_dir}/{rapid_pro_source.contacts_file_name}_log.jsonl"
+    contacts_sync_state_path = f"{raw_data_dir}/{rapid_pro_source.contacts_file_name}_sync_state.json"
+
+    # Load the previous export of contacts if it exists, otherwise fetch all contacts from Rapid Pro.
+    try:
+        log.info(f"Loading raw contacts from file '{raw_contacts_path}'...")
+        with open(raw_contacts_path) as raw_contacts_file:
+            contacts_by_uuid = {contact.uuid: contact for contact in
+                                (Contact.deserialize(contact_json) for contact_json in json.load(raw_contacts_file))}
+        log.info(f"Loaded {len(contacts_by_uuid)} contacts")
+    except FileNotFoundError:
+        log.info(f"File '{raw_contacts_path}' not found, will fetch all contacts from the Rapid Pro server")
+        contacts_by_uuid = dict()
+
+    # Read the high-water mark left by the previous sync. Exports made before the high-water mark was recorded
+    # fall back to the newest modified_on in the loaded contacts.
+    last_modified_after_inclusive = None
+    if len(contacts_by_uuid) > 0:
+        try:
+            with open(contacts_sync_state_path) as f:
+                last_modified_after_inclusive = isoparse(json.load(f)["LastModifiedOn"])
+        except FileNotFoundError:
+            last_modified_after_inclusive = max(contact.modified_on for contact in contacts_by_uuid.values())
+
+    # Fetch the contacts modified since the high-water mark, and merge them into the previous export.
+    if last_modified_after_inclusive is None:
+        log.info("Fetching all contacts...")
+    else:
+        log.info(f"Fetching contacts modified on or after {last_modified_after_inclusive.isoformat()}...")
+    with open(contacts_log_path, "a") as raw_contacts_log_file:
+        updated_contacts = rapid_pro.get_raw_contacts(last_modified_after_inclusive=last_modified_after_inclusive,
+                                                      raw_export_log_file=raw_contacts_log_file)
+    log.info(f"Fetched {len(updated_contacts)} new or modified contacts")
+    for contact in updated_contacts:
+        contacts_by_uuid[contact.uuid] = contact
+        if last_modified_after_inclusive is None or contact.modified_on > last_modified_after_inclusive:
+            last_modified_after_inclusive = contact.modified_on
+
+    log.info(f"Saving {len(contacts_by_uuid)} raw contacts to file '{raw_contacts_path}'...")
+    with open(raw_contacts_path, "w") as raw_contacts_file:
+        json.dump([contact.serialize() for contact in contacts_by_uuid.values()], raw_contacts_file)
+    if last_modified_after_inclusive is not None:
+        with open(contacts_sync_state_path, "w") as f:
+            json.dump({"LastModifiedOn": last_modified_after_inclusive.isoformat()}, f)
+    log.info(f"Saved {len(contacts_by_uuid)} contacts")
+
+    return contacts_by_uuid
+
+
+def fetch_rapid_pro_flow_runs(rapid_pro, raw_data_dir, flow):
+    """
+    Fetches the latest runs for a flow, appending new and modified runs to this flow's RawRunStore in
+    `raw_data_dir`.
+
+    :param rapid_pro: Client for the Rapid Pro instance to fetch the flow from.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param raw_data_dir: Directory to read the previous export from and write the new export to.
+    :type raw_data_dir: str
+    :param flow: Name of the flow to fetch.
+    :type flow: str
+    :return: The store of all the raw runs for this flow.
+    :rtype: RawRunStore
+    """
+    start_time = time.perf_counter()
+
+    runs_log_path = f"{raw_data_dir}/{flow}_log.jsonl"
+    raw_runs_path = f"{raw_data_dir}/{flow}_raw.json"
+    raw_run_store = RawRunStore(f"{raw_data_dir}/{flow}_raw")
+
+    # Migrate exports made before the raw run store was introduced. The imported file is kept, renamed so that it
+    # isn't imported again, so that the export can be recovered if the import turns out to be bad.
+    if len(raw_run_store) == 0 and os.path.exists(raw_runs_path):
+        raw_run_store.import_raw_runs_file(raw_runs_path)
+        os.replace(raw_runs_path, f"{raw_runs_path}.imported")
+
+    flow_id = rapid_pro.get_flow_id(flow)
+
+    # Fetch the runs modified since the newest run in the store, and append them to the store.
+    # If the store is empty, fetch all the runs from Rapid Pro.
+    if raw_run_store.last_modified_on is None:
+        log.info(f"No raw runs stored for flow '{flow}', will fetch all runs from the Rapid Pro server")
+    else:
+        log.info(f"Loaded {len(raw_run_store)} raw runs for flow '{flow}'; fetching runs modified on or after "
+                 f"{raw_run_store.last_modified_on.isoformat()}...")
+    with open(runs_log_path, "a") as raw_runs_log_file:
+        new_runs = rapid_pro.get_raw_runs_for_flow_id(
+            flow_id, last_modified_after_inclusive=raw_run_store.last_modified_on,
+            raw_export_log_file=raw_runs_log_file)
+    log.info(f"Fetched {len(new_runs)} new or modified runs for flow '{flow}'")
+    raw_run_store.append_runs(new_runs)
+
+    log.info(f"Fetched flow '{flow}' in {time.perf_counter() - start_time:.1f}s")
+    return raw_run_store
+
+
+def _serialize_traced_run(traced_run):
+    f = StringIO()
+    TracedDataJsonIO.export_traced_data_iterable_to_jsonl([traced_run], f)
+    return f.getvalue()
+
+
+def _traced_run_cache_key(run_modified_on, contact):
+    # The converted TracedData depends on both the run and its contact, so a cached conversion is only valid while
+    # neither has been modified.
+    return run_modified_on, contact.modified_on.isoformat()
+
+
+def _get_traced_run_id(traced_run):
+    # convert_runs_to_traced_data records the id of the run each TracedData was converted from under the key
+    # "run_id - <flow name>".
+    run_ids = [value for key, value in traced_run.items() if key.startswith("run_id - ")]
+    assert len(run_ids) == 1, f"Expected exactly one run id in a converted run, but found {len(run_ids)}"
+    return run_ids[0]
+
+
+def read_conversion_library_versions(pipfile_lock_path=f"{PROJECT_DIR}/Pipfile.lock"):
+    """
+    Reads the versions of the CONVERSION_LIBRARIES pinned in Pipfile.lock.
+
+    :param pipfile_lock_path: Path to the Pipfile.lock to read.
+    :type pipfile_lock_path: str
+    :return: Dictionary of library name -> pinned version. The version is the git ref for libraries installed from
+             git, or the version specifier for libraries installed from PyPI.
+    :rtype: dict of str -> str
+    """
+    with open(pipfile_lock_path) as f:
+        packages = json.load(f)["default"]
+    return {library: packages[library].get("ref", packages[library].get("version"))
+            for library in CONVERSION_LIBRARIES}
+
+
+def make_traced_runs_cache_header(rapid_pro_source, flow):
+    """
+    Makes the header of a flow's TracedData conversion cache, which records everything other than a run and its
+    contact that the TracedData converted from that run depends on.
+
+    :param rapid_pro_source: Configuration for the Rapid Pro source the flow belongs to.
+    :type rapid_pro_source: RapidProSource
+    :param flow: Name of the flow.
+    :type flow: str
+    :return: Cache header.
+    :rtype: dict
+    """
+    return {
+        "CacheVersion": TRACED_RUNS_CACHE_VERSION,
+        "LibraryVersions": read_conversion_library_versions(),
+        "TestContactUUIDsSHA": SHAUtils.sha_string(json.dumps(sorted(rapid_pro_source.test_contact_uuids))),
+        "IsActivationFlow": flow in rapid_pro_source.activation_flow_names
+    }
+
+
+def load_traced_runs_cache(traced_runs_cache_path, cache_header):
+    """
+    Loads the TracedData conversion cache written by a previous export of a flow.
+
+    :param traced_runs_cache_path: Path to the cache file to load.
+    :type traced_runs_cache_path: str
+    :param cache_header: Header the cache must have to be valid for this export, as returned by
+                         `make_traced_runs_cache_header`.
+    :type cache_header: dict
+    :return: Dictionary of run id -> cache entry. Each cache entry has the keys "RunID", "RunModifiedOn",
+             "ContactModifiedOn", and "Line", the serialized TracedData line that run was converted to.
+             Returns an empty dictionary if there is no cache file, or if the cache file's header doesn't match
+             `cache_header`.
+    :rtype: dict of int -> dict
+    """
+    traced_runs_cache = dict()
+    try:
+        with open(traced_runs_cache_path) as f:
+            if json.loads(f.readline() or "null") != cache_header:
+                log.info(f"Conversion cache '{traced_runs_cache_path}' was written by a different version of the "
+                         f"conversion or for a different configuration; ignoring it")
+                return traced_runs_cache
+
+            for line in f:
+                cache_entry = json.loads(line)
+                traced_runs_cache[cache_entry["RunID"]] = cache_entry
+    except FileNotFoundError:
+        pass
+    return traced_runs_cache
+
+
+def export_rapid_pro_flow(user, rapid_pro, raw_data_dir, phone_number_uuid_table, rapid_pro_source, flow,
+                          raw_run_store, contacts_by_uuid):
+    """
+    Converts the raw runs for a flow to TracedData, and writes them to `raw_data_dir`.
+
+    Only runs which are new or modified since the previous export (or whose contact has been modified) are converted.
+    The serialized TracedData for all the other runs is re-used from the conversion cache written by the previous
+    export. Which runs need converting is decided from the raw run store's manifest, so only those runs are read from
+    the store.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param rapid_pro: Client for the Rapid Pro instance the flow was fetched from.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param raw_data_dir: Directory to write the traced runs to.
+    :type raw_data_dir: str
+    :param phone_number_uuid_table: Table to use to look up the phone numbers of contacts.
+    :type phone_number_uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable | CachedUuidTable
+    :param rapid_pro_source: Configuration for the Rapid Pro source this flow belongs to.
+    :type rapid_pro_source: RapidProSource
+    :param flow: Name of the flow to export.
+    :type flow: str
+    :param raw_run_store: Store of all the raw runs for this flow.
+    :type raw_run_store: RawRunStore
+    :param contacts_by_uuid: Dictionary of contact uuid -> contact for every contact in this source, as returned by
+                             `sync_rapid_pro_contacts`. This is shared between flows and must not be modified.
+    :type contacts_by_uuid: dict of str -> temba_client.v2.Contact
+    """
+    start_time = time.perf_counter()
+
+    traced_runs_output_path = f"{raw_data_dir}/{flow}.jsonl"
+    traced_runs_cache_path = f"{raw_data_dir}/{flow}_traced_cache.jsonl"
+    log.info(f"Exporting flow '{flow}' to '{traced_runs_output_path}'...")
+
+    traced_runs_cache_header = make_traced_runs_cache_header(rapid_pro_source, flow)
+    traced_runs_cache = load_traced_runs_cache(traced_runs_cache_path, traced_runs_cache_header)
+
+    # Find the runs which need converting. Runs whose contact is missing or has no urns can't be converted yet;
+    # they are skipped here, and will be converted by a later export once their contact has been fetched.
+    convertible_run_ids = []
+    run_ids_to_convert = []
+    cache_keys = dict()  # of run id -> cache key
+    for run_id, run_modified_on, contact_uuid in raw_run_store.iter_run_metadata():
+        contact = contacts_by_uuid.get(contact_uuid)
+        if contact is None or len(contact.urns) == 0:
+            continue
+        convertible_run_ids.append(run_id)
+
+        cache_keys[run_id] = _traced_run_cache_key(run_modified_on, contact)
+        cache_entry = traced_runs_cache.get(run_id)
+        if cache_entry is None or \
+                (cache_entry["RunModifiedOn"], cache_entry["ContactModifiedOn"]) != cache_keys[run_id]:
+            run_ids_to_convert.append(run_id)
+    if len(convertible_run_ids) < len(raw_run_store):
+        log.warning(f"Skipped {len(raw_run_store) - len(convertible_run_ids)} runs in flow '{flow}' with a contact "
+                    f"that is missing from the downloaded contacts or has no urns")
+    log.info(f"Converting {len(run_ids_to_convert)} new or modified runs for flow '{flow}' "
+             f"({len(convertible_run_ids) - len(run_ids_to_convert)} runs cached)...")
+
+    # Read only the runs to convert from the store, and convert them to TracedData, passing only the contacts these
+    # runs refer to.
+    runs_to_convert = raw_run_store.read_runs(run_ids_to_convert)
+    run_contact_uuids = {run.contact.uuid for run in runs_to_convert}
+    raw_contacts = [contacts_by_uuid[uuid] for uuid in run_contact_uuids]
+    traced_runs = rapid_pro.convert_runs_to_traced_data(
+        user, runs_to_convert, raw_contacts, phone_number_uuid_table, rapid_pro_source.test_contact_uuids)
+
+    if flow in rapid_pro_source.activation_flow_names:
+        label_somalia_operator(user, traced_runs, phone_number_uuid_table)
+
+    # Replace the cache entries of the converted runs with their new TracedData, matching each TracedData to its run
+    # by the run id recorded in it. Runs which didn't convert to a TracedData are left without a cache entry, so
+    # that their stale TracedData isn't exported.
+    for run_id in run_ids_to_convert:
+        traced_runs_cache.pop(run_id, None)
+    for traced_run in traced_runs:
+        run_id = _get_traced_run_id(traced_run)
+        run_modified_on, contact_modified_on = cache_keys[run_id]
+        traced_runs_cache[run_id] = {
+            "RunID": run_id,
+            "RunModifiedOn": run_modified_on,
+            "ContactModifiedOn": contact_modified_on,
+            "Line": _serialize_traced_run(traced_run)
+        }
+    converted_time = time.perf_counter()
+
+    # Stream the cached and freshly converted TracedData to the output file in run order, and write the cache
+    # entries for exactly those runs, so that entries for runs which no longer exist are dropped.
+    log.info(f"Saving traced runs to {traced_runs_output_path}...")
+    IOUtils.ensure_dirs_exist_for_file(traced_runs_output_path)
+    saved_count = 0
+    with open(traced_runs_output_path, "w") as traced_runs_output_file, \
+            open(f"{traced_runs_cache_path}.tmp", "w") as traced_runs_cache_file:
+        traced_runs_cache_file.write(json.dumps(traced_runs_cache_header))
+        traced_runs_cache_file.write("\n")
+        for run_id in convertible_run_ids:
+            cache_entry = traced_runs_cache.get(run_id)
+            if cache_entry is None:
+                continue
+            traced_runs_output_file.write(cache_entry["Line"])
+            traced_runs_cache_file.write(json.dumps(cache_entry))
+            traced_runs_cache_file.write("\n")
+            saved_count += 1
+    os.replace(f"{traced_runs_cache_path}.tmp", traced_runs_cache_path)
+    if saved_count < len(convertible_run_ids):
+        log.warning(f"{len(convertible_run_ids) - saved_count} runs in flow '{flow}' were not converted to TracedData")
+    log.info(f"Saved {saved_count} traced runs")
+    end_time = time.perf_counter()
+
+    log.info(f"Exported flow '{flow}' in {end_time - start_time:.1f}s "
+             f"(convert {converted_time - start_time:.1f}s, write {end_time - converted_time:.1f}s)")
+
+
+def export_rapid_pro_flows(user, rapid_pro, raw_data_dir, phone_number_uuid_table, rapid_pro_source):
+    """
+    Exports all the flows in the given Rapid Pro source, using up to `rapid_pro_source.max_concurrent_flow_exports`
+    worker threads to fetch, convert and write flows concurrently.
+
+    Runs are fetched for every flow first, then the contacts are synced once for the whole source, then each flow
+    is converted and written. Syncing the contacts after all the runs have been fetched ensures every run's contact
+    is available when converting.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param rapid_pro: Client for the Rapid Pro instance to fetch from.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param raw_data_dir: Directory to read previous exports from and write the new exports to.
+    :type raw_data_dir: str
+    :param phone_number_uuid_table: Table to use to look up the phone numbers of contacts.
+    :type phone_number_uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable | CachedUuidTable
+    :param rapid_pro_source: Configuration for the Rapid Pro source to export.
+    :type rapid_pro_source: RapidProSource
+    """
+    flows = rapid_pro_source.activation_flow_names + rapid_pro_source.survey_flow_names
+    log.info(f"Exporting {len(flows)} flows with up to {rapid_pro_source.max_concurrent_flow_exports} "
+             f"concurrent exports...")
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=rapid_pro_source.max_concurrent_flow_exports) as executor:
+        # Download all the runs for each of the radio shows.
+        # executor.map returns results in configuration order, and re-raises the first failure.
+        raw_run_stores = list(executor.map(lambda flow: fetch_rapid_pro_flow_runs(rapid_pro, raw_data_dir, flow),
+                                           flows))
+
+        # Sync the contacts once for the whole source, and share the result between all of the flow exports.
+        contacts_by_uuid = sync_rapid_pro_contacts(rapid_pro, raw_data_dir, rapid_pro_source)
+
+        list(executor.map(
+            lambda flow, raw_run_store: export_rapid_pro_flow(user, rapid_pro, raw_data_dir, phone_number_uuid_table,
+                                                              rapid_pro_source, flow, raw_run_store, contacts_by_uuid),
+            flows, raw_run_stores
+        ))
+    log.info(f"Exported {len(flows)} flows in {time.perf_counter() - start_time:.1f}s")
 
 
 def fetch_from_rapid_pro(user, google_cloud_credentials_file_path, raw_data_dir, phone_number_uuid_table,
@@ -60,137 +441,101 @@ def fetch_from_rapid_pro(user, google_cloud_credentials_file_path, raw_data_dir,
 
     rapid_pro = RapidProClient(rapid_pro_source.domain, rapid_pro_token)
 
-    # Load the previous export of contacts if it exists, otherwise fetch all contacts from Rapid Pro.
-    raw_contacts_path = f"{raw_data_dir}/{rapid_pro_source.contacts_file_name}_raw.json"
-    contacts_log_path = f"{raw_data_dir}/{rapid_pro_source.contacts_file_name}_log.jsonl"
-    try:
-        log.info(f"Loading raw contacts from file '{raw_contacts_path}'...")
-        with open(raw_contacts_path) as raw_contacts_file:
-            raw_contacts = [Contact.deserialize(contact_json) for contact_json in json.load(raw_contacts_file)]
-        log.info(f"Loaded {len(raw_contacts)} contacts")
-    except FileNotFoundError:
-        log.info(f"File '{raw_contacts_path}' not found, will fetch all contacts from the Rapid Pro server")
-        with open(contacts_log_path, "a") as contacts_log_file:
-            raw_contacts = rapid_pro.get_raw_contacts(raw_export_log_file=contacts_log_file)
-
-    # Download all the runs for each of the radio shows
-    for flow in rapid_pro_source.activation_flow_names + rapid_pro_source.survey_flow_names:
-        runs_log_path = f"{raw_data_dir}/{flow}_log.jsonl"
-        raw_runs_path = f"{raw_data_dir}/{flow}_raw.json"
-        traced_runs_output_path = f"{raw_data_dir}/{flow}.jsonl"
-        log.info(f"Exporting flow '{flow}' to '{traced_runs_output_path}'...")
-
-        flow_id = rapid_pro.get_flow_id(flow)
-
-        # Load the previous export of runs for this flow, and update them with the newest runs.
-        # If there is no previous export for this flow, fetch all the runs from Rapid Pro.
-        with open(runs_log_path, "a") as raw_runs_log_file:
-            try:
-                log.info(f"Loading raw runs from file '{raw_runs_path}'...")
-                with open(raw_runs_path) as raw_runs_file:
-                    raw_runs = [Run.deserialize(run_json) for run_json in json.load(raw_runs_file)]
-                log.info(f"Loaded {len(raw_runs)} runs")
-                raw_runs = rapid_pro.update_raw_runs_with_latest_modified(
-                    flow_id, raw_runs, raw_export_log_file=raw_runs_log_file)
-            except FileNotFoundError:
-                log.info(f"File '{raw_runs_path}' not found, will fetch all runs from the Rapid Pro server for flow '{flow}'")
-                raw_runs = rapid_pro.get_raw_runs_for_flow_id(flow_id, raw_export_log_file=raw_runs_log_file)
-
-        # Fetch the latest contacts from Rapid Pro.
-        with open(contacts_log_path, "a") as raw_contacts_log_file:
-            raw_contacts = rapid_pro.update_raw_contacts_with_latest_modified(raw_contacts,
-                                                                              raw_export_log_file=raw_contacts_log_file)
-
-        # Convert the runs to TracedData.
-        traced_runs = rapid_pro.convert_runs_to_traced_data(
-            user, raw_runs, raw_contacts, phone_number_uuid_table, rapid_pro_source.test_contact_uuids)
-
-        if flow in rapid_pro_source.activation_flow_names:
-            label_somalia_operator(user, traced_runs, phone_number_uuid_table)
-
-        log.info(f"Saving {len(raw_runs)} raw runs to {raw_runs_path}...")
-        with open(raw_runs_path, "w") as raw_runs_file:
-            json.dump([run.serialize() for run in raw_runs], raw_runs_file)
-        log.info(f"Saved {len(raw_runs)} raw runs")
-
-        log.info(f"Saving {len(traced_runs)} traced runs to {traced_runs_output_path}...")
-        IOUtils.ensure_dirs_exist_for_file(traced_runs_output_path)
-        with open(traced_runs_output_path, "w") as traced_runs_output_file:
-            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_runs, traced_runs_output_file)
-        log.info(f"Saved {len(traced_runs)} traced runs")
-
-    log.info(f"Saving {len(raw_contacts)} raw contacts to file '{raw_contacts_path}'...")
-    with open(raw_contacts_path, "w") as raw_contacts_file:
-        json.dump([contact.serialize() for contact in raw_contacts], raw_contacts_file)
-    log.info(f"Saved {len(raw_contacts)} contacts")
-    
-    
-def fetch_from_gcloud_bucket(google_cloud_credentials_file_path, raw_data_dir, gcloud_source):
+    export_rapid_pro_flows(user, rapid_pro, raw_data_dir, phone_number_uuid_table, rapid_pro_source)
+
+
+def fetch_from_gcloud_bucket(blob_store, raw_data_dir, gcloud_source):
     log.info("Fetching data from a gcloud bucket...")
-    for blob_url in gcloud_source.activation_flow_urls + gcloud_source.survey_flow_urls:
-        flow = blob_url.split("/")[-1]
+    download_manager = BlobDownloadManager(blob_store, raw_data_dir, gcloud_source.max_concurrent_downloads)
+    download_manager.download_blobs({
+        blob_url: blob_url.split("/")[-1]
+        for blob_url in gcloud_source.activation_flow_urls + gcloud_source.survey_flow_urls
+    })
 
-        traced_runs_output_path = f"{raw_data_dir}/{flow}"
-        if os.path.exists(traced_runs_output_path):
-            log.info(f"File '{traced_runs_output_path}' for flow '{flow}' already exists; skipping download")
-            continue
-        
-        log.info(f"Saving '{flow}' to file '{traced_runs_output_path}'...")
-        with open(traced_runs_output_path, "wb") as traced_runs_output_file:
-            google_cloud_utils.download_blob_to_file(
-                google_cloud_credentials_file_path, blob_url, traced_runs_output_file)
 
+@lru_cache(maxsize=None)
+def _shaqadoon_received_on_format(raw_date_length):
+    if raw_date_length == len("dd/mm/YYYY HH:MM"):
+        return "%d/%m/%Y %H:%M"
+    else:
+        return "%d/%m/%Y %H:%M:%S"
+
+
+def parse_shaqadoon_received_on_dates(raw_dates):
+    """
+    Parses a batch of 'ReceivedOn' dates from a Shaqadoon CSV, which are in Mogadishu local time.
+
+    Each distinct date string is only parsed once.
+
+    :param raw_dates: Dates to parse, in the format "dd/mm/YYYY HH:MM" or "dd/mm/YYYY HH:MM:SS".
+    :type raw_dates: iterable of str
+    :return: Dictionary of raw date -> ISO 8601 string of that date.
+    :rtype: dict of str -> str
+    """
+    mogadishu_timezone = pytz.timezone("Africa/Mogadishu")
+    return {
+        raw_date: mogadishu_timezone.localize(
+            datetime.strptime(raw_date, _shaqadoon_received_on_format(len(raw_date)))).isoformat()
+        for raw_date in set(raw_dates)
+    }
 
-def fetch_from_shaqadoon_csv(user, google_cloud_credentials_file_path, raw_data_dir, phone_number_uuid_table,
-                             shaqadoon_csv_source):
+
+def fetch_from_shaqadoon_csv(user, blob_store, raw_data_dir, phone_number_uuid_table, shaqadoon_csv_source):
     log.info("Fetching data from a Shaqadoon CSV...")
-    for blob_url in shaqadoon_csv_source.activation_flow_urls + shaqadoon_csv_source.survey_flow_urls:
+    blob_urls = shaqadoon_csv_source.activation_flow_urls + shaqadoon_csv_source.survey_flow_urls
+    download_manager = BlobDownloadManager(blob_store, raw_data_dir, shaqadoon_csv_source.max_concurrent_downloads)
+    downloaded_blob_urls = download_manager.download_blobs(
+        {blob_url: blob_url.split("/")[-1] for blob_url in blob_urls})
+
+    for blob_url in blob_urls:
         flow_name = blob_url.split('/')[-1].split('.')[0]  # Takes the name between the last '/' and the '.csv' ending 
+        raw_csv_path = f"{raw_data_dir}/{blob_url.split('/')[-1]}"
         traced_runs_output_path = f"{raw_data_dir}/{flow_name}.jsonl"
-        if os.path.exists(traced_runs_output_path):
-            log.info(f"File '{traced_runs_output_path}' for blob '{blob_url}' already exists; skipping download")
+        if os.path.exists(traced_runs_output_path) and blob_url not in downloaded_blob_urls:
+            log.info(f"File '{traced_runs_output_path}' for blob '{blob_url}' is up to date; skipping conversion")
             continue
 
-        log.info(f"Downloading recovered data from '{blob_url}'...")
-        raw_csv_string = StringIO(google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path, blob_url))
-        raw_data = list(csv.DictReader(raw_csv_string))
-        log.info(f"Downloaded {len(raw_data)} recovered messages")
-
-        log.info("Converting the recovered messages to TracedData...")
-        traced_runs = []
-        for i, row in enumerate(raw_data):
-            raw_date = row["ReceivedOn"]
-            if len(raw_date) == len("dd/mm/YYYY HH:MM"):
-                parsed_raw_date = datetime.strptime(raw_date, "%d/%m/%Y %H:%M")
-            else:
-                parsed_raw_date = datetime.strptime(raw_date, "%d/%m/%Y %H:%M:%S")
-            localized_date = pytz.timezone("Africa/Mogadishu").localize(parsed_raw_date)
-
-            assert row["Sender"].startswith("avf-phone-uuid-"), \
-                f"The 'Sender' column for '{blob_url} contains an item that has not been de-identified " \
-                f"into Africa's Voices Foundation's de-identification format. This may be done with de_identify_csv.py."
-
-            d = {
-                "avf_phone_id": row["Sender"],
-                "message": row["Message"],
-                "received_on": localized_date.isoformat(),
-                "run_id": SHAUtils.sha_dict(row)
-            }
-
-            traced_runs.append(
-                TracedData(d, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
-            )
-        log.info("Converted the recovered messages to TracedData")
-
-        if blob_url in shaqadoon_csv_source.activation_flow_urls:
-            label_somalia_operator(user, traced_runs, phone_number_uuid_table)
-
-        log.info(f"Exporting {len(traced_runs)} TracedData items to {traced_runs_output_path}...")
-        IOUtils.ensure_dirs_exist_for_file(traced_runs_output_path)
-        with open(traced_runs_output_path, "w") as f:
-            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_runs, f)
-        log.info(f"Exported TracedData")
+        with open(raw_csv_path, encoding="utf-8", newline="") as raw_csv_file:
+            # Convert the recovered messages to TracedData and write them out in chunks, so that only one chunk of
+            # the CSV is held in memory at a time. The output is written to a temporary file first, so that a
+            # partially written file is never mistaken for a complete export by the check above.
+            log.info(f"Converting the recovered messages to TracedData and exporting to {traced_runs_output_path}...")
+            IOUtils.ensure_dirs_exist_for_file(traced_runs_output_path)
+            raw_data = csv.DictReader(raw_csv_file)
+            exported_count = 0
+            with open(f"{traced_runs_output_path}.tmp", "w") as f:
+                while True:
+                    rows = list(itertools.islice(raw_data, SHAQADOON_CSV_CHUNK_SIZE))
+                    if len(rows) == 0:
+                        break
+
+                    received_on_dates = parse_shaqadoon_received_on_dates(row["ReceivedOn"] for row in rows)
+                    metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+
+                    traced_runs = []
+                    for row in rows:
+                        assert row["Sender"].startswith("avf-phone-uuid-"), \
+                            f"The 'Sender' column for '{blob_url} contains an item that has not been de-identified " \
+                            f"into Africa's Voices Foundation's de-identification format. " \
+                            f"This may be done with de_identify_csv.py."
+
+                        d = {
+                            "avf_phone_id": row["Sender"],
+                            "message": row["Message"],
+                            "received_on": received_on_dates[row["ReceivedOn"]],
+                            "run_id": SHAUtils.sha_dict(row)
+                        }
+
+                        traced_runs.append(TracedData(d, metadata))
+
+                    if blob_url in shaqadoon_csv_source.activation_flow_urls:
+                        label_somalia_operator(user, traced_runs, phone_number_uuid_table)
+
+                    TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_runs, f)
+                    exported_count += len(traced_runs)
+                    log.info(f"Exported {exported_count} recovered messages...")
+            os.replace(f"{traced_runs_output_path}.tmp", traced_runs_output_path)
+        log.info(f"Exported {exported_count} TracedData items to {traced_runs_output_path}")
 
 
 def main(user, google_cloud_credentials_file_path, pipeline_configuration_file_path, raw_data_dir):
@@ -212,6 +557,18 @@ def main(user, google_cloud_credentials_file_path, pipeline_configuration_file_p
     )
     log.info("Initialised the Firestore UUID table")
 
+    if pipeline_configuration.phone_number_uuid_table.cache_encryption_key_file_url is not None:
+        log.info("Downloading the phone number <-> uuid cache encryption key...")
+        cache_encryption_key = google_cloud_utils.download_blob_to_string(
+            google_cloud_credentials_file_path,
+            pipeline_configuration.phone_number_uuid_table.cache_encryption_key_file_url
+        ).strip()
+        phone_number_uuid_table = CachedUuidTable(
+            phone_number_uuid_table, f"{raw_data_dir}/phone_number_uuid_cache.sqlite", cache_encryption_key)
+        log.info("Initialised the local phone number <-> uuid cache")
+
+    blob_store = GCloudBlobStore(google_cloud_credentials_file_path)
+
     log.info(f"Fetching data from {len(pipeline_configuration.raw_data_sources)} sources...")
     for i, raw_data_source in enumerate(pipeline_configuration.raw_data_sources):
         log.info(f"Fetching from source {i + 1}/{len(pipeline_configuration.raw_data_sources)}...")
@@ -219,14 +576,16 @@ def main(user, google_cloud_credentials_file_path, pipeline_configuration_file_p
             fetch_from_rapid_pro(user, google_cloud_credentials_file_path, raw_data_dir, phone_number_uuid_table,
                                  raw_data_source)
         elif isinstance(raw_data_source, GCloudBucketSource):
-            fetch_from_gcloud_bucket(google_cloud_credentials_file_path, raw_data_dir, raw_data_source)
+            fetch_from_gcloud_bucket(blob_store, raw_data_dir, raw_data_source)
         elif isinstance(raw_data_source, ShaqadoonCSVSource):
-            fetch_from_shaqadoon_csv(user, google_cloud_credentials_file_path, raw_data_dir, phone_number_uuid_table,
-                                     raw_data_source)
+            fetch_from_shaqadoon_csv(user, blob_store, raw_data_dir, phone_number_uuid_table, raw_data_source)
 
         else:
             assert False, f"Unknown raw_data_source type {type(raw_data_source)}"
 
+    if isinstance(phone_number_uuid_table, CachedUuidTable):
+        phone_number_uuid_table.log_stats()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetches all the raw data for this project from Rapid Pro. "
@@ -1,6 +1,8 @@
 import argparse
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data.io import TracedDataJsonIO
@@ -10,14 +12,147 @@ from storage.google_drive import drive_client_wrapper
 
 from src import CombineRawDatasets, TranslateRapidProKeys, AutoCode, ProductionFile, \
     ApplyManualCodes, AnalysisFile, WSCorrection
-from src.lib import PipelineConfiguration
+from src.lib import CodaFileCache, MessageIds, PipelineConfiguration, StageCheckpoints, TimestampParser
 
 Logger.set_project_name("OCHA")
 log = Logger(__name__)
 
+# Names of the stages which can be checkpointed, in the order they run.
+STAGE_NAMES = ["combine_raw_datasets", "translate_rapid_pro_keys", "ws_correction", "auto_code", "production_file",
+               "apply_manual_codes"]
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Paths, relative to the project directory, of everything other than the pipeline configuration and the stages'
+# input files that determines the output of the stages: the code, the code schemes which src/lib/code_schemes.py
+# loads at import time, and Pipfile.lock, which pins the versions of the libraries that do the cleaning and Coda IO.
+CODE_PATHS = ["generate_outputs.py", "src", "code_schemes", "Pipfile.lock"]
+
+
+def load_dataset(raw_flow_path):
+    """
+    Loads the TracedData in a raw flow file exported by fetch_raw_data.py.
+
+    This is a module-level function so that it can be run in a worker process by `load_datasets`.
+
+    :param raw_flow_path: Path to the raw flow file to load.
+    :type raw_flow_path: str
+    :return: Tuple of (TracedData loaded from the file, time taken to load the file in seconds).
+    :rtype: (list of TracedData, float)
+    """
+    start_time = time.perf_counter()
+    with open(raw_flow_path, "r") as f:
+        runs = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
+    return runs, time.perf_counter() - start_time
+
+
+def hash_stage_inputs(pipeline_configuration_file_path, user, stage_input_output_paths, project_dir=PROJECT_DIR):
+    """
+    Computes the hash of the inputs of each checkpointed stage.
+
+    Each stage's hash covers the hash of the previous stage, the files that stage reads, the paths of the files that
+    stage writes, the user running the pipeline, and the files in CODE_PATHS, so a change to any of these invalidates
+    the checkpoints of that stage and of every stage after it.
+
+    :param pipeline_configuration_file_path: Path to the pipeline configuration file.
+    :type pipeline_configuration_file_path: str
+    :param user: Identifier of the user running the pipeline, which is recorded in the TracedData Metadata.
+    :type user: str
+    :param stage_input_output_paths: (stage name, paths of the files that stage reads, paths of the files that stage
+                                     writes) for each stage, in the order they run.
+    :type stage_input_output_paths: list of (str, list of str, list of str)
+    :param project_dir: Directory that the paths in CODE_PATHS are relative to.
+    :type project_dir: str
+    :return: Hash of the inputs of each stage, in the same order as `stage_input_output_paths`.
+    :rtype: list of str
+    """
+    inputs_hash = StageCheckpoints.chain_hash(
+        StageCheckpoints.hash_files([pipeline_configuration_file_path]),
+        StageCheckpoints.hash_files([os.path.join(project_dir, path) for path in CODE_PATHS]),
+        user
+    )
+    stage_inputs_hashes = []
+    for stage_name, input_paths, output_paths in stage_input_output_paths:
+        inputs_hash = StageCheckpoints.chain_hash(
+            inputs_hash, stage_name, StageCheckpoints.hash_files(input_paths), *output_paths)
+        stage_inputs_hashes.append(inputs_hash)
+    return stage_inputs_hashes
+
+
+def get_first_stage_to_run(checkpoints, stage_names, stage_inputs_hashes):
+    """
+    :param checkpoints: Checkpoints saved by previous runs.
+    :type checkpoints: StageCheckpoints
+    :param stage_names: Names of the checkpointed stages, in the order they run.
+    :type stage_names: list of str
+    :param stage_inputs_hashes: Hash of the current inputs of each stage, as returned by `hash_stage_inputs`.
+    :type stage_inputs_hashes: list of str
+    :return: Index of the stage after the latest stage whose checkpoint was saved with its current inputs hash, or 0
+             if no stage has such a checkpoint.
+    :rtype: int
+    """
+    for i in reversed(range(len(stage_names))):
+        if checkpoints.get_checkpoint_hash(stage_names[i]) == stage_inputs_hashes[i]:
+            return i + 1
+    return 0
+
+
+def load_datasets(raw_data_dir, flow_names, max_workers=1):
+    """
+    Loads the raw flow files for the given flows, parsing up to `max_workers` files in parallel.
+
+    Each worker process needs enough memory to hold the TracedData it parses as well as the copy it sends back to
+    this process, so loading in parallel needs more memory than loading in this process.
+
+    :param raw_data_dir: Directory containing the raw flow files exported by fetch_raw_data.py.
+    :type raw_data_dir: str
+    :param flow_names: Names of the flows to load.
+    :type flow_names: list of str
+    :param max_workers: Maximum number of processes to parse files with. If 1, the files are parsed in this process.
+    :type max_workers: int
+    :return: The TracedData loaded for each flow, in the same order as `flow_names`.
+    :rtype: list of list of TracedData
+    """
+    raw_flow_paths = [f"{raw_data_dir}/{flow_name}.jsonl" for flow_name in flow_names]
+    log.info(f"Loading {len(raw_flow_paths)} raw flow files...")
+    start_time = time.perf_counter()
+
+    def log_loaded(loaded):
+        datasets = []
+        for i, (raw_flow_path, (runs, load_time)) in enumerate(zip(raw_flow_paths, loaded)):
+            log.info(f"Loaded {i + 1}/{len(raw_flow_paths)}: {raw_flow_path} ({len(runs)} runs in {load_time:.1f}s)")
+            datasets.append(runs)
+        return datasets
+
+    if max_workers == 1:
+        datasets = log_loaded(map(load_dataset, raw_flow_paths))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            datasets = log_loaded(executor.map(load_dataset, raw_flow_paths))
+
+    log.info(f"Loaded {sum(len(runs) for runs in datasets)} runs from {len(raw_flow_paths)} raw flow files in "
+             f"{time.perf_counter() - start_time:.1f}s")
+    return datasets
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Runs the post-fetch phase of the pipeline")
 
+    parser.add_argument("--checkpoint-dir", metavar="checkpoint-dir",
+                        help="Directory to save the output of each stage to. If set, the pipeline resumes after the "
+                             "last stage with a checkpoint whose inputs are unchanged since it was saved. "
+                             "Note that when 'MoveWSMessages' is true in the pipeline configuration, a change to "
+                             "only the Coda files re-runs the pipeline from ws_correction, rather than from "
+                             "apply_manual_codes")
+    parser.add_argument("--max-load-workers", metavar="max-load-workers", type=int, default=1,
+                        help="Maximum number of processes to load the raw data files with. Each process holds a copy "
+                             "of the data it loads, so raising this raises peak memory use. Defaults to 1")
+    parser.add_argument("--max-ws-correction-workers", metavar="max-ws-correction-workers", type=int, default=1,
+                        help="Maximum number of processes to move WS messages with. Defaults to 1")
+    parser.add_argument("--resume-from", metavar="stage", choices=STAGE_NAMES,
+                        help="Stage to resume from, using the checkpoint of the stage before it even if that "
+                             "checkpoint's inputs have changed. Requires --checkpoint-dir")
+
     parser.add_argument("user", help="User launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -50,6 +185,8 @@ if __name__ == "__main__":
                              "radio show production"),
 
     args = parser.parse_args()
+    if args.resume_from is not None and args.checkpoint_dir is None:
+        parser.error("--resume-from requires --checkpoint-dir")
 
     csv_by_message_drive_path = None
     csv_by_individual_drive_path = None
@@ -70,6 +207,11 @@ if __name__ == "__main__":
     csv_by_individual_output_path = args.csv_by_individual_output_path
     production_csv_output_path = args.production_csv_output_path
 
+    max_load_workers = args.max_load_workers
+    max_ws_correction_workers = args.max_ws_correction_workers
+    checkpoint_dir = args.checkpoint_dir
+    resume_from = args.resume_from
+
     # Load the pipeline configuration file
     log.info("Loading Pipeline Configuration File...")
     with open(pipeline_configuration_file_path) as f:
@@ -81,55 +223,105 @@ if __name__ == "__main__":
             google_cloud_credentials_file_path, pipeline_configuration.drive_upload.drive_credentials_file_url))
         drive_client_wrapper.init_client_from_info(credentials_info)
 
-    # Load the input datasets
-    def load_datasets(flow_names):
-        datasets = []
-        for i, flow_name in enumerate(flow_names):
-            raw_flow_path = f"{raw_data_dir}/{flow_name}.jsonl"
-            log.info(f"Loading {i + 1}/{len(flow_names)}: {raw_flow_path}...")
-            with open(raw_flow_path, "r") as f:
-                runs = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
-            log.info(f"Loaded {len(runs)} runs")
-            datasets.append(runs)
-        return datasets
-
     activation_flow_names = []
     survey_flow_names = []
     for raw_data_source in pipeline_configuration.raw_data_sources:
         activation_flow_names.extend(raw_data_source.get_activation_flow_names())
         survey_flow_names.extend(raw_data_source.get_survey_flow_names())
 
-    log.info("Loading activation datasets...")
-    activation_datasets = load_datasets(activation_flow_names)
-
-    log.info("Loading survey datasets...")
-    survey_datasets = load_datasets(survey_flow_names)
-
-    # Add survey data to the messages
-    log.info("Combining Datasets...")
-    coalesced_survey_datasets = []
-    for dataset in survey_datasets:
-        coalesced_survey_datasets.append(CombineRawDatasets.coalesce_traced_runs_by_key(user, dataset, "avf_phone_id"))
-    data = CombineRawDatasets.combine_raw_datasets(user, activation_datasets, coalesced_survey_datasets)
-
-    log.info("Translating Rapid Pro Keys...")
-    data = TranslateRapidProKeys.translate_rapid_pro_keys(user, data, pipeline_configuration)
-
-    if pipeline_configuration.move_ws_messages:
-        log.info("Moving WS messages...")
-        data = WSCorrection.move_wrong_scheme_messages(user, data, prev_coded_dir_path)
-    else:
-        log.info("Not moving WS messages (because the 'MoveWSMessages' key in the pipeline configuration "
-                 "json was set to 'false')")
-
-    log.info("Auto Coding Messages...")
-    data = AutoCode.auto_code(user, data, pipeline_configuration, icr_output_dir, coded_dir_path)
-
-    log.info("Exporting production CSV...")
-    data = ProductionFile.generate(data, production_csv_output_path)
-
-    log.info("Applying Manual Codes from Coda...")
-    data = ApplyManualCodes.apply_manual_codes(user, data, prev_coded_dir_path)
+    def combine_raw_datasets(_):
+        # Load the input datasets
+        log.info("Loading activation and survey datasets...")
+        datasets = load_datasets(raw_data_dir, activation_flow_names + survey_flow_names, max_load_workers)
+        activation_datasets = datasets[:len(activation_flow_names)]
+        survey_datasets = datasets[len(activation_flow_names):]
+
+        # Add survey data to the messages
+        log.info("Combining Datasets...")
+        coalesced_survey_datasets = []
+        for dataset in survey_datasets:
+            coalesced_survey_datasets.append(
+                CombineRawDatasets.coalesce_traced_runs_by_key(user, dataset, "avf_phone_id"))
+        return CombineRawDatasets.combine_raw_datasets(user, activation_datasets, coalesced_survey_datasets)
+
+    def translate_rapid_pro_keys(data):
+        log.info("Translating Rapid Pro Keys...")
+        return TranslateRapidProKeys.translate_rapid_pro_keys(user, data, pipeline_configuration)
+
+    def ws_correction(data):
+        if pipeline_configuration.move_ws_messages:
+            log.info("Moving WS messages...")
+            return WSCorrection.move_wrong_scheme_messages(user, data, prev_coded_dir_path, max_ws_correction_workers)
+        else:
+            log.info("Not moving WS messages (because the 'MoveWSMessages' key in the pipeline configuration "
+                     "json was set to 'false')")
+            return data
+
+    def auto_code(data):
+        log.info("Auto Coding Messages...")
+        return AutoCode.auto_code(user, data, pipeline_configuration, icr_output_dir, coded_dir_path)
+
+    def production_file(data):
+        log.info("Exporting production CSV...")
+        return ProductionFile.generate(data, production_csv_output_path)
+
+    def apply_manual_codes(data):
+        log.info("Applying Manual Codes from Coda...")
+        return ApplyManualCodes.apply_manual_codes(user, data, prev_coded_dir_path)
+
+    # The hash of each stage's inputs covers the hash of the previous stage, the files that stage reads, and the code
+    # (see `hash_stage_inputs`). WS correction only reads the Coda files when MoveWSMessages is set, so only then does
+    # a Coda-only change invalidate it. Otherwise, such a change only invalidates ApplyManualCodes.
+    stages = [
+        # (name, function, files read, files written)
+        ("combine_raw_datasets", combine_raw_datasets,
+         [f"{raw_data_dir}/{flow_name}.jsonl" for flow_name in activation_flow_names + survey_flow_names], []),
+        ("translate_rapid_pro_keys", translate_rapid_pro_keys, [], []),
+        ("ws_correction", ws_correction, [prev_coded_dir_path] if pipeline_configuration.move_ws_messages else [], []),
+        ("auto_code", auto_code, [], [icr_output_dir, coded_dir_path]),
+        ("production_file", production_file, [], [production_csv_output_path]),
+        ("apply_manual_codes", apply_manual_codes, [prev_coded_dir_path], [])
+    ]
+    assert [stage[0] for stage in stages] == STAGE_NAMES
+
+    data = None
+    first_stage_to_run = 0
+    if checkpoint_dir is not None:
+        checkpoints = StageCheckpoints(checkpoint_dir)
+
+        log.info("Hashing stage inputs...")
+        stage_inputs_hashes = hash_stage_inputs(
+            pipeline_configuration_file_path, user,
+            [(stage_name, input_paths, output_paths) for stage_name, _, input_paths, output_paths in stages])
+
+        if resume_from is not None:
+            first_stage_to_run = STAGE_NAMES.index(resume_from)
+            if first_stage_to_run > 0:
+                checkpoint_stage_name = STAGE_NAMES[first_stage_to_run - 1]
+                checkpoint_hash = checkpoints.get_checkpoint_hash(checkpoint_stage_name)
+                assert checkpoint_hash is not None, f"No checkpoint exists for stage '{checkpoint_stage_name}'"
+                if checkpoint_hash != stage_inputs_hashes[first_stage_to_run - 1]:
+                    log.warning(f"The inputs of stage '{checkpoint_stage_name}' have changed since its checkpoint "
+                                f"was saved; resuming from it anyway")
+        else:
+            first_stage_to_run = get_first_stage_to_run(checkpoints, STAGE_NAMES, stage_inputs_hashes)
+
+        if first_stage_to_run > 0:
+            log.info(f"Skipping the stages up to and including '{STAGE_NAMES[first_stage_to_run - 1]}', "
+                     f"using their checkpoints")
+            # Restore the files written by all the skipped stages, not just the last one.
+            for i in range(first_stage_to_run - 1):
+                stage_name, _, _, output_paths = stages[i]
+                if len(output_paths) > 0:
+                    checkpoints.restore_outputs(stage_name, output_paths)
+            stage_name, _, _, output_paths = stages[first_stage_to_run - 1]
+            data = checkpoints.load(stage_name, output_paths)
+
+    for i in range(first_stage_to_run, len(stages)):
+        stage_name, stage_fn, _, output_paths = stages[i]
+        data = stage_fn(data)
+        if checkpoint_dir is not None:
+            checkpoints.save(stage_name, stage_inputs_hashes[i], data, output_paths)
 
     log.info("Generating Analysis CSVs...")
     messages_data, individuals_data = AnalysisFile.generate(user, data, csv_by_message_output_path,
@@ -187,4 +379,7 @@ if __name__ == "__main__":
         log.info("Skipping uploading to Google Drive (because the pipeline configuration json does not contain the key "
                  "'DriveUploadPaths')")
 
+    TimestampParser.log_stats()
+    CodaFileCache.log_stats()
+    MessageIds.log_stats()
     log.info("Python script complete")
@@ -13,6 +13,12 @@ while [[ $# -gt 0 ]]; do
             MEMORY_PROFILE_OUTPUT_PATH="$2"
             MEMORY_PROFILE_ARG="--profile-memory $MEMORY_PROFILE_OUTPUT_PATH"
             shift 2;;
+        --checkpoint-dir)
+            CHECKPOINT_DIR_ARG="--checkpoint-dir $2"
+            shift 2;;
+        --resume-from)
+            RESUME_FROM_ARG="--resume-from $2"
+            shift 2;;
         --)
             shift
             break;;
@@ -22,7 +28,7 @@ while [[ $# -gt 0 ]]; do
 done
 
 if [[ $# -ne 4 ]]; then
-    echo "Usage: ./3_generate_outputs.sh [--profile-cpu <cpu-profile-output-path>] [--profile-memory <memory-profile-output-path>] <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
+    echo "Usage: ./3_generate_outputs.sh [--profile-cpu <cpu-profile-output-path>] [--profile-memory <memory-profile-output-path>] [--checkpoint-dir <checkpoint-dir> [--resume-from <stage>]] <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
     echo "Generates the outputs needed downstream from raw data files generated by step 2 and uploads to Google Drive"
     exit
 fi
@@ -36,7 +42,7 @@ mkdir -p "$DATA_ROOT/Coded Coda Files"
 mkdir -p "$DATA_ROOT/Outputs"
 
 cd ..
-./docker-run-generate-outputs.sh ${CPU_PROFILE_ARG} ${MEMORY_PROFILE_ARG} \
+./docker-run-generate-outputs.sh ${CPU_PROFILE_ARG} ${MEMORY_PROFILE_ARG} ${CHECKPOINT_DIR_ARG} ${RESUME_FROM_ARG} \
     "$USER" "$GOOGLE_CLOUD_CREDENTIALS_FILE_PATH" "$PIPELINE_CONFIGURATION_FILE_PATH" \
     "$DATA_ROOT/Raw Data" "$DATA_ROOT/Coded Coda Files/" \
     "$DATA_ROOT/Outputs/messages_traced_data.jsonl" "$DATA_ROOT/Outputs/individuals_traced_data.jsonl" \
@@ -7,7 +7,7 @@ from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataCodaV2IO
 
-from src.lib import PipelineConfiguration
+from src.lib import CodaFileCache, CodingErrorDetector, PipelineConfiguration
 from src.lib.code_schemes import CodeSchemes
 from src.lib.pipeline_configuration import CodingModes
 
@@ -17,57 +17,37 @@ log = Logger(__name__)
 class ApplyManualCodes(object):
     @staticmethod
     def _impute_coding_error_codes(user, data):
-        for td in data:
+        coding_error_detector = CodingErrorDetector(
+            PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS
+        )
+        for td, plans_with_errors in zip(data, coding_error_detector.detect(data)):
             coding_error_dict = dict()
-            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-                rqa_codes = []
+            for plan in plans_with_errors:
+                log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
+                coding_error_dict[f"{plan.raw_field}_correct_dataset"] = \
+                    CleaningUtils.make_label_from_cleaner_code(
+                        CodeSchemes.WS_CORRECT_DATASET,
+                        CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
+                        Metadata.get_call_location(),
+                    ).to_dict()
+
                 for cc in plan.coding_configurations:
                     if cc.coding_mode == CodingModes.SINGLE:
-                        if cc.coded_field in td:
-                            label = td[cc.coded_field]
-                            rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
+                        coding_error_dict[cc.coded_field] = \
+                            CleaningUtils.make_label_from_cleaner_code(
+                                cc.code_scheme,
+                                cc.code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
+                                Metadata.get_call_location()
+                            ).to_dict()
                     else:
                         assert cc.coding_mode == CodingModes.MULTIPLE
-                        for label in td.get(cc.coded_field, []):
-                            rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
-
-                has_ws_code_in_code_scheme = False
-                for code in rqa_codes:
-                    if code.control_code == Codes.WRONG_SCHEME:
-                        has_ws_code_in_code_scheme = True
-
-                has_ws_code_in_ws_scheme = False
-                if f"{plan.raw_field}_correct_dataset" in td:
-                    ws_code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_code_id(
-                        td[f"{plan.raw_field}_correct_dataset"]["CodeID"])
-                    has_ws_code_in_ws_scheme = ws_code.code_type == "Normal" or ws_code.control_code == Codes.NOT_CODED
-
-                if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
-                    log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
-                    coding_error_dict[f"{plan.raw_field}_correct_dataset"] = \
-                        CleaningUtils.make_label_from_cleaner_code(
-                            CodeSchemes.WS_CORRECT_DATASET,
-                            CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
-                            Metadata.get_call_location(),
-                        ).to_dict()
-
-                    for cc in plan.coding_configurations:
-                        if cc.coding_mode == CodingModes.SINGLE:
-                            coding_error_dict[cc.coded_field] = \
-                                CleaningUtils.make_label_from_cleaner_code(
-                                    cc.code_scheme,
-                                    cc.code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
-                                    Metadata.get_call_location()
-                                ).to_dict()
-                        else:
-                            assert cc.coding_mode == CodingModes.MULTIPLE
-                            coding_error_dict[cc.coded_field] = [
-                                CleaningUtils.make_label_from_cleaner_code(
-                                    cc.code_scheme,
-                                    cc.code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
-                                    Metadata.get_call_location()
-                                ).to_dict()
-                            ]
+                        coding_error_dict[cc.coded_field] = [
+                            CleaningUtils.make_label_from_cleaner_code(
+                                cc.code_scheme,
+                                cc.code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
+                                Metadata.get_call_location()
+                            ).to_dict()
+                        ]
 
             td.append_data(coding_error_dict, Metadata(user, Metadata.get_call_location(), time.time()))
 
@@ -80,34 +60,27 @@ class ApplyManualCodes(object):
 
             coda_input_path = path.join(coda_input_dir, plan.coda_filename)
 
-            for cc in plan.coding_configurations:
-                f = None
-                try:
-                    if path.exists(coda_input_path):
-                        f = open(coda_input_path, "r")
+            # Coda files only exist once manual coding has started for a dataset. If this plan's Coda file does not
+            # exist, the imports are given None, which labels every message as not yet reviewed.
+            if not path.exists(coda_input_path):
+                log.warning(f"Coda file '{coda_input_path}' does not exist; importing no manual codes for it")
 
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                            user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
-                    else:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
-                            user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
-                finally:
-                    if f is not None:
-                        f.close()
-
-            f = None
-            try:
-                if path.exists(coda_input_path):
-                    f = open(coda_input_path, "r")
-
-                TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                    user, data, plan.id_field,
-                    {f"{plan.raw_field}_correct_dataset": CodeSchemes.WS_CORRECT_DATASET}, f
-                )
-            finally:
-                if f is not None:
-                    f.close()
+            # Apply all the schemes of each coding mode in one import, so the Coda file is parsed at most once per
+            # coding mode rather than once per scheme.
+            single_coded_scheme_key_map = dict()
+            multi_coded_scheme_key_map = dict()
+            for cc in plan.coding_configurations:
+                if cc.coding_mode == CodingModes.SINGLE:
+                    single_coded_scheme_key_map[cc.coded_field] = cc.code_scheme
+                else:
+                    multi_coded_scheme_key_map[cc.coded_field] = cc.code_scheme
+            single_coded_scheme_key_map[f"{plan.raw_field}_correct_dataset"] = CodeSchemes.WS_CORRECT_DATASET
+
+            TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
+                user, data, plan.id_field, single_coded_scheme_key_map, CodaFileCache.open(coda_input_path))
+            if len(multi_coded_scheme_key_map) > 0:
+                TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
+                    user, data, plan.id_field, multi_coded_scheme_key_map, CodaFileCache.open(coda_input_path))
 
         # Label data for which there is no response as TRUE_MISSING.
         # Label data for which the response is the empty string as NOT_CODED.
@@ -1,12 +1,14 @@
 import random
+import time
 from os import path
 
 from core_data_modules.cleaners.cleaning_utils import CleaningUtils
 from core_data_modules.logging import Logger
+from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataCSVIO, TracedDataCodaV2IO
 from core_data_modules.util import IOUtils
 
-from src.lib import PipelineConfiguration, MessageFilters, ICRTools
+from src.lib import PipelineConfiguration, MessageFilterChain, MessageFilters, MessageIds, ICRTools
 
 log = Logger(__name__)
 
@@ -54,40 +56,79 @@ class AutoCode(object):
 
     @classmethod
     def filter_messages(cls, data, project_start_date, project_end_date, filter_test_messages=True):
+        chain = MessageFilterChain(data)
+
         # Filter out test messages sent by AVF.
         if filter_test_messages:
-            data = MessageFilters.filter_test_messages(data)
+            chain.add_filter("test messages", MessageFilters.is_not_test_message())
         else:
             log.debug("Not filtering out test messages (because the pipeline configuration json key "
                       "'FilterTestMessages' was set to false)")
 
         # Filter for runs which don't contain a response to any week's question
-        data = MessageFilters.filter_empty_messages(data,
-                                                    [plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS])
+        chain.add_filter("empty messages", MessageFilters.is_not_empty_message(
+            [plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS]))
 
         # Filter out runs sent outwith the project start and end dates
         time_keys = {plan.time_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
-        data = MessageFilters.filter_time_range(data, time_keys, project_start_date, project_end_date)
+        chain.add_filter(f"messages sent outside the time range {project_start_date.isoformat()} to "
+                         f"{project_end_date.isoformat()}",
+                         MessageFilters.is_in_time_range(time_keys, project_start_date, project_end_date))
 
-        return data
+        return chain.to_list()
 
     @classmethod
     def run_cleaners(cls, user, data):
+        # List the coding configurations which have cleaners in coding plan order, so that later configurations still
+        # take precedence if two write the same coded field. Configurations which run the same cleaner on the same
+        # raw field into the same code scheme share a memo of the cleaner's results.
+        cleaners = []  # of (raw_field, coded_field, cleaner, code_scheme, results memo)
+        memos = dict()  # of (raw_field, cleaner, code scheme id) -> dict of raw text -> cleaned Label
         for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
             for cc in plan.coding_configurations:
                 if cc.cleaner is not None:
-                    CleaningUtils.apply_cleaner_to_traced_data_iterable(user, data, plan.raw_field, cc.coded_field,
-                                                                        cc.cleaner, cc.code_scheme)
+                    memo = memos.setdefault((plan.raw_field, cc.cleaner, cc.code_scheme.scheme_id), dict())
+                    cleaners.append((plan.raw_field, cc.coded_field, cc.cleaner, cc.code_scheme, memo))
+
+        # Raw texts repeat heavily (especially survey answers such as age and location), so run each cleaner once per
+        # distinct text and reuse its label, and write all of each TracedData's cleaned labels in a single append.
+        cleaner_calls = 0
+        cleaned_values = 0
+        metadata = Metadata(user, Metadata.get_call_location(), time.time())
+        for td in data:
+            cleaned = dict()
+            for raw_field, coded_field, cleaner, code_scheme, memo in cleaners:
+                if raw_field not in td:
+                    continue
+
+                text = td[raw_field]
+                cleaned_values += 1
+                if text not in memo:
+                    cleaner_calls += 1
+                    memo[text] = CleaningUtils.apply_cleaner_to_text(cleaner, text, code_scheme)
+
+                label = memo[text]
+                if label is not None:
+                    cleaned[coded_field] = label.to_dict()
+
+            if len(cleaned) > 0:
+                td.append_data(cleaned, metadata)
+
+        log.info(f"Cleaned {cleaned_values} values with {cleaner_calls} cleaner calls")
 
     @classmethod
     def export_coda(cls, user, data, coda_output_dir):
         IOUtils.ensure_dirs_exist(coda_output_dir)
+        MessageIds.compute_message_ids(user, data, [
+            (plan.raw_field, plan.id_field)
+            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS
+            if plan.coda_filename is not None
+        ])
+
         for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
             if plan.coda_filename is None:
                 continue
 
-            TracedDataCodaV2IO.compute_message_ids(user, data, plan.raw_field, plan.id_field)
-
             coda_output_path = path.join(coda_output_dir, plan.coda_filename)
             with open(coda_output_path, "w") as f:
                 TracedDataCodaV2IO.export_traced_data_iterable_to_coda_2(
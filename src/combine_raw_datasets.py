@@ -1,20 +1,28 @@
-from core_data_modules.traced_data import TracedData, Metadata
+from core_data_modules.traced_data import Metadata
 from core_data_modules.util import TimeUtils
 
 
 class CombineRawDatasets(object):
     @staticmethod
     def coalesce_traced_runs_by_key(user, traced_runs, coalesce_key):
-        coalesced_runs = dict()
-
+        # Group the runs by key first, so that each group's later runs can be merged into its first run with a
+        # single append, rather than one append per repeated run.
+        runs_by_key = dict()  # of coalesce key value -> list of TracedData, in received order
         for run in traced_runs:
-            if run[coalesce_key] not in coalesced_runs:
-                coalesced_runs[run[coalesce_key]] = run
-            else:
-                coalesced_runs[run[coalesce_key]].append_data(
-                    dict(run.items()), Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            runs_by_key.setdefault(run[coalesce_key], []).append(run)
+
+        coalesced_runs = []
+        coalesce_metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        for runs in runs_by_key.values():
+            first_run = runs[0]
+            if len(runs) > 1:
+                merged_data = dict()
+                for run in runs[1:]:
+                    merged_data.update(run.items())
+                first_run.append_data(merged_data, coalesce_metadata)
+            coalesced_runs.append(first_run)
 
-        return list(coalesced_runs.values())
+        return coalesced_runs
 
     @staticmethod
     def combine_raw_datasets(user, messages_datasets, surveys_datasets):
@@ -23,7 +31,18 @@ class CombineRawDatasets(object):
         for messages_dataset in messages_datasets:
             data.extend(messages_dataset)
 
+        # Index the responses to all the surveys by avf_phone_id, merging each respondent's responses in survey order
+        # so that later surveys take precedence, as they would if each survey were appended in turn.
+        survey_responses_lut = dict()  # of avf_phone_id -> dict of survey key -> value
         for surveys_dataset in surveys_datasets:
-            TracedData.update_iterable(user, "avf_phone_id", data, surveys_dataset, "survey_responses")
+            for survey_td in surveys_dataset:
+                survey_responses_lut.setdefault(survey_td["avf_phone_id"], dict()).update(survey_td.items())
+
+        # Attach all of each message's survey responses in a single append, rather than one per survey.
+        survey_responses_metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        for td in data:
+            survey_responses = survey_responses_lut.get(td["avf_phone_id"])
+            if survey_responses is not None:
+                td.append_data(dict(survey_responses), survey_responses_metadata)
 
         return data
@@ -1,5 +1,14 @@
+from .blob_download_manager import BlobDownloadManager, GCloudBlobStore, LocalDirectoryBlobStore
+from .cached_uuid_table import CachedUuidTable
+from .coda_file_cache import CodaFileCache
 from .code_schemes import CodeSchemes
+from .coding_error_detector import CodingErrorDetector
 from .consent_utils import ConsentUtils
 from .icr_tools import ICRTools
-from .message_filters import MessageFilters
+from .message_filters import MessageFilterChain, MessageFilters
+from .message_ids import MessageIds
 from .pipeline_configuration import PipelineConfiguration
+from .raw_run_store import RawRunStore
+from .stage_checkpoints import StageCheckpoints
+from .timestamp_parser import TimestampParser
+from .timestamp_remapping_index import TimestampRemappingIndex
@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from google.cloud import storage
+from storage.google_cloud import google_cloud_utils
+
+log = Logger(__name__)
+
+
+class GCloudBlobStore(object):
+    """
+    Reads blobs from Google Cloud Storage, given their gs:// URLs.
+    """
+    def __init__(self, google_cloud_credentials_file_path):
+        """
+        :param google_cloud_credentials_file_path: Path to a Google Cloud service account credentials file.
+        :type google_cloud_credentials_file_path: str
+        """
+        self.google_cloud_credentials_file_path = google_cloud_credentials_file_path
+
+    def get_blob_versions(self, blob_urls):
+        """
+        Gets the versions of the given blobs, listing each bucket once rather than reading the metadata of each blob
+        separately.
+
+        :param blob_urls: gs:// URLs of the blobs to get the versions of.
+        :type blob_urls: iterable of str
+        :return: Dictionary of blob URL -> the generation number of that blob, which changes every time the blob is
+                 overwritten.
+        :rtype: dict of str -> str
+        """
+        blob_names_by_bucket = dict()  # of bucket name -> set of blob names
+        for blob_url in blob_urls:
+            parsed_blob_url = urlparse(blob_url)
+            assert parsed_blob_url.scheme == "gs", f"Blob URL '{blob_url}' is not a gs URL"
+            blob_names_by_bucket.setdefault(parsed_blob_url.netloc, set()).add(parsed_blob_url.path.lstrip("/"))
+
+        storage_client = storage.Client.from_service_account_json(self.google_cloud_credentials_file_path)
+        blob_versions = dict()
+        for bucket_name, blob_names in blob_names_by_bucket.items():
+            # List only the blobs under the longest prefix shared by all the wanted blobs in this bucket.
+            prefix = os.path.commonprefix(list(blob_names))
+            for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+                if blob.name in blob_names:
+                    blob_versions[f"gs://{bucket_name}/{blob.name}"] = str(blob.generation)
+
+            for blob_name in blob_names:
+                assert f"gs://{bucket_name}/{blob_name}" in blob_versions, \
+                    f"Blob 'gs://{bucket_name}/{blob_name}' does not exist"
+
+        return blob_versions
+
+    def download_blob_to_file(self, blob_url, f):
+        """
+        :param blob_url: gs:// URL of the blob to download.
+        :type blob_url: str
+        :param f: Binary file to write the blob to.
+        :type f: file-like
+        """
+        google_cloud_utils.download_blob_to_file(self.google_cloud_credentials_file_path, blob_url, f)
+
+
+class LocalDirectoryBlobStore(object):
+    """
+    Stands in for Google Cloud Storage by reading the blob for each gs://<bucket>/<path> URL from
+    <root_dir>/<bucket>/<path>. Intended for testing.
+    """
+    def __init__(self, root_dir):
+        """
+        :param root_dir: Directory containing one sub-directory for each bucket.
+        :type root_dir: str
+        """
+        self.root_dir = root_dir
+
+    def _path(self, blob_url):
+        parsed_blob_url = urlparse(blob_url)
+        return os.path.join(self.root_dir, parsed_blob_url.netloc, parsed_blob_url.path.lstrip("/"))
+
+    def _get_blob_version(self, blob_url):
+        stat = os.stat(self._path(blob_url))
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def get_blob_versions(self, blob_urls):
+        return {blob_url: self._get_blob_version(blob_url) for blob_url in blob_urls}
+
+    def download_blob_to_file(self, blob_url, f):
+        with open(self._path(blob_url), "rb") as blob_file:
+            shutil.copyfileobj(blob_file, f)
+
+
+class BlobDownloadManager(object):
+    """
+    Downloads blobs to a local directory concurrently, skipping blobs which are unchanged since they were last
+    downloaded.
+
+    Each blob is downloaded to a temporary file which is only renamed into place once the download is complete, and
+    the version of each downloaded blob is recorded in a manifest in the download directory. A blob is only
+    re-downloaded if its version has changed since the last download, or if its local file is missing.
+    """
+    MANIFEST_FILE_NAME = "download_manifest.json"
+
+    def __init__(self, blob_store, download_dir, max_concurrent_downloads=1):
+        """
+        :param blob_store: Store to download the blobs from.
+        :type blob_store: GCloudBlobStore | LocalDirectoryBlobStore
+        :param download_dir: Directory to download the blobs to.
+        :type download_dir: str
+        :param max_concurrent_downloads: Maximum number of blobs to download at the same time.
+        :type max_concurrent_downloads: int
+        """
+        self.blob_store = blob_store
+        self.download_dir = download_dir
+        self.max_concurrent_downloads = max_concurrent_downloads
+
+        self._manifest_path = os.path.join(download_dir, self.MANIFEST_FILE_NAME)
+        self._manifest_lock = threading.Lock()
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def _write_manifest(self, manifest):
+        IOUtils.ensure_dirs_exist_for_file(self._manifest_path)
+        with open(f"{self._manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(f"{self._manifest_path}.tmp", self._manifest_path)
+
+    def _download_blob(self, manifest, blob_url, blob_version, file_name):
+        output_path = os.path.join(self.download_dir, file_name)
+
+        manifest_entry = manifest.get(blob_url)
+        if os.path.exists(output_path) and manifest_entry is not None and \
+                manifest_entry["FileName"] == file_name and manifest_entry["Version"] == blob_version:
+            log.info(f"File '{output_path}' is up to date with blob '{blob_url}' (version {blob_version}); "
+                     f"skipping download")
+            return False
+
+        log.info(f"Downloading blob '{blob_url}' (version {blob_version}) to '{output_path}'...")
+        IOUtils.ensure_dirs_exist_for_file(output_path)
+        with open(f"{output_path}.tmp", "wb") as f:
+            self.blob_store.download_blob_to_file(blob_url, f)
+        os.replace(f"{output_path}.tmp", output_path)
+
+        # Record each download as soon as it completes, so that progress survives a crash part way through.
+        with self._manifest_lock:
+            manifest[blob_url] = {"FileName": file_name, "Version": blob_version}
+            self._write_manifest(manifest)
+        log.info(f"Downloaded blob '{blob_url}' to '{output_path}'")
+        return True
+
+    def download_blobs(self, blob_urls_to_file_names):
+        """
+        Downloads each of the given blobs to the download directory, unless the local copy is already up to date.
+
+        :param blob_urls_to_file_names: Dictionary of blob URL -> name of the file in the download directory to
+                                        download that blob to.
+        :type blob_urls_to_file_names: dict of str -> str
+        :return: URLs of the blobs which were downloaded, i.e. those which were new or had changed.
+        :rtype: set of str
+        """
+        manifest = self._load_manifest()
+        blob_urls = list(blob_urls_to_file_names.keys())
+        blob_versions = self.blob_store.get_blob_versions(blob_urls)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads) as executor:
+            downloaded = list(executor.map(
+                lambda blob_url: self._download_blob(manifest, blob_url, blob_versions[blob_url],
+                                                     blob_urls_to_file_names[blob_url]),
+                blob_urls
+            ))
+
+        downloaded_blob_urls = {blob_url for blob_url, was_downloaded in zip(blob_urls, downloaded) if was_downloaded}
+        log.info(f"Downloaded {len(downloaded_blob_urls)}/{len(blob_urls)} blobs; the rest were up to date")
+        return downloaded_blob_urls
@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import hmac
+import sqlite3
+import threading
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from cryptography.fernet import Fernet
+
+log = Logger(__name__)
+
+
+class CachedUuidTable(object):
+    """
+    Local, encrypted-at-rest cache in front of a data <-> uuid table such as a FirestoreUuidTable.
+
+    Known uuid <-> data pairs are served from an SQLite database, and only the misses are sent to the remote table in
+    a single batch. The data (e.g. phone numbers) is stored encrypted with Fernet, and is indexed by an HMAC of the data
+    so that data -> uuid lookups do not need to decrypt the cache.
+    """
+    # SQLite limits the number of parameters in a query to 999.
+    _QUERY_BATCH_SIZE = 500
+
+    def __init__(self, uuid_table, cache_path, encryption_key):
+        """
+        :param uuid_table: Remote table to look up cache misses in.
+        :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+        :param cache_path: Path to the SQLite database to use as the cache. Created if it does not exist.
+        :type cache_path: str
+        :param encryption_key: URL-safe base64-encoded 32-byte Fernet key to encrypt the cached data with.
+        :type encryption_key: str
+        """
+        self._uuid_table = uuid_table
+        self._fernet = Fernet(encryption_key)
+        self._hmac_key = hmac.new(base64.urlsafe_b64decode(encryption_key), b"data-lookup", hashlib.sha256).digest()
+
+        self.hits = 0
+        self.misses = 0
+
+        # The connection is shared between the threads exporting flows, so serialise all access to it.
+        self._lock = threading.Lock()
+        IOUtils.ensure_dirs_exist_for_file(cache_path)
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS uuid_data ("
+                "uuid TEXT PRIMARY KEY, data_hmac TEXT NOT NULL UNIQUE, encrypted_data BLOB NOT NULL)"
+            )
+
+    def _hmac(self, data):
+        return hmac.new(self._hmac_key, data.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _select(self, column, values):
+        values = list(values)
+        rows = []
+        with self._lock:
+            for i in range(0, len(values), self._QUERY_BATCH_SIZE):
+                batch = values[i:i + self._QUERY_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                rows.extend(self._connection.execute(
+                    f"SELECT uuid, data_hmac, encrypted_data FROM uuid_data WHERE {column} IN ({placeholders})", batch
+                ))
+        return rows
+
+    def _insert(self, uuid_to_data):
+        rows = [(uuid, self._hmac(data), self._fernet.encrypt(data.encode("utf-8")))
+                for uuid, data in uuid_to_data.items()]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO uuid_data VALUES (?, ?, ?)", rows)
+
+    def _record_lookups(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        log.info(f"UUID cache: {hits} hits, {misses} misses")
+
+    def log_stats(self):
+        log.info(f"UUID cache: {self.hits} hits, {self.misses} misses in total")
+
+    def uuid_to_data_batch(self, uuids):
+        """
+        :param uuids: Uuids to look up the data of.
+        :type uuids: iterable of str
+        :return: Dictionary of uuid -> data.
+        :rtype: dict of str -> str
+        """
+        uuids = set(uuids)
+        uuid_to_data = {uuid: self._fernet.decrypt(encrypted_data).decode("utf-8")
+                        for uuid, _, encrypted_data in self._select("uuid", uuids)}
+
+        missed_uuids = uuids - uuid_to_data.keys()
+        self._record_lookups(len(uuid_to_data), len(missed_uuids))
+        if len(missed_uuids) > 0:
+            fetched = self._uuid_table.uuid_to_data_batch(list(missed_uuids))
+            self._insert(fetched)
+            uuid_to_data.update(fetched)
+
+        return uuid_to_data
+
+    def data_to_uuid_batch(self, data):
+        """
+        :param data: Data to look up the uuids of. Data which is not yet in the remote table is assigned a new uuid.
+        :type data: iterable of str
+        :return: Dictionary of data -> uuid.
+        :rtype: dict of str -> str
+        """
+        hmac_to_data = {self._hmac(d): d for d in set(data)}
+        data_to_uuid = {hmac_to_data[data_hmac]: uuid
+                        for uuid, data_hmac, _ in self._select("data_hmac", hmac_to_data.keys())}
+
+        missed_data = set(hmac_to_data.values()) - data_to_uuid.keys()
+        self._record_lookups(len(data_to_uuid), len(missed_data))
+        if len(missed_data) > 0:
+            fetched = self._uuid_table.data_to_uuid_batch(list(missed_data))
+            self._insert({uuid: d for d, uuid in fetched.items()})
+            data_to_uuid.update(fetched)
+
+        return data_to_uuid
@@ -0,0 +1,54 @@
+import os
+from io import StringIO
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class CodaFileCache(object):
+    """
+    Process-wide cache of the contents of Coda files, so that stages which import the same Coda file (e.g. WS
+    correction and manual code application) only read it from disk once per run.
+
+    Entries are keyed by path, modification time and size, so a file which changes during the run is re-read.
+    """
+    _cache = dict()  # of absolute path -> (mtime_ns, size, contents)
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def open(cls, coda_file_path):
+        """
+        Opens a Coda file through this cache.
+
+        :param coda_file_path: Path to the Coda file to open.
+        :type coda_file_path: str
+        :return: A new text file-like object over the file's contents, or None if the file does not exist.
+        :rtype: io.StringIO | None
+        """
+        coda_file_path = os.path.abspath(coda_file_path)
+        try:
+            stat = os.stat(coda_file_path)
+        except FileNotFoundError:
+            cls._cache.pop(coda_file_path, None)
+            return None
+
+        cached = cls._cache.get(coda_file_path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            cls.hits += 1
+            return StringIO(cached[2])
+
+        cls.misses += 1
+        with open(coda_file_path, "r") as f:
+            contents = f.read()
+        cls._cache[coda_file_path] = (stat.st_mtime_ns, stat.st_size, contents)
+        return StringIO(contents)
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
+
+    @classmethod
+    def log_stats(cls):
+        log.info(f"Coda file cache: {cls.misses} files read from disk, {cls.hits} reads saved by the cache")
@@ -0,0 +1,82 @@
+from core_data_modules.cleaners import Codes
+
+from src.lib.code_schemes import CodeSchemes
+from src.lib.pipeline_configuration import CodingModes
+
+
+class CodingErrorDetector(object):
+    """
+    Finds the coding plans whose labels disagree about whether a message is in the wrong scheme, i.e. where a
+    message has a WS code in one of the plan's code schemes but not in the 'WS - Correct Dataset' scheme, or vice versa.
+
+    The code ids of each scheme are mapped to whether they indicate a wrong scheme message once, up front, and each
+    plan is checked across all the data at once from columns of the relevant labels.
+    """
+    def __init__(self, coding_plans, coded_field_suffix="", correct_dataset_field_suffix="_correct_dataset"):
+        """
+        :param coding_plans: Coding plans to check for coding errors.
+        :type coding_plans: list of src.lib.pipeline_configuration.CodingPlan
+        :param coded_field_suffix: Suffix of the keys of the coded fields to check, e.g. "_WS" for the '_WS' fields
+                                   imported by WS correction.
+        :type coded_field_suffix: str
+        :param correct_dataset_field_suffix: Suffix to add to each plan's raw field to get the key of its
+                                             'WS - Correct Dataset' field.
+        :type correct_dataset_field_suffix: str
+        """
+        self.coding_plans = coding_plans
+        self.coded_field_suffix = coded_field_suffix
+        self.correct_dataset_field_suffix = correct_dataset_field_suffix
+
+        # Code id -> whether a message with that code is in the wrong scheme, for the 'WS - Correct Dataset' scheme,
+        # where a Normal or NC code means the message belongs in another dataset.
+        self._correct_dataset_is_ws = {
+            code.code_id: code.code_type == "Normal" or code.control_code == Codes.NOT_CODED
+            for code in CodeSchemes.WS_CORRECT_DATASET.codes
+        }
+
+        # (coded field, coding mode, code id -> whether that code is the WS code) for each coding configuration of
+        # each plan.
+        self._coded_fields = []
+        for plan in coding_plans:
+            self._coded_fields.append([
+                (f"{cc.coded_field}{coded_field_suffix}", cc.coding_mode,
+                 {code.code_id: code.control_code == Codes.WRONG_SCHEME for code in cc.code_scheme.codes})
+                for cc in plan.coding_configurations
+            ])
+
+    def _has_ws_code_in_code_schemes(self, td, coded_fields):
+        for coded_field, coding_mode, code_is_ws in coded_fields:
+            if coding_mode == CodingModes.SINGLE:
+                if coded_field in td and code_is_ws[td[coded_field]["CodeID"]]:
+                    return True
+            else:
+                assert coding_mode == CodingModes.MULTIPLE
+                for label in td.get(coded_field, []):
+                    if code_is_ws[label["CodeID"]]:
+                        return True
+        return False
+
+    def detect(self, data):
+        """
+        :param data: TracedData objects to check for coding errors.
+        :type data: list of TracedData
+        :return: For each TracedData, in the same order as `data`, the coding plans which have a coding error.
+        :rtype: list of list of src.lib.pipeline_configuration.CodingPlan
+        """
+        plans_with_errors = [[] for _ in data]
+
+        for plan, coded_fields in zip(self.coding_plans, self._coded_fields):
+            correct_dataset_field = f"{plan.raw_field}{self.correct_dataset_field_suffix}"
+
+            code_scheme_column = [self._has_ws_code_in_code_schemes(td, coded_fields) for td in data]
+            correct_dataset_column = [
+                correct_dataset_field in td and self._correct_dataset_is_ws[td[correct_dataset_field]["CodeID"]]
+                for td in data
+            ]
+
+            for i, (has_ws_code_in_code_scheme, has_ws_code_in_ws_scheme) in \
+                    enumerate(zip(code_scheme_column, correct_dataset_column)):
+                if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
+                    plans_with_errors[i].append(plan)
+
+        return plans_with_errors
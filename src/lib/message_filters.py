@@ -1,11 +1,67 @@
 from core_data_modules.logging import Logger
-from dateutil.parser import isoparse
+
+from src.lib.timestamp_parser import TimestampParser
 
 log = Logger(__name__)
 
 
 # TODO: Move to Core once adapted for and tested on a pipeline that supports multiple radio shows
 class MessageFilters(object):
+    @staticmethod
+    def is_not_test_message(test_run_key="test_run"):
+        """
+        :param test_run_key: Key in each TracedData of the test message tag.
+        :type test_run_key: str
+        :return: Predicate which returns False for TracedData objects td where td.get(test_run_key) == True.
+        :rtype: function of TracedData -> bool
+        """
+        return lambda td: not td.get(test_run_key, False)
+
+    @staticmethod
+    def is_not_empty_message(message_keys):
+        """
+        :param message_keys: Keys in each TracedData to search for a message.
+        :type message_keys: iterable of str
+        :return: Predicate which returns True for TracedData which contain at least one of the message_keys.
+        :rtype: function of TracedData -> bool
+        """
+        message_keys = frozenset(message_keys)
+        return lambda td: any(message_key in td for message_key in message_keys)
+
+    @staticmethod
+    def is_in_time_range(time_keys, start_time_inclusive, end_time_exclusive):
+        """
+        :param time_keys: Keys in each TracedData object that contain the time the message was sent.
+                          Each TracedData must have exactly one match for each key.
+                          The values must be strings in ISO 8601 format.
+        :type time_keys: set of str
+        :param start_time_inclusive: Inclusive start time of the time range to keep.
+        :type start_time_inclusive: datetime.datetime
+        :param end_time_exclusive: Exclusive end time of the time range to keep.
+        :type end_time_exclusive: datetime.datetime
+        :return: Predicate which returns True for TracedData sent within the time range, and fails an assertion for
+                 TracedData which don't have exactly one of the time_keys.
+        :rtype: function of TracedData -> bool
+        """
+        def predicate(td):
+            matching_time_keys = [time_key for time_key in time_keys if time_key in td]
+            assert len(matching_time_keys) == 1, len(matching_time_keys)
+            return start_time_inclusive <= TimestampParser.isoparse(td[matching_time_keys[0]]) < end_time_exclusive
+
+        return predicate
+
+    @staticmethod
+    def is_not_noise(message_key, noise_fn):
+        """
+        :param message_key: Key in the TracedData of the value to test for noise.
+        :type message_key: str
+        :param noise_fn: Function which, given a value, returns whether this message is noise.
+        :type noise_fn: function of str -> bool
+        :return: Predicate which returns True for TracedData which aren't noise.
+        :rtype: function of TracedData -> bool
+        """
+        return lambda td: not noise_fn(td.get(message_key))
+
     @staticmethod
     def filter_operator(messages, operator_key, operator_code):
         log.debug(f"Filtering for messages with operator code {operator_code.display_text}")
@@ -28,13 +84,27 @@ class MessageFilters(object):
         :rtype: list of TracedData
         """
         log.debug("Filtering out test messages...")
-        filtered = [td for td in messages if not td.get(test_run_key, False)]
+        filtered = list(filter(MessageFilters.is_not_test_message(test_run_key), messages))
         log.info(f"Filtered out test messages. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
 
     @staticmethod
-    def filter_empty_messages(messages, message_keys):
+    def iter_non_empty_messages(messages, message_keys):
+        """
+        Lazily filters messages for objects which contain an answer in at least one of the given message_keys.
+
+        :param messages: Message objects to filter.
+        :type messages: iterable of TracedData
+        :param message_keys: Keys in each TracedData to search for a message.
+        :type message_keys: iterable of str
+        :return: Iterator over the messages which contain at least one of the message_keys, each emitted once.
+        :rtype: iterator of TracedData
+        """
+        return filter(MessageFilters.is_not_empty_message(message_keys), messages)
+
+    @classmethod
+    def filter_empty_messages(cls, messages, message_keys):
         """
         Filters a list of messages for objects which contain an answer in at least one of the given message_keys.
         
@@ -46,12 +116,7 @@ class MessageFilters(object):
         :rtype: list of TracedData 
         """
         log.debug("Filtering out empty message objects...")
-        filtered = []
-        for td in messages:
-            for message_key in message_keys:
-                if message_key in td:
-                    filtered.append(td)
-                    continue
+        filtered = list(cls.iter_non_empty_messages(messages, message_keys))
         log.info(f"Filtered out empty message objects. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
@@ -84,21 +149,9 @@ class MessageFilters(object):
                   f"{start_time_inclusive.isoformat()} to {end_time_inclusive.isoformat()} "
                   f"for time keys {time_keys}...")
 
-        # Validate the input data
-        for td in messages:
-            matching_time_keys = 0
-            for time_key in time_keys:
-                if time_key in td:
-                    matching_time_keys += 1
-            assert matching_time_keys == 1, matching_time_keys
-
-        # Perform the actual filtering
-        filtered = []
-        for td in messages:
-            for time_key in time_keys:
-                if time_key in td and start_time_inclusive <= isoparse(td[time_key]) < end_time_inclusive:
-                    filtered.append(td)
-                    break
+        # Validate and filter the input data in a single pass
+        filtered = list(filter(MessageFilters.is_in_time_range(time_keys, start_time_inclusive, end_time_inclusive),
+                               messages))
 
         log.info(f"Filtered out messages sent outside the time range "
                  f"{start_time_inclusive.isoformat()} to {end_time_inclusive.isoformat()}. "
@@ -121,7 +174,82 @@ class MessageFilters(object):
         :rtype: list of TracedData
         """
         log.debug("Filtering out messages identified as noise...")
-        filtered = [td for td in messages if not noise_fn(td.get(message_key))]
+        filtered = list(filter(MessageFilters.is_not_noise(message_key, noise_fn), messages))
         log.info(f"Filtered out messages identified as noise. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
+
+
+class MessageFilterChain(object):
+    """
+    Lazily applies a chain of filters to messages in a single pass.
+
+    Each message is tested against the filters in the order they were added, stopping at the first filter which drops
+    it, so no intermediate lists are built. The number of messages each filter dropped is counted while iterating,
+    and can be logged once a consumer has finished iterating.
+
+    Usage:
+    >>> chain = (MessageFilterChain(messages)
+    ...          .add_filter("test messages", MessageFilters.is_not_test_message())
+    ...          .add_filter("empty messages", MessageFilters.is_not_empty_message(message_keys)))
+    >>> filtered = chain.to_list()
+    """
+    def __init__(self, messages):
+        """
+        :param messages: Messages to filter.
+        :type messages: iterable of TracedData
+        """
+        self.messages = messages
+        self.filters = []  # of (name, predicate)
+
+        self.input_count = 0
+        self.output_count = 0
+        self.dropped_counts = []
+
+    def add_filter(self, name, predicate):
+        """
+        Adds a filter to the end of this chain.
+
+        :param name: Name of the filter, for logging.
+        :type name: str
+        :param predicate: Function which returns True for messages which should be kept.
+        :type predicate: function of TracedData -> bool
+        :return: This chain, so that calls can be chained.
+        :rtype: MessageFilterChain
+        """
+        self.filters.append((name, predicate))
+        return self
+
+    def __iter__(self):
+        self.input_count = 0
+        self.output_count = 0
+        self.dropped_counts = [0] * len(self.filters)
+
+        for td in self.messages:
+            self.input_count += 1
+            for i, (_, predicate) in enumerate(self.filters):
+                if not predicate(td):
+                    self.dropped_counts[i] += 1
+                    break
+            else:
+                self.output_count += 1
+                yield td
+
+    def log_stats(self):
+        """
+        Logs the number of messages dropped by each filter during the last iteration over this chain.
+        """
+        for (name, _), dropped_count in zip(self.filters, self.dropped_counts):
+            log.info(f"Filtered out {dropped_count} messages: {name}")
+        log.info(f"Returning {self.output_count}/{self.input_count} messages.")
+
+    def to_list(self):
+        """
+        Applies this chain to all of the messages, and logs the number of messages dropped by each filter.
+
+        :return: The messages which passed every filter.
+        :rtype: list of TracedData
+        """
+        filtered = list(self)
+        self.log_stats()
+        return filtered
@@ -0,0 +1,64 @@
+import time
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data import Metadata
+from core_data_modules.util import SHAUtils
+
+log = Logger(__name__)
+
+
+class MessageIds(object):
+    """
+    Computes Coda message ids, hashing each distinct message text at most once per run however many fields and
+    stages it is needed for.
+    """
+    _message_ids = dict()  # of message text -> message id
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get_message_id(cls, text):
+        """
+        :param text: Message text to get the id of.
+        :type text: str
+        :return: The id TracedDataCodaV2IO.compute_message_ids assigns to this text.
+        :rtype: str
+        """
+        message_id = cls._message_ids.get(text)
+        if message_id is not None:
+            cls.hits += 1
+            return message_id
+
+        # Hash the text in the same way as TracedDataCodaV2IO.compute_message_ids, so that the ids match the ids of
+        # messages in Coda files exported by other tools.
+        cls.misses += 1
+        message_id = SHAUtils.sha_string(text)
+        cls._message_ids[text] = message_id
+        return message_id
+
+    @classmethod
+    def compute_message_ids(cls, user, data, message_id_fields):
+        """
+        Sets the message id fields of each TracedData in a single pass, with one append per TracedData.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to set the message ids of.
+        :type data: iterable of TracedData
+        :param message_id_fields: (message key, message id key to write) for each message id to compute.
+                                  Message ids are only set for TracedData which contain the message key.
+        :type message_id_fields: list of (str, str)
+        """
+        metadata = Metadata(user, Metadata.get_call_location(), time.time())
+        for td in data:
+            message_ids = dict()
+            for message_key, message_id_key in message_id_fields:
+                if message_key in td:
+                    message_ids[message_id_key] = cls.get_message_id(td[message_key])
+
+            if len(message_ids) > 0:
+                td.append_data(message_ids, metadata)
+
+    @classmethod
+    def log_stats(cls):
+        log.info(f"Message ids: {cls.misses} distinct texts hashed, {cls.hits} hashes saved by the cache")
@@ -6,10 +6,14 @@ from urllib.parse import urlparse
 import pytz
 from core_data_modules.cleaners import Codes, swahili, somali
 from core_data_modules.data_models import validators
+from core_data_modules.logging import Logger
 from core_data_modules.traced_data.util.fold_traced_data import FoldStrategies
 from dateutil.parser import isoparse
 
 from src.lib import CodeSchemes, code_imputation_functions
+from src.lib.timestamp_remapping_index import TimestampRemappingIndex
+
+log = Logger(__name__)
 
 
 class CodingModes(object):
@@ -384,6 +388,21 @@ class PipelineConfiguration(object):
         assert isinstance(self.phone_number_uuid_table, PhoneNumberUuidTable)
         self.phone_number_uuid_table.validate()
 
+        validators.validate_list(self.timestamp_remappings, "timestamp_remappings")
+        remappings_by_time_key = dict()
+        for i, remapping in enumerate(self.timestamp_remappings):
+            assert isinstance(remapping, TimestampRemapping), \
+                f"timestamp_remappings[{i}] is not of type TimestampRemapping"
+            remapping.validate()
+            remappings_by_time_key.setdefault(remapping.time_key, []).append((i, remapping))
+
+        # Overlapping remappings are allowed, with later remappings taking precedence, but are easy to create by
+        # mistake when rescheduling shows, so warn about them.
+        for time_key, remappings in remappings_by_time_key.items():
+            for i, j in sorted(TimestampRemappingIndex(remappings).get_overlapping_remappings()):
+                log.warning(f"timestamp_remappings[{i}] and timestamp_remappings[{j}] have overlapping time ranges "
+                            f"for time key '{time_key}'; timestamp_remappings[{j}] takes precedence")
+
         validators.validate_list(self.rapid_pro_key_remappings, "rapid_pro_key_remappings")
         for i, remapping in enumerate(self.rapid_pro_key_remappings):
             assert isinstance(remapping, RapidProKeyRemapping), \
@@ -421,7 +440,7 @@ class RawDataSource(ABC):
 
 class RapidProSource(RawDataSource):
     def __init__(self, domain, token_file_url, contacts_file_name, activation_flow_names, survey_flow_names,
-                 test_contact_uuids):
+                 test_contact_uuids, max_concurrent_flow_exports=1):
         """
         :param domain: URL of the Rapid Pro server to download data from.
         :type domain: str
@@ -437,6 +456,8 @@ class RapidProSource(RawDataSource):
                                    Runs for any of those test contacts will be tagged with {'test_run': True},
                                    and dropped when the pipeline is run with "FilterTestMessages" set to true.
         :type test_contact_uuids: list of str
+        :param max_concurrent_flow_exports: Maximum number of flows to fetch, convert and write at the same time.
+        :type max_concurrent_flow_exports: int
         """
         self.domain = domain
         self.token_file_url = token_file_url
@@ -444,6 +465,7 @@ class RapidProSource(RawDataSource):
         self.activation_flow_names = activation_flow_names
         self.survey_flow_names = survey_flow_names
         self.test_contact_uuids = test_contact_uuids
+        self.max_concurrent_flow_exports = max_concurrent_flow_exports
 
         self.validate()
 
@@ -461,9 +483,10 @@ class RapidProSource(RawDataSource):
         activation_flow_names = configuration_dict.get("ActivationFlowNames", [])
         survey_flow_names = configuration_dict.get("SurveyFlowNames", [])
         test_contact_uuids = configuration_dict.get("TestContactUUIDs", [])
+        max_concurrent_flow_exports = configuration_dict.get("MaxConcurrentFlowExports", 1)
 
         return cls(domain, token_file_url, contacts_file_name, activation_flow_names,
-                   survey_flow_names, test_contact_uuids)
+                   survey_flow_names, test_contact_uuids, max_concurrent_flow_exports)
 
     def validate(self):
         validators.validate_string(self.domain, "domain")
@@ -482,11 +505,23 @@ class RapidProSource(RawDataSource):
         for i, contact_uuid in enumerate(self.test_contact_uuids):
             validators.validate_string(contact_uuid, f"test_contact_uuids[{i}]")
 
+        validators.validate_int(self.max_concurrent_flow_exports, "max_concurrent_flow_exports")
+        assert self.max_concurrent_flow_exports >= 1, "max_concurrent_flow_exports must be at least 1"
+
 
 class AbstractRemoteURLSource(RawDataSource):
-    def __init__(self, activation_flow_urls, survey_flow_urls):
+    def __init__(self, activation_flow_urls, survey_flow_urls, max_concurrent_downloads=1):
+        """
+        :param activation_flow_urls: GS URLs of the files that contain the radio show responses.
+        :type activation_flow_urls: list of str
+        :param survey_flow_urls: GS URLs of the files that contain the survey responses.
+        :type survey_flow_urls: list of str
+        :param max_concurrent_downloads: Maximum number of files to download at the same time.
+        :type max_concurrent_downloads: int
+        """
         self.activation_flow_urls = activation_flow_urls
         self.survey_flow_urls = survey_flow_urls
+        self.max_concurrent_downloads = max_concurrent_downloads
 
         self.validate()
 
@@ -500,8 +535,9 @@ class AbstractRemoteURLSource(RawDataSource):
     def from_configuration_dict(cls, configuration_dict):
         activation_flow_urls = configuration_dict.get("ActivationFlowURLs", [])
         survey_flow_urls = configuration_dict.get("SurveyFlowURLs", [])
+        max_concurrent_downloads = configuration_dict.get("MaxConcurrentDownloads", 1)
 
-        return cls(activation_flow_urls, survey_flow_urls)
+        return cls(activation_flow_urls, survey_flow_urls, max_concurrent_downloads)
 
     def validate(self):
         validators.validate_list(self.activation_flow_urls, "activation_flow_urls")
@@ -512,28 +548,36 @@ class AbstractRemoteURLSource(RawDataSource):
         for i, survey_flow_url in enumerate(self.survey_flow_urls):
             validators.validate_url(survey_flow_url, f"survey_flow_urls[{i}]", "gs")
 
+        validators.validate_int(self.max_concurrent_downloads, "max_concurrent_downloads")
+        assert self.max_concurrent_downloads >= 1, "max_concurrent_downloads must be at least 1"
+
 
 class GCloudBucketSource(AbstractRemoteURLSource):
-    def __init__(self, activation_flow_urls, survey_flow_urls):
-        super().__init__(activation_flow_urls, survey_flow_urls)
+    def __init__(self, activation_flow_urls, survey_flow_urls, max_concurrent_downloads=1):
+        super().__init__(activation_flow_urls, survey_flow_urls, max_concurrent_downloads)
 
 
 class ShaqadoonCSVSource(AbstractRemoteURLSource):
-    def __init__(self, activation_flow_urls, survey_flow_urls):
-        super().__init__(activation_flow_urls, survey_flow_urls)
+    def __init__(self, activation_flow_urls, survey_flow_urls, max_concurrent_downloads=1):
+        super().__init__(activation_flow_urls, survey_flow_urls, max_concurrent_downloads)
 
 
 class PhoneNumberUuidTable(object):
-    def __init__(self, firebase_credentials_file_url, table_name):
+    def __init__(self, firebase_credentials_file_url, table_name, cache_encryption_key_file_url=None):
         """
         :param firebase_credentials_file_url: GS URL to the private credentials file for the Firebase account where
                                                  the phone number <-> uuid table is stored.
         :type firebase_credentials_file_url: str
         :param table_name: Name of the data <-> uuid table in Firebase to use.
         :type table_name: str
+        :param cache_encryption_key_file_url: GS URL to a text file containing the Fernet key to encrypt the local
+                                              phone number <-> uuid cache with.
+                                              If None, does not use a local cache.
+        :type cache_encryption_key_file_url: str | None
         """
         self.firebase_credentials_file_url = firebase_credentials_file_url
         self.table_name = table_name
+        self.cache_encryption_key_file_url = cache_encryption_key_file_url
 
         self.validate()
 
@@ -541,13 +585,17 @@ class PhoneNumberUuidTable(object):
     def from_configuration_dict(cls, configuration_dict):
         firebase_credentials_file_url = configuration_dict["FirebaseCredentialsFileURL"]
         table_name = configuration_dict["TableName"]
+        cache_encryption_key_file_url = configuration_dict.get("CacheEncryptionKeyFileURL")
 
-        return cls(firebase_credentials_file_url, table_name)
+        return cls(firebase_credentials_file_url, table_name, cache_encryption_key_file_url)
 
     def validate(self):
         validators.validate_url(self.firebase_credentials_file_url, "firebase_credentials_file_url", scheme="gs")
         validators.validate_string(self.table_name, "table_name")
 
+        if self.cache_encryption_key_file_url is not None:
+            validators.validate_url(self.cache_encryption_key_file_url, "cache_encryption_key_file_url", scheme="gs")
+
 
 class TimestampRemapping(object):
     def __init__(self, time_key, show_pipeline_key_to_remap_to, range_start_inclusive=None, range_end_exclusive=None,
@@ -0,0 +1,298 @@
+import json
+import os
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from dateutil.parser import isoparse
+from temba_client.v2 import Run
+
+log = Logger(__name__)
+
+
+class RawRunStore(object):
+    """
+    Append-only store of the raw Rapid Pro runs for one flow.
+
+    Runs are written to JSONL segment files, which are never modified once written. A manifest records, for each run,
+    the segment and byte offset holding its latest version along with the run's modified_on and contact uuid, so that
+    callers can decide which runs they need from the manifest alone and then deserialize only those runs.
+
+    The manifest is a snapshot, re-written only when the store is compacted, plus a log with one line for each segment
+    appended since that snapshot, so appending runs costs time proportional to the new runs rather than to the size
+    of the store. Segments are compacted once they contain more superseded runs than live ones, or once there are
+    more than MAX_SEGMENTS of them.
+    """
+    MANIFEST_FILE_NAME = "manifest.json"
+    MANIFEST_LOG_FILE_NAME = "manifest_log.jsonl"
+    MANIFEST_VERSION = 2
+    MAX_SEGMENTS = 32
+
+    def __init__(self, store_dir):
+        """
+        Opens the store in `store_dir`, reading only the manifest.
+
+        :param store_dir: Directory to store the manifest and segments in. Created on first write if it does not
+                          exist.
+        :type store_dir: str
+        """
+        self.store_dir = store_dir
+
+        try:
+            with open(self._path(self.MANIFEST_FILE_NAME)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {
+                "Version": self.MANIFEST_VERSION,
+                "Generation": 0,
+                "NextSegmentNumber": 0,
+                "Segments": [],
+                "Runs": {},
+                "LastModifiedOn": None
+            }
+
+        self._generation = manifest["Generation"]
+        self._next_segment_number = manifest["NextSegmentNumber"]
+        self._segments = manifest["Segments"]  # list of {"FileName": str, "RunCount": int}
+        # dict of run id -> {"Segment": str, "Offset": int, "ModifiedOn": str, "ContactUUID": str}, in the order the
+        # runs are stored in the segments.
+        self._runs = manifest["Runs"]
+        self._last_modified_on = None
+        if manifest["LastModifiedOn"] is not None:
+            self._last_modified_on = isoparse(manifest["LastModifiedOn"])
+
+        self._replay_manifest_log()
+
+    def __len__(self):
+        return len(self._runs)
+
+    @property
+    def last_modified_on(self):
+        """
+        :return: The most recent modified_on of any run in this store, or None if this store is empty.
+        :rtype: datetime.datetime | None
+        """
+        return self._last_modified_on
+
+    def _path(self, file_name):
+        return os.path.join(self.store_dir, file_name)
+
+    def _write_atomically(self, file_name, write_fn):
+        path = self._path(file_name)
+        IOUtils.ensure_dirs_exist_for_file(path)
+        with open(f"{path}.tmp", "w") as f:
+            write_fn(f)
+        os.replace(f"{path}.tmp", path)
+
+    def _replay_manifest_log(self):
+        """
+        Applies the segments recorded in the manifest log since the last snapshot to the manifest loaded from the
+        snapshot.
+
+        Lines written before the snapshot was last re-written are ignored. A line left incomplete by a crash while it
+        was being appended is truncated, so that the next append starts on a new line.
+        """
+        manifest_log_path = self._path(self.MANIFEST_LOG_FILE_NAME)
+        valid_size = 0
+        try:
+            with open(manifest_log_path, "rb") as f:
+                for line in f:
+                    try:
+                        delta = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_size += len(line)
+
+                    if delta["Generation"] != self._generation:
+                        continue
+                    self._apply_segment(delta["Segment"], delta["Runs"], isoparse(delta["LastModifiedOn"]))
+                    self._next_segment_number = delta["NextSegmentNumber"]
+        except FileNotFoundError:
+            return
+
+        if os.path.getsize(manifest_log_path) > valid_size:
+            log.warning(f"Truncating an incomplete entry from the end of the manifest log of raw run store "
+                        f"'{self.store_dir}'")
+            os.truncate(manifest_log_path, valid_size)
+
+    def _apply_segment(self, segment, run_entries, last_modified_on):
+        self._segments.append(segment)
+        for run_id, run_entry in run_entries.items():
+            # Re-insert each updated run, so that self._runs stays in the same order as the runs in the segments.
+            self._runs.pop(run_id, None)
+            self._runs[run_id] = run_entry
+
+        if self._last_modified_on is None or last_modified_on > self._last_modified_on:
+            self._last_modified_on = last_modified_on
+
+    def _write_manifest(self):
+        manifest = {
+            "Version": self.MANIFEST_VERSION,
+            "Generation": self._generation,
+            "NextSegmentNumber": self._next_segment_number,
+            "Segments": self._segments,
+            "Runs": self._runs,
+            "LastModifiedOn": None if self._last_modified_on is None else self._last_modified_on.isoformat()
+        }
+        self._write_atomically(self.MANIFEST_FILE_NAME, lambda f: json.dump(manifest, f))
+
+    def _write_segment(self, runs):
+        """
+        Writes runs to a new segment.
+
+        :param runs: Runs to write.
+        :type runs: list of temba_client.v2.Run
+        :return: The new segment, the manifest entries for the runs written to it, and the most recent modified_on of
+                 those runs.
+        :rtype: (dict, dict of str -> dict, datetime.datetime)
+        """
+        # Keep only the last version of each run in this batch, so that each run id appears at most once per segment.
+        runs_by_id = dict()
+        for run in runs:
+            runs_by_id.pop(run.id, None)
+            runs_by_id[run.id] = run
+        runs = list(runs_by_id.values())
+
+        segment_file_name = f"segment-{self._next_segment_number:06d}.jsonl"
+        self._next_segment_number += 1
+
+        run_entries = dict()
+
+        def write_runs(f):
+            offset = 0
+            for run in runs:
+                line = json.dumps(run.serialize()) + "\n"
+                f.write(line)
+                run_entries[str(run.id)] = {
+                    "Segment": segment_file_name,
+                    "Offset": offset,
+                    "ModifiedOn": run.modified_on.isoformat(),
+                    "ContactUUID": run.contact.uuid
+                }
+                offset += len(line.encode("utf-8"))
+        self._write_atomically(segment_file_name, write_runs)
+
+        last_modified_on = max(run.modified_on for run in runs)
+        return {"FileName": segment_file_name, "RunCount": len(runs)}, run_entries, last_modified_on
+
+    def append_runs(self, runs):
+        """
+        Appends new or modified runs to this store. Runs with the same id as a run already in the store replace the
+        stored version.
+
+        :param runs: Runs to append.
+        :type runs: list of temba_client.v2.Run
+        """
+        if len(runs) == 0:
+            return
+
+        segment, run_entries, last_modified_on = self._write_segment(runs)
+        with open(self._path(self.MANIFEST_LOG_FILE_NAME), "a") as f:
+            f.write(json.dumps({
+                "Generation": self._generation,
+                "NextSegmentNumber": self._next_segment_number,
+                "Segment": segment,
+                "Runs": run_entries,
+                "LastModifiedOn": last_modified_on.isoformat()
+            }))
+            f.write("\n")
+        self._apply_segment(segment, run_entries, last_modified_on)
+
+        if self._should_compact():
+            self.compact()
+
+    def iter_run_metadata(self):
+        """
+        Reads the metadata of the latest version of every run in this store from the manifest, without reading any
+        segments.
+
+        :return: Iterator over (run id, run modified_on as an ISO 8601 string, contact uuid) for every run in this
+                 store, in the same order as `iter_runs`.
+        :rtype: iterator of (int, str, str)
+        """
+        for run_id, run_entry in self._runs.items():
+            yield int(run_id), run_entry["ModifiedOn"], run_entry["ContactUUID"]
+
+    def read_runs(self, run_ids):
+        """
+        Reads the latest version of each of the given runs, deserializing only those runs.
+
+        :param run_ids: Ids of the runs to read. Each must be in this store.
+        :type run_ids: list of int
+        :return: The runs with the given ids, in the same order as `run_ids`.
+        :rtype: list of temba_client.v2.Run
+        """
+        offsets_by_segment = dict()  # of segment file name -> list of (offset, run id)
+        for run_id in run_ids:
+            run_entry = self._runs[str(run_id)]
+            if run_entry["Segment"] not in offsets_by_segment:
+                offsets_by_segment[run_entry["Segment"]] = []
+            offsets_by_segment[run_entry["Segment"]].append((run_entry["Offset"], run_id))
+
+        runs_by_id = dict()
+        for segment_file_name, offsets in offsets_by_segment.items():
+            with open(self._path(segment_file_name), "rb") as f:
+                for offset, run_id in sorted(offsets):
+                    f.seek(offset)
+                    runs_by_id[run_id] = Run.deserialize(json.loads(f.readline()))
+
+        return [runs_by_id[run_id] for run_id in run_ids]
+
+    def iter_runs(self):
+        """
+        Reads the latest version of every run in this store, oldest segment first.
+
+        :return: Iterator over the runs in this store.
+        :rtype: iterator of temba_client.v2.Run
+        """
+        for segment in self._segments:
+            with open(self._path(segment["FileName"])) as f:
+                for line in f:
+                    run_json = json.loads(line)
+                    if self._runs[str(run_json["id"])]["Segment"] == segment["FileName"]:
+                        yield Run.deserialize(run_json)
+
+    def _should_compact(self):
+        stored_run_count = sum(segment["RunCount"] for segment in self._segments)
+        superseded_run_count = stored_run_count - len(self._runs)
+        return superseded_run_count > len(self._runs) or len(self._segments) > self.MAX_SEGMENTS
+
+    def compact(self):
+        """
+        Re-writes all the live runs in this store to a single segment and the manifest to a new snapshot, and deletes
+        the old segments and the manifest log.
+        """
+        log.info(f"Compacting {len(self._segments)} segments in raw run store '{self.store_dir}'...")
+        old_segments = self._segments
+        runs = list(self.iter_runs())
+
+        self._generation += 1
+        self._segments = []
+        self._runs = dict()
+        self._last_modified_on = None
+        if len(runs) > 0:
+            self._apply_segment(*self._write_segment(runs))
+        # Writing the snapshot with the new generation is what commits the compaction: any lines left in the manifest
+        # log are from the previous generation, so are ignored if the steps below are interrupted.
+        self._write_manifest()
+
+        if os.path.exists(self._path(self.MANIFEST_LOG_FILE_NAME)):
+            os.remove(self._path(self.MANIFEST_LOG_FILE_NAME))
+        for segment in old_segments:
+            os.remove(self._path(segment["FileName"]))
+        log.info(f"Compacted raw run store '{self.store_dir}' to {len(runs)} runs")
+
+    def import_raw_runs_file(self, raw_runs_path):
+        """
+        Imports runs from a JSON file containing a list of serialized runs, as written by previous versions of
+        fetch_raw_data.py.
+
+        :param raw_runs_path: Path to the raw runs file to import.
+        :type raw_runs_path: str
+        """
+        log.info(f"Importing raw runs from file '{raw_runs_path}' into raw run store '{self.store_dir}'...")
+        with open(raw_runs_path) as raw_runs_file:
+            runs = [Run.deserialize(run_json) for run_json in json.load(raw_runs_file)]
+        self.append_runs(runs)
+        log.info(f"Imported {len(runs)} runs")
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import shutil
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class StageCheckpoints(object):
+    """
+    Persists the output of each stage of a pipeline run to a checkpoint directory, so that later runs can reload the
+    output of the last stage whose inputs have not changed instead of recomputing it.
+
+    Each checkpoint is identified by a hash of everything the stage's output depends on. Callers compute these hashes
+    with `hash_files` and `chain_hash`, so that a stage's hash covers the hashes of all the stages before it.
+
+    Files written by a stage as a side effect (e.g. Coda or CSV exports) are saved with the checkpoint and copied back
+    into place when it is loaded, so that resuming produces the same set of output files as a full run.
+    """
+    METADATA_FILE_NAME = "checkpoint.json"
+    DATA_FILE_NAME = "data.jsonl"
+    OUTPUTS_DIR_NAME = "outputs"
+
+    def __init__(self, checkpoint_dir):
+        """
+        :param checkpoint_dir: Directory to read and write checkpoints in.
+        :type checkpoint_dir: str
+        """
+        self.checkpoint_dir = checkpoint_dir
+
+    @staticmethod
+    def hash_files(paths):
+        """
+        Computes a hash of the names and contents of the given files and directories.
+        Paths which do not exist are hashed as missing, so that creating them changes the hash. Python bytecode caches
+        are ignored.
+
+        :param paths: Paths of the files and directories to hash.
+        :type paths: iterable of str
+        :return: Hex digest of the files' hash.
+        :rtype: str
+        """
+        file_hash = hashlib.sha256()
+
+        def update_with_file(path):
+            file_hash.update(path.encode("utf-8"))
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    file_hash.update(chunk)
+
+        for path in paths:
+            if os.path.isdir(path):
+                for dir_path, dir_names, file_names in os.walk(path):
+                    # Prune and sort in place so that os.walk visits the remaining directories in a stable order.
+                    dir_names[:] = sorted(d for d in dir_names if d != "__pycache__")
+                    for file_name in sorted(file_names):
+                        update_with_file(os.path.join(dir_path, file_name))
+            elif os.path.isfile(path):
+                update_with_file(path)
+            else:
+                file_hash.update(f"missing:{path}".encode("utf-8"))
+
+        return file_hash.hexdigest()
+
+    @staticmethod
+    def chain_hash(*hashes):
+        """
+        :param hashes: Hashes (or other strings) to combine.
+        :type hashes: str
+        :return: Hex digest of a hash of the given hashes, in order.
+        :rtype: str
+        """
+        return hashlib.sha256(json.dumps(hashes).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _copy_dir_contents(cls, source_dir, target_dir):
+        IOUtils.ensure_dirs_exist(target_dir)
+        for file_name in os.listdir(source_dir):
+            source_path = os.path.join(source_dir, file_name)
+            if os.path.isdir(source_path):
+                cls._copy_dir_contents(source_path, os.path.join(target_dir, file_name))
+            else:
+                shutil.copyfile(source_path, os.path.join(target_dir, file_name))
+
+    def _stage_dir(self, stage_name):
+        return os.path.join(self.checkpoint_dir, stage_name)
+
+    def get_checkpoint_hash(self, stage_name):
+        """
+        :param stage_name: Name of the stage to get the checkpoint hash of.
+        :type stage_name: str
+        :return: The hash of the inputs of the complete checkpoint for this stage, or None if there is no complete
+                 checkpoint for this stage.
+        :rtype: str | None
+        """
+        try:
+            with open(os.path.join(self._stage_dir(stage_name), self.METADATA_FILE_NAME)) as f:
+                return json.load(f)["InputsHash"]
+        except FileNotFoundError:
+            return None
+
+    def save(self, stage_name, inputs_hash, data, output_paths):
+        """
+        Saves a checkpoint of the output of a stage.
+
+        :param stage_name: Name of the stage to save a checkpoint for.
+        :type stage_name: str
+        :param inputs_hash: Hash of everything this stage's output depends on.
+        :type inputs_hash: str
+        :param data: TracedData output by this stage.
+        :type data: list of TracedData
+        :param output_paths: Paths of the files and directories written by this stage.
+        :type output_paths: list of str
+        """
+        log.info(f"Saving checkpoint for stage '{stage_name}'...")
+        stage_dir = self._stage_dir(stage_name)
+        metadata_path = os.path.join(stage_dir, self.METADATA_FILE_NAME)
+
+        # Remove the metadata file first, so that an interrupted save leaves no valid checkpoint behind.
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+
+        data_path = os.path.join(stage_dir, self.DATA_FILE_NAME)
+        IOUtils.ensure_dirs_exist_for_file(data_path)
+        with open(data_path, "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(data, f)
+
+        for i, output_path in enumerate(output_paths):
+            checkpoint_output_path = os.path.join(stage_dir, self.OUTPUTS_DIR_NAME, str(i))
+            if os.path.isdir(output_path):
+                self._copy_dir_contents(output_path, checkpoint_output_path)
+            else:
+                IOUtils.ensure_dirs_exist_for_file(checkpoint_output_path)
+                shutil.copyfile(output_path, checkpoint_output_path)
+
+        with open(metadata_path, "w") as f:
+            json.dump({"InputsHash": inputs_hash, "OutputPathsCount": len(output_paths)}, f)
+        log.info(f"Saved checkpoint for stage '{stage_name}' ({len(data)} TracedData)")
+
+    def restore_outputs(self, stage_name, output_paths):
+        """
+        Copies the files written by a stage back from its checkpoint to the given output paths.
+
+        :param stage_name: Name of the stage to restore the output files of.
+        :type stage_name: str
+        :param output_paths: Paths to restore the files and directories written by this stage to, in the same order
+                             as they were given to `save`.
+        :type output_paths: list of str
+        """
+        stage_dir = self._stage_dir(stage_name)
+        with open(os.path.join(stage_dir, self.METADATA_FILE_NAME)) as f:
+            metadata = json.load(f)
+        assert metadata["OutputPathsCount"] == len(output_paths), \
+            f"Checkpoint for stage '{stage_name}' has {metadata['OutputPathsCount']} output paths, " \
+            f"but {len(output_paths)} were requested"
+
+        for i, output_path in enumerate(output_paths):
+            checkpoint_output_path = os.path.join(stage_dir, self.OUTPUTS_DIR_NAME, str(i))
+            log.info(f"Restoring '{output_path}' from the checkpoint for stage '{stage_name}'...")
+            if os.path.isdir(checkpoint_output_path):
+                self._copy_dir_contents(checkpoint_output_path, output_path)
+            else:
+                IOUtils.ensure_dirs_exist_for_file(output_path)
+                shutil.copyfile(checkpoint_output_path, output_path)
+
+    def load(self, stage_name, output_paths):
+        """
+        Loads the checkpoint of a stage, copying the files written by that stage back to the given output paths.
+
+        :param stage_name: Name of the stage to load the checkpoint of.
+        :type stage_name: str
+        :param output_paths: Paths to restore the files and directories written by this stage to, in the same order
+                             as they were given to `save`.
+        :type output_paths: list of str
+        :return: TracedData output by this stage.
+        :rtype: list of TracedData
+        """
+        log.info(f"Loading checkpoint for stage '{stage_name}'...")
+        self.restore_outputs(stage_name, output_paths)
+
+        with open(os.path.join(self._stage_dir(stage_name), self.DATA_FILE_NAME)) as f:
+            data = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
+        log.info(f"Loaded checkpoint for stage '{stage_name}' ({len(data)} TracedData)")
+        return data
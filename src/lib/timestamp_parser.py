@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+
+log = Logger(__name__)
+
+
+class TimestampParser(object):
+    """
+    Parses ISO 8601 timestamps through a bounded memo shared by every stage of the pipeline, so that each distinct
+    timestamp string is only parsed once however many stages read it.
+    """
+    CACHE_SIZE = 2 ** 20
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def isoparse(timestamp):
+        """
+        :param timestamp: ISO 8601-formatted datetime string.
+        :type timestamp: str
+        :return: The parsed datetime. This may be shared with other callers, but datetimes are immutable.
+        :rtype: datetime.datetime
+        """
+        return isoparse(timestamp)
+
+    @classmethod
+    def log_stats(cls):
+        cache_info = cls.isoparse.cache_info()
+        log.info(f"Timestamp parser: {cache_info.misses} timestamps parsed, {cache_info.hits} parses saved by the "
+                 f"cache ({cache_info.currsize}/{cache_info.maxsize} cached)")
@@ -0,0 +1,60 @@
+from bisect import bisect_right
+
+
+class TimestampRemappingIndex(object):
+    """
+    Index of the time ranges of the timestamp remappings which read the same time key, for finding the remappings
+    which apply to a timestamp with a binary search rather than by testing every remapping.
+
+    The start and end of every remapping's range split the timeline into segments. Each segment is covered by the same
+    remappings at every point within it, so those remappings are precomputed for each segment.
+    """
+    def __init__(self, remappings):
+        """
+        :param remappings: (position, remapping) for each remapping to index, where position is the remapping's
+                           position in the configuration's list of timestamp remappings. All the remappings must
+                           have the same time key.
+        :type remappings: list of (int, src.lib.pipeline_configuration.TimestampRemapping)
+        """
+        assert len({remapping.time_key for _, remapping in remappings}) <= 1, \
+            "All the remappings in a TimestampRemappingIndex must have the same time key"
+        self.remappings = remappings
+
+        boundaries = set()
+        for _, remapping in remappings:
+            boundaries.add(remapping.range_start_inclusive)
+            boundaries.add(remapping.range_end_exclusive)
+        self._boundaries = sorted(boundaries)
+
+        # self._segment_positions[i] contains the positions of the remappings which cover the segment
+        # [self._boundaries[i], self._boundaries[i + 1]), in ascending order.
+        self._segment_positions = []
+        for segment_start in self._boundaries:
+            self._segment_positions.append([
+                position for position, remapping in remappings
+                if remapping.range_start_inclusive <= segment_start < remapping.range_end_exclusive
+            ])
+
+    def get_positions(self, timestamp):
+        """
+        :param timestamp: Timestamp to find the remappings for.
+        :type timestamp: datetime.datetime
+        :return: The positions of the remappings whose time ranges contain `timestamp`, in ascending order.
+        :rtype: list of int
+        """
+        segment_index = bisect_right(self._boundaries, timestamp) - 1
+        if segment_index < 0:
+            return []
+        return self._segment_positions[segment_index]
+
+    def get_overlapping_remappings(self):
+        """
+        :return: Pairs of the remappings in this index whose time ranges overlap, as (position, position) tuples.
+        :rtype: set of (int, int)
+        """
+        overlaps = set()
+        for positions in self._segment_positions:
+            for i, position in enumerate(positions):
+                for other_position in positions[i + 1:]:
+                    overlaps.add((position, other_position))
+        return overlaps
@@ -1,6 +1,6 @@
 from core_data_modules.traced_data.io import TracedDataCSVIO
 
-from src.lib import PipelineConfiguration, MessageFilters
+from src.lib import PipelineConfiguration, MessageFilterChain, MessageFilters
 
 
 class ProductionFile(object):
@@ -14,8 +14,9 @@ class ProductionFile(object):
             if plan.raw_field not in production_keys:
                 production_keys.append(plan.raw_field)
 
-        not_noise = MessageFilters.filter_noise(data, "noise", lambda x: x)
+        not_noise = MessageFilterChain(data).add_filter("noise", MessageFilters.is_not_noise("noise", lambda x: x))
         with open(production_csv_output_path, "w") as f:
             TracedDataCSVIO.export_traced_data_iterable_to_csv(not_noise, f, headers=production_keys)
+        not_noise.log_stats()
 
         return data
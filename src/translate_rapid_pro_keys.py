@@ -1,212 +1,271 @@
-from datetime import datetime
+from bisect import bisect_right
 
-import pytz
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.util import TimeUtils
-from dateutil.parser import isoparse
 
-from src.lib import PipelineConfiguration
+from src.lib import PipelineConfiguration, TimestampParser, TimestampRemappingIndex
 
 log = Logger(__name__)
 
 
-class TranslateRapidProKeys(object):
-    @classmethod
-    def set_show_ids(cls, user, data, pipeline_configuration):
-        """
-        Sets a show pipeline key for each message, using the presence of Rapid Pro value keys to determine which
-        show each message belongs to.
-
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to set the show ids of.
-        :type data: iterable of TracedData
-        :param pipeline_configuration: Pipeline configuration.
-        :type pipeline_configuration: PipelineConfiguration
-        """
-        for td in data:
-            show_dict = dict()
-
-            for remapping in pipeline_configuration.rapid_pro_key_remappings:
-                if not remapping.is_activation_message:
-                    continue
+class _PendingUpdates(object):
+    """
+    Read/write view of a TracedData plus the updates which have been computed for it but not yet appended, so that
+    each translation step can see the results of the steps before it without needing its own append_data.
+    """
+    def __init__(self, td):
+        self.td = td
+        self.updates = dict()
 
-                if td.get(remapping.rapid_pro_key) is not None:
-                    assert "rqa_message" not in show_dict
-                    show_dict["rqa_message"] = td[remapping.rapid_pro_key]
-                    show_dict["show_pipeline_key"] = remapping.pipeline_key
+    def __contains__(self, key):
+        return key in self.updates or key in self.td
 
-            td.append_data(show_dict, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
-
-    @classmethod
-    def _remap_radio_show_by_time_range(cls, user, data, time_key, show_pipeline_key_to_remap_to,
-                                        range_start=None, range_end=None, time_to_adjust_to=None):
-        """
-        Remaps radio show messages received in the given time range to another radio show.
+    def __getitem__(self, key):
+        if key in self.updates:
+            return self.updates[key]
+        return self.td[key]
 
-        Optionally adjusts the datetime of re-mapped messages to a constant.
+    def __setitem__(self, key, value):
+        self.updates[key] = value
 
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to set the show ids of.
-        :type data: iterable of TracedData
-        :param time_key: Key in each TracedData of an ISO 8601-formatted datetime string to read the message sent on
-                         time from.
-        :type time_key: str
-        :param show_pipeline_key_to_remap_to: Pipeline key to assign to messages received within the given time range.
-        :type show_pipeline_key_to_remap_to: str
-        :param range_start: Start datetime for the time range to remap radio show messages from, inclusive.
-                            If None, defaults to the beginning of time.
-        :type range_start: datetime | None
-        :param range_end: End datetime for the time range to remap radio show messages from, exclusive.
-                          If None, defaults to the end of time.
-        :type range_end: datetime | None
-        :param time_to_adjust_to: Datetime to assign to the `time_key` field of re-mapped shows.
-                                  If None, re-mapped shows will not have timestamps re-adjusted.
-        :type time_to_adjust_to: datetime | None
-        """
-        if range_start is None:
-            range_start = pytz.utc.localize(datetime.min)
-        if range_end is None:
-            range_end = pytz.utc.localize(datetime.max)
-
-        log.info(f"Remapping messages in time range {range_start.isoformat()} to {range_end.isoformat()} "
-                 f"to show {show_pipeline_key_to_remap_to}...")
-
-        remapped_count = 0
-        for td in data:
-            if time_key in td and range_start <= isoparse(td[time_key]) < range_end:
-                remapped_count += 1
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
 
-                remapped = {
-                    "show_pipeline_key": show_pipeline_key_to_remap_to
-                }
-                if time_to_adjust_to is not None:
-                    remapped[time_key] = time_to_adjust_to.isoformat()
+    def keys(self):
+        return self.updates.keys() | self.td.keys()
 
-                td.append_data(remapped,
-                               Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
 
-        log.info(f"Remapped {remapped_count} messages to show {show_pipeline_key_to_remap_to}")
+class TranslationPlan(object):
+    def __init__(self, activation_remappings, key_remappings, timestamp_remappings, null_message_fields):
+        """
+        Everything needed to translate the Rapid Pro keys of a TracedData, compiled once from a pipeline configuration
+        so that all the translation steps can be applied to each TracedData in a single pass.
+
+        :param activation_remappings: (Rapid Pro key, show pipeline key) for each activation message key.
+        :type activation_remappings: list of (str, str)
+        :param key_remappings: (Rapid Pro key, pipeline key) for each key which isn't an activation message key.
+        :type key_remappings: list of (str, str)
+        :param timestamp_remappings: Remappings of radio show messages received in particular time ranges.
+        :type timestamp_remappings: list of src.lib.pipeline_configuration.TimestampRemapping
+        :param null_message_fields: (raw field, time field) for each coding plan.
+        :type null_message_fields: list of (str, str)
+        """
+        self.activation_remappings = activation_remappings
+        self.key_remappings = key_remappings
+        self.timestamp_remappings = timestamp_remappings
+        self.null_message_fields = null_message_fields
+
+        self.timestamp_remapped_counts = [0] * len(timestamp_remappings)
+
+        # Group the key remappings by pipeline key, keeping each group's Rapid Pro keys in configuration order, and
+        # index the groups by Rapid Pro key so that remapping a TracedData only touches the keys it contains.
+        self.rapid_pro_keys_by_pipeline_key = dict()  # of pipeline key -> list of Rapid Pro key
+        self.pipeline_keys_by_rapid_pro_key = dict()  # of Rapid Pro key -> set of pipeline key
+        for rapid_pro_key, pipeline_key in key_remappings:
+            self.rapid_pro_keys_by_pipeline_key.setdefault(pipeline_key, []).append(rapid_pro_key)
+            self.pipeline_keys_by_rapid_pro_key.setdefault(rapid_pro_key, set()).add(pipeline_key)
+
+        remappings_by_time_key = dict()  # of time key -> list of (position, TimestampRemapping)
+        for position, remapping in enumerate(timestamp_remappings):
+            remappings_by_time_key.setdefault(remapping.time_key, []).append((position, remapping))
+        self.timestamp_remapping_indexes = {
+            time_key: TimestampRemappingIndex(remappings) for time_key, remappings in remappings_by_time_key.items()
+        }
 
     @classmethod
-    def remap_radio_shows(cls, user, data, pipeline_configuration):
+    def from_pipeline_configuration(cls, pipeline_configuration):
         """
-        Remaps radio shows which were in the wrong flow, and therefore have the wrong key/values set, to have the
-        key/values they would have had if they had been received by the correct flow.
-
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to move the radio show messages in.
-        :type data: iterable of TracedData
         :param pipeline_configuration: Pipeline configuration.
         :type pipeline_configuration: PipelineConfiguration
+        :rtype: TranslationPlan
+        """
+        activation_remappings = []
+        key_remappings = []
+        for remapping in pipeline_configuration.rapid_pro_key_remappings:
+            if remapping.is_activation_message:
+                activation_remappings.append((remapping.rapid_pro_key, remapping.pipeline_key))
+            else:
+                key_remappings.append((remapping.rapid_pro_key, remapping.pipeline_key))
+
+        null_message_fields = [
+            (plan.raw_field, plan.time_field)
+            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS
+        ]
+
+        return cls(activation_remappings, key_remappings, pipeline_configuration.timestamp_remappings,
+                   null_message_fields)
+
+    def _set_show_id(self, td):
+        """
+        Sets a show pipeline key, using the presence of Rapid Pro value keys to determine which show the message
+        belongs to.
+        """
+        show_id_set = False
+        for rapid_pro_key, pipeline_key in self.activation_remappings:
+            if td.get(rapid_pro_key) is not None:
+                assert not show_id_set
+                show_id_set = True
+                td["rqa_message"] = td[rapid_pro_key]
+                td["show_pipeline_key"] = pipeline_key
+
+    def _remap_radio_show(self, td):
         """
-        for remapping in pipeline_configuration.timestamp_remappings:
-            cls._remap_radio_show_by_time_range(
-                user, data, remapping.time_key, remapping.show_pipeline_key_to_remap_to,
-                remapping.range_start_inclusive, remapping.range_end_exclusive, remapping.time_to_adjust_to
-            )
+        Remaps a radio show message which was in the wrong flow, and therefore has the wrong key/values set, to have
+        the key/values it would have had if it had been received by the correct flow.
 
-    @classmethod
-    def remap_key_names(cls, user, data, pipeline_configuration):
+        Optionally adjusts the datetime of re-mapped messages to a constant.
         """
-        Remaps key names.
-        
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to remap the key names of.
-        :type data: iterable of TracedData
-        :param pipeline_configuration: Pipeline configuration.
-        :type pipeline_configuration: PipelineConfiguration
+        # Find the remappings which apply by parsing each time key once and looking its timestamp up in the index.
+        # Remappings apply in configuration order, and a remapping which adjusts the timestamp changes which of the
+        # later remappings apply, so after each adjustment look up the remappings after it again.
+        applied_positions = []
+        for time_key, index in self.timestamp_remapping_indexes.items():
+            if time_key not in td:
+                continue
+
+            timestamp = TimestampParser.isoparse(td[time_key])
+            positions = index.get_positions(timestamp)
+            i = 0
+            while i < len(positions):
+                position = positions[i]
+                applied_positions.append(position)
+
+                time_to_adjust_to = self.timestamp_remappings[position].time_to_adjust_to
+                if time_to_adjust_to is not None and time_to_adjust_to != timestamp:
+                    timestamp = time_to_adjust_to
+                    positions = index.get_positions(timestamp)
+                    i = bisect_right(positions, position)
+                else:
+                    i += 1
+
+        for position in sorted(applied_positions):
+            remapping = self.timestamp_remappings[position]
+            self.timestamp_remapped_counts[position] += 1
+
+            td["show_pipeline_key"] = remapping.show_pipeline_key_to_remap_to
+            if remapping.time_to_adjust_to is not None:
+                td[remapping.time_key] = remapping.time_to_adjust_to.isoformat()
+
+    def _remap_key_names(self, td):
         """
-        for td in data:
-            remapped = dict()
-               
-            for remapping in pipeline_configuration.rapid_pro_key_remappings:
-                if remapping.is_activation_message:
+        Remaps Rapid Pro key names to the key names used by the rest of the pipeline.
+        """
+        new_keys = set()
+        for key in td.keys():
+            new_keys.update(self.pipeline_keys_by_rapid_pro_key.get(key, ()))
+
+        remapped = dict()
+        for new_key in new_keys:
+            if new_key in td:
+                continue
+
+            for old_key in self.rapid_pro_keys_by_pipeline_key[new_key]:
+                if old_key not in td:
                     continue
 
-                old_key = remapping.rapid_pro_key
-                new_key = remapping.pipeline_key
-                
-                if old_key in td and new_key not in td:
-                    # Some "old keys" translate to the same new key. This is sometimes desirable, for example if we ask
-                    # the same demog question to the same person in multiple places, we should take take their 
-                    # newest response. However, if their newest response is "null" in the flow exported from Rapid Pro,
-                    # taking the newest response would cause loss of some valuable responses. This check ensures we
-                    # are taking the most recent response, unless the most response is "null" and there was a more
-                    # substantive response in the past.
-                    if td[old_key] is None and remapped.get(new_key) is not None:
-                        continue
+                # Some "old keys" translate to the same new key. This is sometimes desirable, for example if we ask
+                # the same demog question to the same person in multiple places, we should take take their
+                # newest response. However, if their newest response is "null" in the flow exported from Rapid Pro,
+                # taking the newest response would cause loss of some valuable responses. This check ensures we
+                # are taking the most recent response, unless the most response is "null" and there was a more
+                # substantive response in the past.
+                if td[old_key] is None and remapped.get(new_key) is not None:
+                    continue
 
-                    remapped[new_key] = td[old_key]
+                remapped[new_key] = td[old_key]
 
-            td.append_data(remapped, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        for key, value in remapped.items():
+            td[key] = value
 
-    @classmethod
-    def set_rqa_raw_keys_from_show_ids(cls, user, data):
+    @staticmethod
+    def _set_rqa_raw_key_from_show_id(td):
         """
-        Despite the earlier phases of this pipeline stage using a common 'rqa_message' field and then a
+        Despite the earlier steps of this translation using a common 'rqa_message' field and then a
         'show_pipeline_key' field to identify which radio show a message belonged to, the rest of the pipeline still
         uses the presence of a raw field for each show to determine which show a message belongs to.
         This function translates from the new 'show_id' method back to the old 'raw field presence` method.
-        
-        TODO: Update the rest of the pipeline to use show_ids, and/or perform remapping before combining the datasets.
 
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to set raw radio show message fields for.
-        :type data: iterable of TracedData
+        TODO: Update the rest of the pipeline to use show_ids, and/or perform remapping before combining the datasets.
         """
-        for td in data:
-            if "show_pipeline_key" in td:
-                td.append_data({td["show_pipeline_key"]: td["rqa_message"]},
-                               Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        if "show_pipeline_key" in td:
+            td[td["show_pipeline_key"]] = td["rqa_message"]
 
-    @classmethod
-    def hide_null_messages(cls, user, data):
+    def _get_null_message_keys(self, td):
         """
-        Hides messages which were null in Rapid Pro.
-
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to search for null messages in and hide.
-        :type data: iterable of TracedData
+        Finds the keys of messages which were null in Rapid Pro.
         """
-        for td in data:
-            null_keys = set()
-            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-                if plan.raw_field in td and td[plan.raw_field] is None:
-                    null_keys.update({plan.raw_field, plan.time_field})
-            td.hide_keys(null_keys, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        null_keys = set()
+        for raw_field, time_field in self.null_message_fields:
+            if raw_field in td and td[raw_field] is None:
+                null_keys.update({raw_field, time_field})
+        return null_keys
 
-    @classmethod
-    def translate_rapid_pro_keys(cls, user, data, pipeline_configuration):
+    def translate(self, td):
         """
-        Remaps the keys of rqa messages in the wrong flow into the correct one, and remaps all Rapid Pro keys to
-        more usable keys that can be used by the rest of the pipeline.
-        
-        TODO: Break this function such that the show remapping phase happens in one class, and the Rapid Pro remapping
-              in another?
+        Computes the translation of a TracedData's Rapid Pro keys, without modifying the TracedData.
+
+        :param td: TracedData to translate.
+        :type td: TracedData
+        :return: Tuple of (key/values to append to `td`, keys to hide from `td` after appending).
+        :rtype: (dict, set of str)
         """
-        # Set the show pipeline key for each message, using the presence of Rapid Pro value keys in the TracedData.
+        pending = _PendingUpdates(td)
+
+        # Set the show pipeline key, using the presence of Rapid Pro value keys in the TracedData.
         # These are necessary in order to be able to remap radio shows and key names separately (because data
         # can't be 'deleted' from TracedData).
-        cls.set_show_ids(user, data, pipeline_configuration)
+        self._set_show_id(pending)
 
         # Move rqa messages which ended up in the wrong flow to the correct one.
-        cls.remap_radio_shows(user, data, pipeline_configuration)
+        self._remap_radio_show(pending)
 
         # Remap the keys used by Rapid Pro to more usable key names that will be used by the rest of the pipeline.
-        cls.remap_key_names(user, data, pipeline_configuration)
+        self._remap_key_names(pending)
 
         # Convert from the new show key format to the raw field format still used by the rest of the pipeline.
-        cls.set_rqa_raw_keys_from_show_ids(user, data)
+        self._set_rqa_raw_key_from_show_id(pending)
 
         # Some Text inputs in Rapid Pro can be null. We don't know why, but there's no useful messages in those
         # cases so hide them (which means the rest of the pipeline will treat those as NA).
-        cls.hide_null_messages(user, data)
+        null_keys = self._get_null_message_keys(pending)
+
+        return pending.updates, null_keys
+
+
+class TranslateRapidProKeys(object):
+    @classmethod
+    def translate_rapid_pro_keys(cls, user, data, pipeline_configuration):
+        """
+        Remaps the keys of rqa messages in the wrong flow into the correct one, and remaps all Rapid Pro keys to
+        more usable keys that can be used by the rest of the pipeline.
+
+        All the translation steps are applied to each TracedData in a single pass, with one append of the combined
+        updates (and one hide of any null messages) per TracedData.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to translate.
+        :type data: iterable of TracedData
+        :param pipeline_configuration: Pipeline configuration.
+        :type pipeline_configuration: PipelineConfiguration
+        :return: `data`, translated.
+        :rtype: iterable of TracedData
+        """
+        plan = TranslationPlan.from_pipeline_configuration(pipeline_configuration)
+
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        for td in data:
+            updates, null_keys = plan.translate(td)
+            td.append_data(updates, metadata)
+            if len(null_keys) > 0:
+                td.hide_keys(null_keys, metadata)
+
+        for remapping, remapped_count in zip(plan.timestamp_remappings, plan.timestamp_remapped_counts):
+            log.info(f"Remapped {remapped_count} messages in time range "
+                     f"{remapping.range_start_inclusive.isoformat()} to {remapping.range_end_exclusive.isoformat()} "
+                     f"to show {remapping.show_pipeline_key_to_remap_to}")
 
         return data
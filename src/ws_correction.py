@@ -1,4 +1,7 @@
+import itertools
+import math
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from core_data_modules.cleaners import Codes
 from core_data_modules.cleaners.cleaning_utils import CleaningUtils
@@ -6,7 +9,7 @@ from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataCodaV2IO
 
-from src.lib import PipelineConfiguration
+from src.lib import CodaFileCache, CodingErrorDetector, MessageIds, PipelineConfiguration
 from src.lib.pipeline_configuration import CodeSchemes, CodingModes
 
 log = Logger(__name__)
@@ -20,92 +23,44 @@ class _WSUpdate(object):
 
 
 class WSCorrection(object):
-    @staticmethod
-    def move_wrong_scheme_messages(user, data, coda_input_dir):
-        log.info("Importing manually coded Coda files to '_WS' fields...")
-        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-            if plan.coda_filename is None:
-                continue
-
-            TracedDataCodaV2IO.compute_message_ids(user, data, plan.raw_field, f"{plan.id_field}_WS")
-            with open(f"{coda_input_dir}/{plan.coda_filename}") as f:
-                TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                    user, data, f"{plan.id_field}_WS",
-                    {f"{plan.raw_field}_WS_correct_dataset": CodeSchemes.WS_CORRECT_DATASET}, f
-                )
-
-            for cc in plan.coding_configurations:
-                with open(f"{coda_input_dir}/{plan.coda_filename}") as f:
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                            user, data, plan.id_field + "_WS",
-                            {f"{cc.coded_field}_WS": cc.code_scheme}, f
-                        )
-                    else:
-                        assert cc.coding_mode == CodingModes.MULTIPLE
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
-                            user, data, f"{plan.id_field}_WS",
-                            {f"{cc.coded_field}_WS": cc.code_scheme}, f
-                        )
-
-        log.info("Checking for WS Coding Errors...")
-        # Check for coding errors
-        for td in data:
-            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-                rqa_codes = []
-                for cc in plan.coding_configurations:
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        if f"{cc.coded_field}_WS" in td:
-                            label = td[f"{cc.coded_field}_WS"]
-                            rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
-                    else:
-                        assert cc.coding_mode == CodingModes.MULTIPLE
-                        for label in td.get(f"{cc.coded_field}_WS", []):
-                            rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
-
-                has_ws_code_in_code_scheme = False
-                for code in rqa_codes:
-                    if code.control_code == Codes.WRONG_SCHEME:
-                        has_ws_code_in_code_scheme = True
-
-                has_ws_code_in_ws_scheme = False
-                if f"{plan.raw_field}_WS_correct_dataset" in td:
-                    ws_code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_code_id(
-                        td[f"{plan.raw_field}_WS_correct_dataset"]["CodeID"])
-                    has_ws_code_in_ws_scheme = ws_code.code_type == "Normal" or ws_code.control_code == Codes.NOT_CODED
-
-                if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
-                    log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
-                    coding_error_dict = {
-                        f"{plan.raw_field}_WS_correct_dataset":
-                            CleaningUtils.make_label_from_cleaner_code(
-                                CodeSchemes.WS_CORRECT_DATASET,
-                                CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
-                                Metadata.get_call_location(),
-                            ).to_dict()
-                    }
-                    td.append_data(coding_error_dict, Metadata(user, Metadata.get_call_location(), time.time()))
+    SHARDS_PER_WORKER = 4
 
+    @staticmethod
+    def _correct_uid_groups(user, groups):
+        """
+        Moves the WS messages within each of the given groups of TracedData.
+
+        Each group is corrected independently of every other group, so this can be run on shards of the groups in
+        separate processes.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param groups: Groups of TracedData to correct, where each group contains all the TracedData for one uid.
+        :type groups: list of list of TracedData
+        :return: Tuple of (TracedData with the WS data moved, in group order,
+                           dict of ('WS - Correct Dataset' code id, display text) -> count of the occurrences of
+                           codes with no matching code id in any coding plan for this project).
+        :rtype: (list of TracedData, dict of (str, str) -> int)
+        """
         # Construct a map from WS normal code id to the raw field that code indicates a requested move to.
         ws_code_to_raw_field_map = dict()
         for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
             if plan.ws_code is not None:
                 ws_code_to_raw_field_map[plan.ws_code.code_id] = plan.raw_field
 
-        # Group the TracedData by uid.
-        data_grouped_by_uid = dict()
-        for td in data:
-            uid = td["uid"]
-            if uid not in data_grouped_by_uid:
-                data_grouped_by_uid[uid] = []
-            data_grouped_by_uid[uid].append(td)
+        # Precompute the coding plan lookups needed to correct each uid's messages.
+        raw_survey_fields = {plan.raw_field for plan in PipelineConfiguration.SURVEY_CODING_PLANS}
+        raw_rqa_fields = {plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
+        rqa_keys = raw_rqa_fields | {plan.time_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
+        raw_field_to_rqa_plan_map = {plan.raw_field: plan for plan in PipelineConfiguration.RQA_CODING_PLANS}
+        raw_field_to_plans_map = dict()  # of raw_field -> list of CodingPlan with that raw_field
+        for plan in PipelineConfiguration.SURVEY_CODING_PLANS + PipelineConfiguration.RQA_CODING_PLANS:
+            raw_field_to_plans_map.setdefault(plan.raw_field, []).append(plan)
 
-        # Perform the WS correction for each uid.
-        log.info("Performing WS correction...")
         corrected_data = []  # List of TracedData with the WS data moved.
         unknown_target_code_counts = dict()  # 'WS - Correct Dataset' codes with no matching code id in any coding plan
                                              # for this project, with a count of the occurrences
-        for group in data_grouped_by_uid.values():
+        for group in groups:
             # Find all the surveys data being moved.
             # (Note: we only need to check one td in this group because all the demographics are the same)
             td = group[0]
@@ -168,8 +123,6 @@ class WSCorrection(object):
                             rqa_updates.append((plan.raw_field, _WSUpdate(td[plan.raw_field], td[plan.time_field], plan.raw_field)))
 
             # Add data moving from survey fields to the relevant survey_/rqa_updates
-            raw_survey_fields = {plan.raw_field for plan in PipelineConfiguration.SURVEY_CODING_PLANS}
-            raw_rqa_fields = {plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
             for plan in PipelineConfiguration.SURVEY_CODING_PLANS + PipelineConfiguration.RQA_CODING_PLANS:
                 if plan.raw_field not in survey_moves:
                     continue
@@ -190,15 +143,14 @@ class WSCorrection(object):
                 if target_field is None:
                     continue
 
-                for plan in PipelineConfiguration.SURVEY_CODING_PLANS + PipelineConfiguration.RQA_CODING_PLANS:
-                    if plan.raw_field == source_field:
-                        _td = group[i]
-                        update = _WSUpdate(_td[plan.raw_field], _td[plan.time_field], plan.raw_field)
-                        if target_field in raw_survey_fields:
-                            survey_updates[target_field] = survey_updates.get(target_field, []) + [update]
-                        else:
-                            assert target_field in raw_rqa_fields, f"Raw field '{target_field}' not in any coding plan"
-                            rqa_updates.append((target_field, update))
+                for plan in raw_field_to_plans_map.get(source_field, []):
+                    _td = group[i]
+                    update = _WSUpdate(_td[plan.raw_field], _td[plan.time_field], plan.raw_field)
+                    if target_field in raw_survey_fields:
+                        survey_updates[target_field] = survey_updates.get(target_field, []) + [update]
+                    else:
+                        assert target_field in raw_rqa_fields, f"Raw field '{target_field}' not in any coding plan"
+                        rqa_updates.append((target_field, update))
 
             # Re-format the survey updates to a form suitable for use by the rest of the pipeline
             flattened_survey_updates = {}
@@ -224,15 +176,12 @@ class WSCorrection(object):
                            Metadata(user, Metadata.get_call_location(), time.time()))
 
             # Hide all the RQA fields (they will be added back, in turn, in the next step).
-            td.hide_keys({plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS}.intersection(td.keys()),
-                         Metadata(user, Metadata.get_call_location(), time.time()))
-            td.hide_keys({plan.time_field for plan in PipelineConfiguration.RQA_CODING_PLANS}.intersection(td.keys()),
-                         Metadata(user, Metadata.get_call_location(), time.time()))
+            td.hide_keys(rqa_keys.intersection(td.keys()), Metadata(user, Metadata.get_call_location(), time.time()))
 
-            # For each rqa message, create a copy of this td, append the rqa message, and add this to the
-            # list of TracedData.
-            raw_field_to_rqa_plan_map = {plan.raw_field: plan for plan in PipelineConfiguration.RQA_CODING_PLANS}
-            for target_field, update in rqa_updates:
+            # For each rqa message, derive a TracedData from this td with the rqa message appended, and add it to the
+            # list of TracedData. This td is not used again once the last message has been derived from it, so only
+            # copy it for the messages before that, and append the last message to this td directly.
+            for i, (target_field, update) in enumerate(rqa_updates):
                 target_coding_plan = raw_field_to_rqa_plan_map[target_field]
 
                 rqa_dict = {
@@ -241,10 +190,131 @@ class WSCorrection(object):
                     f"{target_field}_source": update.source
                 }
 
-                corrected_td = td.copy()
+                corrected_td = td if i == len(rqa_updates) - 1 else td.copy()
                 corrected_td.append_data(rqa_dict, Metadata(user, Metadata.get_call_location(), time.time()))
                 corrected_data.append(corrected_td)
 
+        return corrected_data, unknown_target_code_counts
+
+    @staticmethod
+    def _correct_uid_groups_in_parallel(user, groups, max_workers):
+        """
+        Runs `_correct_uid_groups` on contiguous shards of the given groups in a process pool, and merges the results
+        in the order of the groups, so the output is the same as correcting all the groups in a single process.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param groups: Groups of TracedData to correct, where each group contains all the TracedData for one uid.
+        :type groups: list of list of TracedData
+        :param max_workers: Maximum number of processes to correct the groups with.
+        :type max_workers: int
+        :return: See `_correct_uid_groups`.
+        :rtype: (list of TracedData, dict of (str, str) -> int)
+        """
+        # Use a few shards per worker, so that a shard with many large groups doesn't leave the other workers idle.
+        shard_size = max(1, math.ceil(len(groups) / (max_workers * WSCorrection.SHARDS_PER_WORKER)))
+        shards = [groups[i:i + shard_size] for i in range(0, len(groups), shard_size)]
+        log.info(f"Correcting {len(groups)} uids in {len(shards)} shards across up to {max_workers} processes...")
+
+        corrected_data = []
+        unknown_target_code_counts = dict()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for shard_corrected_data, shard_unknown_target_code_counts in executor.map(
+                    WSCorrection._correct_uid_groups, itertools.repeat(user), shards):
+                corrected_data.extend(shard_corrected_data)
+                for code, count in shard_unknown_target_code_counts.items():
+                    unknown_target_code_counts[code] = unknown_target_code_counts.get(code, 0) + count
+
+        return corrected_data, unknown_target_code_counts
+
+    @staticmethod
+    def move_wrong_scheme_messages(user, data, coda_input_dir, max_workers=1):
+        """
+        Imports the WS codes from the Coda files in `coda_input_dir`, and moves each message labelled as being in the
+        wrong scheme to the field of the scheme it was labelled as belonging to.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to move the WS messages in.
+        :type data: iterable of TracedData
+        :param coda_input_dir: Directory to read the manually coded Coda files from.
+        :type coda_input_dir: str
+        :param max_workers: Maximum number of processes to move the messages with. Each uid's messages are moved
+                            independently, so the uids are sharded across processes if this is greater than 1.
+        :type max_workers: int
+        :return: TracedData objects with the WS messages moved, one per RQA message.
+        :rtype: list of TracedData
+        """
+        log.info("Importing manually coded Coda files to '_WS' fields...")
+        MessageIds.compute_message_ids(user, data, [
+            (plan.raw_field, f"{plan.id_field}_WS")
+            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS
+            if plan.coda_filename is not None
+        ])
+
+        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
+            if plan.coda_filename is None:
+                continue
+
+            # Apply all the schemes of each coding mode in one import, so the Coda file is parsed at most once per
+            # coding mode rather than once per scheme.
+            single_coded_scheme_key_map = {f"{plan.raw_field}_WS_correct_dataset": CodeSchemes.WS_CORRECT_DATASET}
+            multi_coded_scheme_key_map = dict()
+            for cc in plan.coding_configurations:
+                if cc.coding_mode == CodingModes.SINGLE:
+                    single_coded_scheme_key_map[f"{cc.coded_field}_WS"] = cc.code_scheme
+                else:
+                    assert cc.coding_mode == CodingModes.MULTIPLE
+                    multi_coded_scheme_key_map[f"{cc.coded_field}_WS"] = cc.code_scheme
+
+            coda_input_path = f"{coda_input_dir}/{plan.coda_filename}"
+            f = CodaFileCache.open(coda_input_path)
+            if f is None:
+                raise FileNotFoundError(f"Coda file '{coda_input_path}' does not exist")
+            TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
+                user, data, f"{plan.id_field}_WS", single_coded_scheme_key_map, f
+            )
+            if len(multi_coded_scheme_key_map) > 0:
+                TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
+                    user, data, f"{plan.id_field}_WS", multi_coded_scheme_key_map, CodaFileCache.open(coda_input_path)
+                )
+
+        log.info("Checking for WS Coding Errors...")
+        # Check for coding errors
+        coding_error_detector = CodingErrorDetector(
+            PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS,
+            coded_field_suffix="_WS", correct_dataset_field_suffix="_WS_correct_dataset"
+        )
+        for td, plans_with_errors in zip(data, coding_error_detector.detect(data)):
+            for plan in plans_with_errors:
+                log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
+                coding_error_dict = {
+                    f"{plan.raw_field}_WS_correct_dataset":
+                        CleaningUtils.make_label_from_cleaner_code(
+                            CodeSchemes.WS_CORRECT_DATASET,
+                            CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
+                            Metadata.get_call_location(),
+                        ).to_dict()
+                }
+                td.append_data(coding_error_dict, Metadata(user, Metadata.get_call_location(), time.time()))
+
+        # Group the TracedData by uid.
+        data_grouped_by_uid = dict()
+        for td in data:
+            uid = td["uid"]
+            if uid not in data_grouped_by_uid:
+                data_grouped_by_uid[uid] = []
+            data_grouped_by_uid[uid].append(td)
+
+        # Perform the WS correction for each uid, sharding the uids across processes if requested.
+        log.info("Performing WS correction...")
+        groups = list(data_grouped_by_uid.values())
+        if max_workers == 1:
+            corrected_data, unknown_target_code_counts = WSCorrection._correct_uid_groups(user, groups)
+        else:
+            corrected_data, unknown_target_code_counts = WSCorrection._correct_uid_groups_in_parallel(
+                user, groups, max_workers)
+
         if len(unknown_target_code_counts) > 0:
             log.warning("Found the following 'WS - Correct Dataset' CodeIDs with no matching coding plan:")
             for (code_id, display_text), count in unknown_target_code_counts.items():
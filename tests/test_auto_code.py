@@ -0,0 +1,71 @@
+import time
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.auto_code import AutoCode
+from src.lib import PipelineConfiguration
+from src.lib.code_schemes import CodeSchemes
+from src.lib.pipeline_configuration import CodingConfiguration, CodingModes, CodingPlan
+
+
+def _make_td(d):
+    return TracedData(d, Metadata("test", Metadata.get_call_location(), time.time()))
+
+
+def _make_plan(raw_field, coded_field, cleaner):
+    return CodingPlan(raw_field=raw_field, raw_field_fold_strategy=None, coding_configurations=[
+        CodingConfiguration(coding_mode=CodingModes.SINGLE, code_scheme=CodeSchemes.GENDER, coded_field=coded_field,
+                            fold_strategy=None, cleaner=cleaner)
+    ])
+
+
+def _clean_gender(text):
+    return text if text in {"male", "female"} else Codes.NOT_CODED
+
+
+def _make_counting_cleaner(calls):
+    def clean_gender(text):
+        calls.append(text)
+        return _clean_gender(text)
+    return clean_gender
+
+
+def test_run_cleaners_applies_configurations_in_coding_plan_order(monkeypatch):
+    # Two raw fields clean into the same coded field. The plans for the second raw field are listed between the
+    # plans for the first, so the label from the last plan in coding plan order must win.
+    monkeypatch.setattr(PipelineConfiguration, "RQA_CODING_PLANS", [
+        _make_plan("gender_a_raw", "gender_coded", _clean_gender),
+        _make_plan("gender_b_raw", "gender_coded", _clean_gender),
+    ])
+    monkeypatch.setattr(PipelineConfiguration, "SURVEY_CODING_PLANS", [
+        _make_plan("gender_a_raw", "gender_coded", _clean_gender),
+    ])
+    data = [
+        _make_td({"gender_a_raw": "male", "gender_b_raw": "female"}),
+        _make_td({"gender_a_raw": "unclear", "gender_b_raw": "female"}),
+    ]
+
+    AutoCode.run_cleaners("test", data)
+
+    assert data[0]["gender_coded"]["CodeID"] == CodeSchemes.GENDER.get_code_with_match_value("male").code_id
+    # The last plan's cleaner returned NC, so the label from the plan before it is kept.
+    assert data[1]["gender_coded"]["CodeID"] == CodeSchemes.GENDER.get_code_with_match_value("female").code_id
+
+
+def test_run_cleaners_runs_each_cleaner_once_per_distinct_text(monkeypatch):
+    calls = []
+    clean_gender = _make_counting_cleaner(calls)
+    monkeypatch.setattr(PipelineConfiguration, "RQA_CODING_PLANS", [])
+    monkeypatch.setattr(PipelineConfiguration, "SURVEY_CODING_PLANS", [
+        _make_plan("gender_raw", "gender_coded", clean_gender),
+        _make_plan("gender_raw", "gender_coded_copy", clean_gender),
+    ])
+    data = [_make_td({"gender_raw": text}) for text in ["male", "female", "male", "male", "female"]]
+
+    AutoCode.run_cleaners("test", data)
+
+    assert sorted(calls) == ["female", "male"]
+    for td in data:
+        assert td["gender_coded"] == td["gender_coded_copy"]
+        assert td["gender_coded"]["CodeID"] == CodeSchemes.GENDER.get_code_with_match_value(td["gender_raw"]).code_id
@@ -0,0 +1,104 @@
+import json
+import os
+
+from src.lib import BlobDownloadManager, LocalDirectoryBlobStore
+
+
+def _write_blob(blob_store_dir, blob_path, contents):
+    path = os.path.join(blob_store_dir, blob_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _setup(tmp_path, max_concurrent_downloads=1):
+    blob_store_dir = str(tmp_path / "blobs")
+    download_dir = str(tmp_path / "downloads")
+    _write_blob(blob_store_dir, "bucket/flows/flow_a.jsonl", "flow a\n")
+    _write_blob(blob_store_dir, "bucket/flows/flow_b.jsonl", "flow b\n")
+    _write_blob(blob_store_dir, "other-bucket/flow_c.csv", "flow c\n")
+    manager = BlobDownloadManager(LocalDirectoryBlobStore(blob_store_dir), download_dir, max_concurrent_downloads)
+    blob_urls_to_file_names = {
+        "gs://bucket/flows/flow_a.jsonl": "flow_a.jsonl",
+        "gs://bucket/flows/flow_b.jsonl": "flow_b.jsonl",
+        "gs://other-bucket/flow_c.csv": "flow_c.csv"
+    }
+    return blob_store_dir, download_dir, manager, blob_urls_to_file_names
+
+
+def test_download_blobs(tmp_path):
+    _, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path, max_concurrent_downloads=3)
+
+    assert manager.download_blobs(blob_urls_to_file_names) == set(blob_urls_to_file_names)
+
+    assert sorted(os.listdir(download_dir)) == \
+        [BlobDownloadManager.MANIFEST_FILE_NAME, "flow_a.jsonl", "flow_b.jsonl", "flow_c.csv"]
+    for file_name, contents in [("flow_a.jsonl", "flow a\n"), ("flow_b.jsonl", "flow b\n"), ("flow_c.csv", "flow c\n")]:
+        assert _read_file(os.path.join(download_dir, file_name)) == contents
+
+
+def test_unchanged_blobs_are_skipped(tmp_path):
+    _, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path)
+    manager.download_blobs(blob_urls_to_file_names)
+    download_mtimes = {f: os.stat(os.path.join(download_dir, f)).st_mtime_ns for f in os.listdir(download_dir)}
+
+    assert manager.download_blobs(blob_urls_to_file_names) == set()
+    assert {f: os.stat(os.path.join(download_dir, f)).st_mtime_ns for f in os.listdir(download_dir)} == \
+        download_mtimes
+
+
+def test_changed_blobs_are_downloaded_again(tmp_path):
+    blob_store_dir, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path)
+    manager.download_blobs(blob_urls_to_file_names)
+
+    _write_blob(blob_store_dir, "bucket/flows/flow_b.jsonl", "flow b, updated\n")
+
+    assert manager.download_blobs(blob_urls_to_file_names) == {"gs://bucket/flows/flow_b.jsonl"}
+    assert _read_file(os.path.join(download_dir, "flow_b.jsonl")) == "flow b, updated\n"
+
+
+def test_deleted_local_files_are_downloaded_again(tmp_path):
+    _, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path)
+    manager.download_blobs(blob_urls_to_file_names)
+
+    os.remove(os.path.join(download_dir, "flow_c.csv"))
+
+    assert manager.download_blobs(blob_urls_to_file_names) == {"gs://other-bucket/flow_c.csv"}
+    assert _read_file(os.path.join(download_dir, "flow_c.csv")) == "flow c\n"
+
+
+def test_download_recovers_from_a_crash_part_way_through_a_download(tmp_path):
+    _, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path)
+    manager.download_blobs(blob_urls_to_file_names)
+
+    # Simulate a crash part way through re-downloading flow_a: its download was left in a temporary file, and the
+    # manifest was left with a previous version of the blob.
+    with open(os.path.join(download_dir, "flow_a.jsonl.tmp"), "w") as f:
+        f.write("flow a, partially dow")
+    manifest_path = os.path.join(download_dir, BlobDownloadManager.MANIFEST_FILE_NAME)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["gs://bucket/flows/flow_a.jsonl"]["Version"] = "stale-version"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+    assert manager.download_blobs(blob_urls_to_file_names) == {"gs://bucket/flows/flow_a.jsonl"}
+    assert _read_file(os.path.join(download_dir, "flow_a.jsonl")) == "flow a\n"
+    assert not os.path.exists(os.path.join(download_dir, "flow_a.jsonl.tmp"))
+    assert manager.download_blobs(blob_urls_to_file_names) == set()
+
+
+def test_blobs_missing_from_the_manifest_are_downloaded_again(tmp_path):
+    # E.g. after a crash between a download completing and the manifest being written.
+    _, download_dir, manager, blob_urls_to_file_names = _setup(tmp_path)
+    manager.download_blobs(blob_urls_to_file_names)
+
+    os.remove(os.path.join(download_dir, BlobDownloadManager.MANIFEST_FILE_NAME))
+
+    assert manager.download_blobs(blob_urls_to_file_names) == set(blob_urls_to_file_names)
+    assert manager.download_blobs(blob_urls_to_file_names) == set()
@@ -0,0 +1,122 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet
+
+from src.lib import CachedUuidTable
+
+
+class FakeUuidTable(object):
+    """
+    Stands in for a FirestoreUuidTable, assigning uuids in memory and recording the batches looked up in it.
+    """
+    def __init__(self):
+        self.data_to_uuid = dict()
+        self.requested_batches = []
+        self._lock = threading.Lock()
+
+    def data_to_uuid_batch(self, data):
+        with self._lock:
+            self.requested_batches.append(sorted(data))
+            for d in data:
+                if d not in self.data_to_uuid:
+                    self.data_to_uuid[d] = f"avf-phone-uuid-{len(self.data_to_uuid)}"
+            return {d: self.data_to_uuid[d] for d in data}
+
+    def uuid_to_data_batch(self, uuids):
+        with self._lock:
+            self.requested_batches.append(sorted(uuids))
+            uuid_to_data = {uuid: d for d, uuid in self.data_to_uuid.items()}
+            return {uuid: uuid_to_data[uuid] for uuid in uuids}
+
+
+def _phone_number(i):
+    return f"25261{i:07d}"
+
+
+def _make_cached_table(tmp_path, uuid_table, encryption_key):
+    return CachedUuidTable(uuid_table, str(tmp_path / "cache" / "uuid_table.sqlite"), encryption_key)
+
+
+def test_lookups_are_served_from_the_cache_after_the_first_miss(tmp_path):
+    uuid_table = FakeUuidTable()
+    encryption_key = Fernet.generate_key().decode("ascii")
+    cached_table = _make_cached_table(tmp_path, uuid_table, encryption_key)
+
+    phone_numbers = [_phone_number(i) for i in range(3)]
+    data_to_uuid = cached_table.data_to_uuid_batch(phone_numbers)
+    assert data_to_uuid == uuid_table.data_to_uuid
+    assert (cached_table.hits, cached_table.misses) == (0, 3)
+
+    assert cached_table.data_to_uuid_batch(phone_numbers) == data_to_uuid
+    assert cached_table.uuid_to_data_batch(data_to_uuid.values()) == {uuid: d for d, uuid in data_to_uuid.items()}
+    assert (cached_table.hits, cached_table.misses) == (6, 3)
+    assert uuid_table.requested_batches == [sorted(phone_numbers)]
+
+    # The cache persists between instances.
+    reopened_table = _make_cached_table(tmp_path, uuid_table, encryption_key)
+    assert reopened_table.data_to_uuid_batch(phone_numbers) == data_to_uuid
+    assert (reopened_table.hits, reopened_table.misses) == (3, 0)
+    assert len(uuid_table.requested_batches) == 1
+
+
+def test_cache_file_does_not_contain_plaintext_data(tmp_path):
+    cached_table = _make_cached_table(tmp_path, FakeUuidTable(), Fernet.generate_key().decode("ascii"))
+    phone_numbers = [_phone_number(i) for i in range(20)]
+    cached_table.data_to_uuid_batch(phone_numbers)
+
+    with open(str(tmp_path / "cache" / "uuid_table.sqlite"), "rb") as f:
+        cache_contents = f.read()
+    assert b"avf-phone-uuid-0" in cache_contents
+    for phone_number in phone_numbers:
+        assert phone_number.encode("utf-8") not in cache_contents
+
+
+def test_batches_with_cached_and_uncached_entries(tmp_path, monkeypatch):
+    # Use a small query batch size so that the lookups are split over several SQLite queries.
+    monkeypatch.setattr(CachedUuidTable, "_QUERY_BATCH_SIZE", 3)
+    uuid_table = FakeUuidTable()
+    cached_table = _make_cached_table(tmp_path, uuid_table, Fernet.generate_key().decode("ascii"))
+    cached_table.data_to_uuid_batch([_phone_number(i) for i in range(0, 10, 2)])
+
+    data_to_uuid = cached_table.data_to_uuid_batch([_phone_number(i) for i in range(10)])
+    assert data_to_uuid == uuid_table.data_to_uuid
+    assert (cached_table.hits, cached_table.misses) == (5, 10)
+    assert uuid_table.requested_batches[-1] == [_phone_number(i) for i in range(1, 10, 2)]
+
+    # Uuids added to the remote table by another client are fetched and cached alongside the cached uuids.
+    other_uuids = uuid_table.data_to_uuid_batch([_phone_number(i) for i in range(10, 14)])
+    uuids = list(data_to_uuid.values()) + list(other_uuids.values())
+    uuid_to_data = cached_table.uuid_to_data_batch(uuids)
+    assert uuid_to_data == {uuid: d for d, uuid in uuid_table.data_to_uuid.items()}
+    assert (cached_table.hits, cached_table.misses) == (15, 14)
+    assert uuid_table.requested_batches[-1] == sorted(other_uuids.values())
+
+    assert cached_table.uuid_to_data_batch(uuids) == uuid_to_data
+    assert (cached_table.hits, cached_table.misses) == (29, 14)
+
+
+def test_concurrent_lookups(tmp_path):
+    uuid_table = FakeUuidTable()
+    cached_table = _make_cached_table(tmp_path, uuid_table, Fernet.generate_key().decode("ascii"))
+
+    # Each thread looks up an overlapping range of phone numbers, in both directions.
+    def look_up(thread):
+        phone_numbers = [_phone_number(i) for i in range(thread * 10, thread * 10 + 30)]
+        data_to_uuid = cached_table.data_to_uuid_batch(phone_numbers)
+        uuid_to_data = cached_table.uuid_to_data_batch(data_to_uuid.values())
+        return data_to_uuid, uuid_to_data
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(look_up, range(16)))
+
+    for data_to_uuid, uuid_to_data in results:
+        assert data_to_uuid == {d: uuid_table.data_to_uuid[d] for d in data_to_uuid}
+        assert uuid_to_data == {uuid: d for d, uuid in data_to_uuid.items()}
+    assert cached_table.hits + cached_table.misses == 16 * 30 * 2
+    assert len(uuid_table.data_to_uuid) == 15 * 10 + 30
+
+    # Every uuid assigned while the threads were running is now served from the cache.
+    misses = cached_table.misses
+    assert cached_table.data_to_uuid_batch(uuid_table.data_to_uuid.keys()) == uuid_table.data_to_uuid
+    assert cached_table.misses == misses
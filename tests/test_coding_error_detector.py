@@ -0,0 +1,108 @@
+import random
+import time
+
+import pytest
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.lib import CodingErrorDetector, PipelineConfiguration
+from src.lib.code_schemes import CodeSchemes
+from src.lib.pipeline_configuration import CodingModes
+
+CODING_PLANS = PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS
+
+
+def _find_coding_errors_reference(data, coded_field_suffix, correct_dataset_field_suffix):
+    """
+    The checks for coding errors which apply_manual_codes and ws_correction made inline before CodingErrorDetector,
+    which resolve every label with its code scheme one TracedData and coding plan at a time.
+    """
+    plans_with_errors = []
+    for td in data:
+        td_plans_with_errors = []
+        for plan in CODING_PLANS:
+            rqa_codes = []
+            for cc in plan.coding_configurations:
+                if cc.coding_mode == CodingModes.SINGLE:
+                    if f"{cc.coded_field}{coded_field_suffix}" in td:
+                        label = td[f"{cc.coded_field}{coded_field_suffix}"]
+                        rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
+                else:
+                    assert cc.coding_mode == CodingModes.MULTIPLE
+                    for label in td.get(f"{cc.coded_field}{coded_field_suffix}", []):
+                        rqa_codes.append(cc.code_scheme.get_code_with_code_id(label["CodeID"]))
+
+            has_ws_code_in_code_scheme = False
+            for code in rqa_codes:
+                if code.control_code == Codes.WRONG_SCHEME:
+                    has_ws_code_in_code_scheme = True
+
+            has_ws_code_in_ws_scheme = False
+            if f"{plan.raw_field}{correct_dataset_field_suffix}" in td:
+                ws_code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_code_id(
+                    td[f"{plan.raw_field}{correct_dataset_field_suffix}"]["CodeID"])
+                has_ws_code_in_ws_scheme = ws_code.code_type == "Normal" or ws_code.control_code == Codes.NOT_CODED
+
+            if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
+                td_plans_with_errors.append(plan)
+        plans_with_errors.append(td_plans_with_errors)
+
+    return plans_with_errors
+
+
+def _make_data(coded_field_suffix, correct_dataset_field_suffix, count):
+    """
+    Makes TracedData labelled under every coding plan with random codes from the plan's code schemes, where WS codes
+    are much more likely than they would be in a real dataset so that both agreeing and disagreeing labels are common.
+    """
+    rng = random.Random(0)
+
+    def random_label(code_scheme):
+        ws_codes = [code for code in code_scheme.codes if code.control_code == Codes.WRONG_SCHEME]
+        code = ws_codes[0] if len(ws_codes) > 0 and rng.random() < 0.3 else rng.choice(code_scheme.codes)
+        return {"CodeID": code.code_id}
+
+    data = []
+    for _ in range(count):
+        d = dict()
+        for plan in CODING_PLANS:
+            if rng.random() < 0.2:
+                continue
+
+            for cc in plan.coding_configurations:
+                if rng.random() < 0.1:
+                    continue
+                if cc.coding_mode == CodingModes.SINGLE:
+                    d[f"{cc.coded_field}{coded_field_suffix}"] = random_label(cc.code_scheme)
+                else:
+                    d[f"{cc.coded_field}{coded_field_suffix}"] = \
+                        [random_label(cc.code_scheme) for _ in range(rng.randint(0, 3))]
+
+            if rng.random() < 0.8:
+                d[f"{plan.raw_field}{correct_dataset_field_suffix}"] = \
+                    {"CodeID": rng.choice(CodeSchemes.WS_CORRECT_DATASET.codes).code_id}
+        data.append(TracedData(d, Metadata("test", Metadata.get_call_location(), time.time())))
+
+    return data
+
+
+@pytest.mark.parametrize("coded_field_suffix, correct_dataset_field_suffix", [
+    ("", "_correct_dataset"),  # As used by apply_manual_codes
+    ("_WS", "_WS_correct_dataset")  # As used by ws_correction
+])
+def test_detect_matches_inline_checks(coded_field_suffix, correct_dataset_field_suffix):
+    data = _make_data(coded_field_suffix, correct_dataset_field_suffix, 500)
+    detector = CodingErrorDetector(CODING_PLANS, coded_field_suffix, correct_dataset_field_suffix)
+
+    expected = _find_coding_errors_reference(data, coded_field_suffix, correct_dataset_field_suffix)
+    actual = detector.detect(data)
+
+    assert [[plan.raw_field for plan in plans] for plans in actual] == \
+        [[plan.raw_field for plan in plans] for plans in expected]
+    # Check the fixtures cover plans both with and without coding errors.
+    error_count = sum(len(plans) for plans in expected)
+    assert 0 < error_count < len(data) * len(CODING_PLANS)
+
+
+def test_detect_with_no_data():
+    assert CodingErrorDetector(CODING_PLANS).detect([]) == []
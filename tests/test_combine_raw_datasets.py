@@ -0,0 +1,67 @@
+import random
+import time
+
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src import CombineRawDatasets
+
+USER = "test"
+SURVEY_KEYS = ["gender_raw", "age_raw", "location_raw"]
+
+
+def _make_td(d):
+    return TracedData(d, Metadata(USER, Metadata.get_call_location(), time.time()))
+
+
+def _make_datasets():
+    """
+    Makes 2 messages datasets and 3 surveys datasets, where the surveys overlap in the keys they set and in their
+    respondents, and some messages are from uids with no survey responses.
+    """
+    rng = random.Random(0)
+
+    messages_datasets = []
+    for show in range(2):
+        messages_datasets.append([
+            _make_td({"avf_phone_id": f"avf-phone-uuid-{rng.randint(0, 29)}", f"rqa_s04e0{show + 1}_raw": f"msg {i}"})
+            for i in range(40)
+        ])
+
+    surveys_datasets = []
+    for survey in range(3):
+        surveys_dataset = []
+        for uid in rng.sample(range(30), 15):
+            d = {"avf_phone_id": f"avf-phone-uuid-{uid}", f"survey_{survey}_run_id": uid}
+            for key in rng.sample(SURVEY_KEYS, 2):
+                d[key] = f"{key} answer from survey {survey}"
+            surveys_dataset.append(_make_td(d))
+        surveys_datasets.append(surveys_dataset)
+
+    return messages_datasets, surveys_datasets
+
+
+def test_combine_raw_datasets_matches_update_iterable():
+    # The combination from before the survey responses were merged, which appended each survey in turn.
+    messages_datasets, surveys_datasets = _make_datasets()
+    expected = []
+    for messages_dataset in messages_datasets:
+        expected.extend(messages_dataset)
+    for surveys_dataset in surveys_datasets:
+        TracedData.update_iterable(USER, "avf_phone_id", expected, surveys_dataset, "survey_responses")
+
+    messages_datasets, surveys_datasets = _make_datasets()
+    actual = CombineRawDatasets.combine_raw_datasets(USER, messages_datasets, surveys_datasets)
+
+    assert [dict(td.items()) for td in actual] == [dict(td.items()) for td in expected]
+
+    # Check the fixtures cover messages from uids who answered the same question in several surveys, and from uids
+    # who answered no surveys.
+    uids_by_survey_key = dict()  # of survey key -> list of uids which answered that key, one per survey they answered
+    for surveys_dataset in surveys_datasets:
+        for survey_td in surveys_dataset:
+            for key in SURVEY_KEYS:
+                if key in survey_td:
+                    uids_by_survey_key.setdefault(key, []).append(survey_td["avf_phone_id"])
+    message_uids = {td["avf_phone_id"] for td in actual}
+    assert any(uids.count(uid) > 1 for uids in uids_by_survey_key.values() for uid in message_uids)
+    assert not message_uids.issubset({uid for uids in uids_by_survey_key.values() for uid in uids})
@@ -0,0 +1,412 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import pytest
+from core_data_modules.cleaners import Codes, PhoneCleaner
+from core_data_modules.cleaners.cleaning_utils import CleaningUtils
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataJsonIO
+from core_data_modules.util import TimeUtils
+from temba_client.v2 import Contact, Run
+
+import fetch_raw_data
+from fetch_raw_data import export_rapid_pro_flow, export_rapid_pro_flows, fetch_rapid_pro_flow_runs, \
+    label_somalia_operator
+from src.lib import CodeSchemes, RawRunStore
+from src.lib.pipeline_configuration import RapidProSource
+
+CONTACT_COUNT = 3
+
+
+def _make_run(run_id, modified_on_day, flow="test_flow", exit_type="completed"):
+    return Run.deserialize({
+        "id": run_id,
+        "uuid": f"run-uuid-{run_id}",
+        "flow": {"uuid": f"{flow}-uuid", "name": flow},
+        "contact": {"uuid": f"contact-uuid-{run_id % CONTACT_COUNT}", "name": None},
+        "responded": True,
+        "values": {},
+        "path": [],
+        "created_on": "2019-08-01T00:00:00.000000Z",
+        "modified_on": f"2019-08-{modified_on_day:02d}T10:00:00.000000Z",
+        "exited_on": None,
+        "exit_type": exit_type
+    })
+
+
+def _make_contact(contact_number, modified_on_day, name="contact"):
+    return Contact.deserialize({
+        "uuid": f"contact-uuid-{contact_number}",
+        "name": f"{name} {contact_number}",
+        "urns": [f"tel:+2526100000{contact_number}"],
+        "created_on": "2019-08-01T00:00:00.000000Z",
+        "modified_on": f"2019-08-{modified_on_day:02d}T10:00:00.000000Z"
+    })
+
+
+def _make_source(activation_flow_names=None, survey_flow_names=None, test_contact_uuids=None,
+                 max_concurrent_flow_exports=1):
+    return RapidProSource("https://rapidpro.example.com", "gs://bucket/rapid-pro-token.txt", "contacts",
+                          activation_flow_names or [], survey_flow_names or [], test_contact_uuids or [],
+                          max_concurrent_flow_exports)
+
+
+def _serialize(runs):
+    return [run.serialize() for run in runs]
+
+
+class FakeRapidProClient(object):
+    """
+    Stands in for a RapidProClient, serving runs from memory and recording the calls made to it.
+    """
+    def __init__(self, runs_by_flow, contacts=None):
+        self.runs_by_flow = runs_by_flow
+        self.contacts = contacts or []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record_call(self, *call):
+        with self._lock:
+            self.calls.append(call)
+
+    def get_flow_id(self, flow):
+        self._record_call("get_flow_id", flow)
+        return f"{flow}-uuid"
+
+    def get_raw_runs_for_flow_id(self, flow_id, last_modified_after_inclusive=None, raw_export_log_file=None):
+        self._record_call("get_raw_runs_for_flow_id", flow_id, last_modified_after_inclusive)
+        flow = flow_id[:-len("-uuid")]
+        return [run for run in self.runs_by_flow.get(flow, [])
+                if last_modified_after_inclusive is None or run.modified_on >= last_modified_after_inclusive]
+
+    def get_raw_contacts(self, last_modified_after_inclusive=None, raw_export_log_file=None):
+        self._record_call("get_raw_contacts", last_modified_after_inclusive)
+        return [contact for contact in self.contacts
+                if last_modified_after_inclusive is None or contact.modified_on >= last_modified_after_inclusive]
+
+    def convert_runs_to_traced_data(self, user, raw_runs, raw_contacts, phone_number_uuid_table, test_contacts=None):
+        self._record_call("convert_runs_to_traced_data", [run.id for run in raw_runs])
+        contacts_by_uuid = {contact.uuid: contact for contact in raw_contacts}
+        traced_runs = []
+        for run in raw_runs:
+            contact = contacts_by_uuid[run.contact.uuid]
+            traced_runs.append(TracedData({
+                f"run_id - {run.flow.name}": run.id,
+                "avf_phone_id": f"avf-phone-{contact.uuid}",
+                "contact_name": contact.name,
+                "exit_type": run.exit_type,
+                "test_run": contact.uuid in test_contacts
+            }, Metadata(user, Metadata.get_call_location(), time.time())))
+        return traced_runs
+
+    def converted_run_ids(self):
+        return [call[1] for call in self.calls if call[0] == "convert_runs_to_traced_data"]
+
+
+class FakeUuidTable(object):
+    def __init__(self, phone_numbers_by_uuid):
+        self.phone_numbers_by_uuid = phone_numbers_by_uuid
+
+    def uuid_to_data_batch(self, uuids):
+        return {uuid: self.phone_numbers_by_uuid[uuid] for uuid in uuids}
+
+
+def _make_uuid_table(contacts):
+    return FakeUuidTable({f"avf-phone-{contact.uuid}": contact.urns[0][len("tel:+"):] for contact in contacts})
+
+
+def test_fetch_rapid_pro_flow_runs_keeps_imported_legacy_export(tmp_path):
+    raw_data_dir = str(tmp_path)
+    legacy_runs = [_make_run(1, 1), _make_run(2, 2)]
+    with open(os.path.join(raw_data_dir, "test_flow_raw.json"), "w") as f:
+        json.dump(_serialize(legacy_runs), f)
+    rapid_pro = FakeRapidProClient({"test_flow": [_make_run(2, 2), _make_run(3, 3)]})
+
+    raw_run_store = fetch_rapid_pro_flow_runs(rapid_pro, raw_data_dir, "test_flow")
+
+    # The legacy export is imported, then only the runs modified since its newest run are fetched.
+    assert _serialize(raw_run_store.iter_runs()) == _serialize([_make_run(1, 1), _make_run(2, 2), _make_run(3, 3)])
+    assert rapid_pro.calls[-1] == ("get_raw_runs_for_flow_id", "test_flow-uuid", _make_run(2, 2).modified_on)
+
+    # The legacy export is kept, but renamed so that it isn't imported again.
+    assert not os.path.exists(os.path.join(raw_data_dir, "test_flow_raw.json"))
+    with open(os.path.join(raw_data_dir, "test_flow_raw.json.imported")) as f:
+        assert json.load(f) == _serialize(legacy_runs)
+
+    fetch_rapid_pro_flow_runs(rapid_pro, raw_data_dir, "test_flow")
+    assert _serialize(RawRunStore(os.path.join(raw_data_dir, "test_flow_raw")).iter_runs()) == \
+        _serialize([_make_run(1, 1), _make_run(2, 2), _make_run(3, 3)])
+
+
+def _label_somalia_operator_reference(user, traced_runs, phone_number_uuid_table):
+    """
+    The operator labelling from before the labels were shared between TracedData, which cleaned the operator and
+    made a new label for every TracedData.
+    """
+    uuids = {td["avf_phone_id"] for td in traced_runs}
+    uuid_to_phone_lut = phone_number_uuid_table.uuid_to_data_batch(uuids)
+    for td in traced_runs:
+        operator_raw = uuid_to_phone_lut[td["avf_phone_id"]][:5]
+
+        operator_code = PhoneCleaner.clean_operator(operator_raw)
+        if operator_code == Codes.NOT_CODED:
+            operator_label = CleaningUtils.make_label_from_cleaner_code(
+                CodeSchemes.SOMALIA_OPERATOR,
+                CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED),
+                Metadata.get_call_location()
+            )
+        else:
+            operator_label = CleaningUtils.make_label_from_cleaner_code(
+                CodeSchemes.SOMALIA_OPERATOR,
+                CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator_code),
+                Metadata.get_call_location()
+            )
+
+        td.append_data({
+            "operator_raw": operator_raw,
+            "operator_coded": operator_label.to_dict()
+        }, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+
+
+def _make_activation_runs(count):
+    phone_number_prefixes = ["25261", "25262", "25263", "25290", "25268", "25412", "44770"]
+    phone_numbers_by_uuid = {f"avf-phone-uuid-{i}": f"{phone_number_prefixes[i % 7]}{i:07d}" for i in range(count)}
+    traced_runs = [
+        TracedData({"avf_phone_id": uuid}, Metadata("test", Metadata.get_call_location(), time.time()))
+        for uuid in phone_numbers_by_uuid
+    ]
+    return traced_runs, FakeUuidTable(phone_numbers_by_uuid)
+
+
+def _without_date_time(label):
+    return {key: value for key, value in label.items() if key != "DateTimeUTC"}
+
+
+def test_label_somalia_operator_matches_per_run_labelling(monkeypatch):
+    # Labels record where they were made, which differs between the two implementations.
+    monkeypatch.setattr(Metadata, "get_call_location", staticmethod(lambda: "call location"))
+    expected_runs, uuid_table = _make_activation_runs(50)
+    _label_somalia_operator_reference("test", expected_runs, uuid_table)
+
+    cleaned_prefixes = []
+    clean_operator = PhoneCleaner.clean_operator
+    monkeypatch.setattr(fetch_raw_data.PhoneCleaner, "clean_operator",
+                        lambda phone_number: cleaned_prefixes.append(phone_number) or clean_operator(phone_number))
+    actual_runs, uuid_table = _make_activation_runs(50)
+    label_somalia_operator("test", actual_runs, uuid_table)
+
+    for actual, expected in zip(actual_runs, expected_runs):
+        assert actual["operator_raw"] == expected["operator_raw"]
+        assert _without_date_time(actual["operator_coded"]) == _without_date_time(expected["operator_coded"])
+    assert {td["operator_coded"]["CodeID"] for td in actual_runs} == \
+        {CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED).code_id} | \
+        {CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator).code_id
+         for operator in ["hormud", "somtel", "telesom", "golis", "nationlink"]}
+
+    # Each prefix is only cleaned once, but each TracedData has its own label dict.
+    assert sorted(cleaned_prefixes) == sorted({td["operator_raw"] for td in actual_runs})
+    assert len({id(td["operator_coded"]) for td in actual_runs}) == len(actual_runs)
+
+
+def _export_flow(raw_data_dir, rapid_pro, rapid_pro_source, flow="test_flow"):
+    """
+    Fetches and exports a flow from the given client, as export_rapid_pro_flows does for each flow, returning the
+    exported TracedData as dicts.
+    """
+    raw_run_store = fetch_rapid_pro_flow_runs(rapid_pro, raw_data_dir, flow)
+    export_rapid_pro_flow("test", rapid_pro, raw_data_dir, _make_uuid_table(rapid_pro.contacts), rapid_pro_source,
+                          flow, raw_run_store, {contact.uuid: contact for contact in rapid_pro.contacts})
+    with open(os.path.join(raw_data_dir, f"{flow}.jsonl")) as f:
+        return [dict(td.items()) for td in TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)]
+
+
+def _export_flow_without_cache(tmp_path, rapid_pro, rapid_pro_source, flow="test_flow"):
+    raw_data_dir = str(tmp_path / "uncached")
+    shutil.rmtree(raw_data_dir, ignore_errors=True)
+    os.makedirs(raw_data_dir)
+    return _export_flow(raw_data_dir, FakeRapidProClient(rapid_pro.runs_by_flow, rapid_pro.contacts),
+                        rapid_pro_source, flow)
+
+
+def _make_cache_test_client():
+    return FakeRapidProClient({"test_flow": [_make_run(run_id, 1) for run_id in range(1, 7)]},
+                              [_make_contact(contact_number, 1) for contact_number in range(CONTACT_COUNT)])
+
+
+def test_conversion_cache_is_reused(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    rapid_pro_source = _make_source(survey_flow_names=["test_flow"])
+
+    first_output = _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+    second_output = _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    assert rapid_pro.converted_run_ids() == [[1, 2, 3, 4, 5, 6], []]
+    assert second_output == first_output
+    assert [td["run_id - test_flow"] for td in second_output] == [1, 2, 3, 4, 5, 6]
+
+
+def test_conversion_cache_converts_modified_runs_again(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    rapid_pro_source = _make_source(survey_flow_names=["test_flow"])
+    _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    rapid_pro.runs_by_flow["test_flow"][1] = _make_run(2, 5, exit_type="interrupted")
+    output = _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    assert rapid_pro.converted_run_ids()[-1] == [2]
+    assert [td["exit_type"] for td in output if td["run_id - test_flow"] == 2] == ["interrupted"]
+    assert output == _export_flow_without_cache(tmp_path, rapid_pro, rapid_pro_source)
+
+
+def test_conversion_cache_converts_runs_of_modified_contacts_again(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    rapid_pro_source = _make_source(survey_flow_names=["test_flow"])
+    _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    rapid_pro.contacts[1] = _make_contact(1, 5, name="renamed contact")
+    output = _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    assert rapid_pro.converted_run_ids()[-1] == [1, 4]
+    assert [td["contact_name"] for td in output if td["run_id - test_flow"] in {1, 4}] == ["renamed contact 1"] * 2
+    assert output == _export_flow_without_cache(tmp_path, rapid_pro, rapid_pro_source)
+
+
+@pytest.mark.parametrize("first_source, second_source", [
+    (_make_source(survey_flow_names=["test_flow"]),
+     _make_source(survey_flow_names=["test_flow"], test_contact_uuids=["contact-uuid-2"])),
+    (_make_source(survey_flow_names=["test_flow"]), _make_source(activation_flow_names=["test_flow"]))
+])
+def test_conversion_cache_is_ignored_when_the_configuration_changes(tmp_path, first_source, second_source):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    _export_flow(raw_data_dir, rapid_pro, first_source)
+
+    output = _export_flow(raw_data_dir, rapid_pro, second_source)
+
+    assert rapid_pro.converted_run_ids()[-1] == [1, 2, 3, 4, 5, 6]
+    assert output == _export_flow_without_cache(tmp_path, rapid_pro, second_source)
+
+
+def test_conversion_cache_is_ignored_when_the_conversion_libraries_change(tmp_path, monkeypatch):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    rapid_pro_source = _make_source(survey_flow_names=["test_flow"])
+    _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    library_versions = fetch_raw_data.read_conversion_library_versions()
+    assert set(library_versions) == {"coredatamodules", "rapidprotools"}
+    library_versions["rapidprotools"] = "upgraded"
+    monkeypatch.setattr(fetch_raw_data, "read_conversion_library_versions", lambda: library_versions)
+    _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    assert rapid_pro.converted_run_ids()[-1] == [1, 2, 3, 4, 5, 6]
+
+
+def test_conversion_cache_drops_runs_which_are_no_longer_stored(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_cache_test_client()
+    rapid_pro_source = _make_source(survey_flow_names=["test_flow"])
+    _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    # Re-fetch the flow into an empty store from a server which no longer has runs 2 and 5.
+    shutil.rmtree(os.path.join(raw_data_dir, "test_flow_raw"))
+    rapid_pro.runs_by_flow["test_flow"] = [run for run in rapid_pro.runs_by_flow["test_flow"] if run.id not in {2, 5}]
+    output = _export_flow(raw_data_dir, rapid_pro, rapid_pro_source)
+
+    assert rapid_pro.converted_run_ids()[-1] == []
+    assert [td["run_id - test_flow"] for td in output] == [1, 3, 4, 6]
+    with open(os.path.join(raw_data_dir, "test_flow_traced_cache.jsonl")) as f:
+        assert [json.loads(line)["RunID"] for line in f.readlines()[1:]] == [1, 3, 4, 6]
+
+
+def _make_multi_flow_client():
+    flows = ["activation_s01e01", "activation_s01e02", "survey_demog", "survey_evaluation"]
+    return FakeRapidProClient(
+        {flow: [_make_run(i * 10 + run_id, run_id, flow=flow) for run_id in range(1, 6)]
+         for i, flow in enumerate(flows)},
+        [_make_contact(contact_number, contact_number + 1) for contact_number in range(CONTACT_COUNT)]
+    )
+
+
+def _make_multi_flow_source(max_concurrent_flow_exports):
+    return _make_source(activation_flow_names=["activation_s01e01", "activation_s01e02"],
+                        survey_flow_names=["survey_demog", "survey_evaluation"],
+                        test_contact_uuids=["contact-uuid-0"],
+                        max_concurrent_flow_exports=max_concurrent_flow_exports)
+
+
+def _read_flow_outputs(raw_data_dir, rapid_pro_source):
+    outputs = dict()
+    for flow in rapid_pro_source.activation_flow_names + rapid_pro_source.survey_flow_names:
+        with open(os.path.join(raw_data_dir, f"{flow}.jsonl")) as f:
+            outputs[flow] = [dict(td.items()) for td in TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)]
+    return outputs
+
+
+def test_export_rapid_pro_flows_syncs_contacts_between_fetching_and_converting(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_multi_flow_client()
+    rapid_pro_source = _make_multi_flow_source(max_concurrent_flow_exports=2)
+
+    export_rapid_pro_flows("test", rapid_pro, raw_data_dir, _make_uuid_table(rapid_pro.contacts), rapid_pro_source)
+
+    call_names = [call[0] for call in rapid_pro.calls]
+    sync_index = call_names.index("get_raw_contacts")
+    assert call_names.count("get_raw_contacts") == 1
+    assert call_names[:sync_index].count("get_raw_runs_for_flow_id") == 4
+    assert call_names[sync_index + 1:] == ["convert_runs_to_traced_data"] * 4
+
+
+def test_export_rapid_pro_flows_records_the_contacts_high_water_mark(tmp_path):
+    raw_data_dir = str(tmp_path)
+    rapid_pro = _make_multi_flow_client()
+    rapid_pro_source = _make_multi_flow_source(max_concurrent_flow_exports=1)
+    uuid_table = _make_uuid_table(rapid_pro.contacts)
+
+    export_rapid_pro_flows("test", rapid_pro, raw_data_dir, uuid_table, rapid_pro_source)
+    newest_contact_modified_on = max(contact.modified_on for contact in rapid_pro.contacts)
+    with open(os.path.join(raw_data_dir, "contacts_sync_state.json")) as f:
+        assert json.load(f) == {"LastModifiedOn": newest_contact_modified_on.isoformat()}
+
+    # The next export only fetches the contacts modified since the high-water mark, and merges them into the
+    # previous export of the contacts.
+    rapid_pro.contacts[0] = _make_contact(0, 20, name="renamed contact")
+    rapid_pro.calls = []
+    export_rapid_pro_flows("test", rapid_pro, raw_data_dir, uuid_table, rapid_pro_source)
+
+    assert ("get_raw_contacts", newest_contact_modified_on) in rapid_pro.calls
+    with open(os.path.join(raw_data_dir, "contacts_sync_state.json")) as f:
+        assert json.load(f) == {"LastModifiedOn": rapid_pro.contacts[0].modified_on.isoformat()}
+    with open(os.path.join(raw_data_dir, "contacts_raw.json")) as f:
+        assert sorted(contact["name"] for contact in json.load(f)) == ["contact 1", "contact 2", "renamed contact 0"]
+
+
+def test_concurrent_flow_exports_match_serial_flow_exports(tmp_path):
+    os.makedirs(str(tmp_path / "serial"))
+    os.makedirs(str(tmp_path / "concurrent"))
+
+    serial_source = _make_multi_flow_source(max_concurrent_flow_exports=1)
+    rapid_pro = _make_multi_flow_client()
+    export_rapid_pro_flows("test", rapid_pro, str(tmp_path / "serial"), _make_uuid_table(rapid_pro.contacts),
+                           serial_source)
+
+    concurrent_source = _make_multi_flow_source(max_concurrent_flow_exports=4)
+    rapid_pro = _make_multi_flow_client()
+    export_rapid_pro_flows("test", rapid_pro, str(tmp_path / "concurrent"), _make_uuid_table(rapid_pro.contacts),
+                           concurrent_source)
+
+    serial_outputs = _read_flow_outputs(str(tmp_path / "serial"), serial_source)
+    concurrent_outputs = _read_flow_outputs(str(tmp_path / "concurrent"), concurrent_source)
+    # Labels record the time they were made, which differs between the two exports.
+    for outputs in [serial_outputs, concurrent_outputs]:
+        for td in outputs["activation_s01e01"] + outputs["activation_s01e02"]:
+            td["operator_coded"] = _without_date_time(td["operator_coded"])
+    assert concurrent_outputs == serial_outputs
+    assert [len(output) for output in serial_outputs.values()] == [5, 5, 5, 5]
+    assert all("operator_coded" in td for td in serial_outputs["activation_s01e01"])
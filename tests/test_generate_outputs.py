@@ -0,0 +1,137 @@
+import os
+import time
+
+import pytest
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from generate_outputs import CODE_PATHS, PROJECT_DIR, STAGE_NAMES, get_first_stage_to_run, hash_stage_inputs, \
+    load_datasets
+from src.lib import StageCheckpoints
+
+
+def _write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def _make_project(project_dir):
+    _write_file(os.path.join(project_dir, "generate_outputs.py"), "# Pipeline entry point\n")
+    _write_file(os.path.join(project_dir, "src", "auto_code.py"), "# Stage code\n")
+    _write_file(os.path.join(project_dir, "code_schemes", "s04e01_reasons.json"), '{"SchemeID": "1", "Version": 1}')
+    _write_file(os.path.join(project_dir, "Pipfile.lock"), '{"default": {"coredatamodules": {"ref": "a"}}}')
+
+
+def test_code_paths_exist():
+    for path in CODE_PATHS:
+        assert os.path.exists(os.path.join(PROJECT_DIR, path)), path
+
+
+@pytest.mark.parametrize("edited_path, edited_contents", [
+    ("generate_outputs.py", "# Edited pipeline entry point\n"),
+    ("src/auto_code.py", "# Edited stage code\n"),
+    ("code_schemes/s04e01_reasons.json", '{"SchemeID": "1", "Version": 2}'),
+    ("Pipfile.lock", '{"default": {"coredatamodules": {"ref": "b"}}}')
+])
+def test_code_edit_invalidates_checkpoints(tmp_path, edited_path, edited_contents):
+    project_dir = str(tmp_path / "project")
+    _make_project(project_dir)
+    pipeline_configuration_file_path = str(tmp_path / "pipeline_config.json")
+    _write_file(pipeline_configuration_file_path, "{}")
+    stage_input_output_paths = [(stage_name, [], []) for stage_name in STAGE_NAMES]
+
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    stage_inputs_hashes = hash_stage_inputs(pipeline_configuration_file_path, "test", stage_input_output_paths,
+                                            project_dir)
+    for stage_name, inputs_hash in zip(STAGE_NAMES, stage_inputs_hashes):
+        checkpoints.save(stage_name, inputs_hash, [], [])
+    assert get_first_stage_to_run(checkpoints, STAGE_NAMES, stage_inputs_hashes) == len(STAGE_NAMES)
+
+    _write_file(os.path.join(project_dir, edited_path), edited_contents)
+
+    stage_inputs_hashes = hash_stage_inputs(pipeline_configuration_file_path, "test", stage_input_output_paths,
+                                            project_dir)
+    assert get_first_stage_to_run(checkpoints, STAGE_NAMES, stage_inputs_hashes) == 0
+
+
+def _make_stage_input_output_paths(data_dir, move_ws_messages, coded_dir_name="Coda Files"):
+    # The files each stage reads and writes, as listed by generate_outputs.py's main.
+    prev_coded_dir_path = os.path.join(data_dir, "Coded Coda Files")
+    outputs_dir = os.path.join(data_dir, "Outputs")
+    return [
+        ("combine_raw_datasets", [os.path.join(data_dir, "Raw Data", "flow.jsonl")], []),
+        ("translate_rapid_pro_keys", [], []),
+        ("ws_correction", [prev_coded_dir_path] if move_ws_messages else [], []),
+        ("auto_code", [], [os.path.join(outputs_dir, "ICR"), os.path.join(outputs_dir, coded_dir_name)]),
+        ("production_file", [], [os.path.join(outputs_dir, "production.csv")]),
+        ("apply_manual_codes", [prev_coded_dir_path], [])
+    ]
+
+
+def _save_all_checkpoints(checkpoints, stage_inputs_hashes):
+    for stage_name, inputs_hash in zip(STAGE_NAMES, stage_inputs_hashes):
+        checkpoints.save(stage_name, inputs_hash, [], [])
+
+
+@pytest.mark.parametrize("move_ws_messages, expected_first_stage_to_run", [
+    (True, "ws_correction"),
+    (False, "apply_manual_codes")
+])
+def test_coda_edit_invalidates_checkpoints(tmp_path, move_ws_messages, expected_first_stage_to_run):
+    pipeline_configuration_file_path = str(tmp_path / "pipeline_config.json")
+    _write_file(pipeline_configuration_file_path, "{}")
+    data_dir = str(tmp_path / "data")
+    _write_file(os.path.join(data_dir, "Raw Data", "flow.jsonl"), "")
+    _write_file(os.path.join(data_dir, "Coded Coda Files", "s04e01.json"), "[]")
+    stage_input_output_paths = _make_stage_input_output_paths(data_dir, move_ws_messages)
+
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    _save_all_checkpoints(checkpoints, hash_stage_inputs(pipeline_configuration_file_path, "test",
+                                                         stage_input_output_paths))
+
+    _write_file(os.path.join(data_dir, "Coded Coda Files", "s04e01.json"), '[{"ID": "message-1"}]')
+
+    stage_inputs_hashes = hash_stage_inputs(pipeline_configuration_file_path, "test", stage_input_output_paths)
+    assert get_first_stage_to_run(checkpoints, STAGE_NAMES, stage_inputs_hashes) == \
+        STAGE_NAMES.index(expected_first_stage_to_run)
+
+
+@pytest.mark.parametrize("user, coded_dir_name, expected_first_stage_to_run", [
+    ("another user", "Coda Files", "combine_raw_datasets"),
+    ("test", "Renamed Coda Files", "auto_code")
+])
+def test_user_and_output_path_changes_invalidate_checkpoints(tmp_path, user, coded_dir_name,
+                                                             expected_first_stage_to_run):
+    pipeline_configuration_file_path = str(tmp_path / "pipeline_config.json")
+    _write_file(pipeline_configuration_file_path, "{}")
+    data_dir = str(tmp_path / "data")
+
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    _save_all_checkpoints(checkpoints, hash_stage_inputs(
+        pipeline_configuration_file_path, "test", _make_stage_input_output_paths(data_dir, move_ws_messages=True)))
+
+    stage_inputs_hashes = hash_stage_inputs(
+        pipeline_configuration_file_path, user,
+        _make_stage_input_output_paths(data_dir, move_ws_messages=True, coded_dir_name=coded_dir_name))
+    assert get_first_stage_to_run(checkpoints, STAGE_NAMES, stage_inputs_hashes) == \
+        STAGE_NAMES.index(expected_first_stage_to_run)
+
+
+def test_load_datasets_in_parallel_matches_loading_in_this_process(tmp_path):
+    raw_data_dir = str(tmp_path)
+    flow_names = ["flow_a", "flow_b", "flow_c"]
+    for i, flow_name in enumerate(flow_names):
+        with open(os.path.join(raw_data_dir, f"{flow_name}.jsonl"), "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_jsonl([
+                TracedData({"avf_phone_id": f"avf-phone-uuid-{j}", f"{flow_name}_raw": f"message {j}"},
+                           Metadata("test", Metadata.get_call_location(), time.time()))
+                for j in range(i + 1)
+            ], f)
+
+    datasets = load_datasets(raw_data_dir, flow_names)
+    parallel_datasets = load_datasets(raw_data_dir, flow_names, max_workers=2)
+
+    assert [len(runs) for runs in datasets] == [1, 2, 3]
+    assert [[dict(td.items()) for td in runs] for runs in parallel_datasets] == \
+        [[dict(td.items()) for td in runs] for runs in datasets]
@@ -0,0 +1,184 @@
+import time
+
+import pytest
+from core_data_modules.traced_data import Metadata, TracedData
+from dateutil.parser import isoparse
+
+from src.lib import MessageFilterChain, MessageFilters
+from src.lib import message_filters as message_filters_module
+
+MESSAGE_KEYS = ["rqa_s04e01_raw", "rqa_s04e02_raw"]
+
+
+def _make_td(d):
+    return TracedData(d, Metadata("test", Metadata.get_call_location(), time.time()))
+
+
+def test_filter_empty_messages_returns_td_with_several_message_keys_once():
+    both = _make_td({"uid": "a", "rqa_s04e01_raw": "message 1", "rqa_s04e02_raw": "message 2"})
+    one = _make_td({"uid": "b", "rqa_s04e02_raw": "message 3"})
+    empty = _make_td({"uid": "c"})
+
+    filtered = MessageFilters.filter_empty_messages([both, empty, one], MESSAGE_KEYS)
+
+    assert len(filtered) == 2
+    assert filtered[0] is both
+    assert filtered[1] is one
+
+
+def test_filter_empty_messages_with_duplicated_message_keys():
+    td = _make_td({"uid": "a", "rqa_s04e01_raw": "message 1", "rqa_s04e02_raw": "message 2"})
+
+    filtered = MessageFilters.filter_empty_messages([td], MESSAGE_KEYS + MESSAGE_KEYS)
+
+    assert len(filtered) == 1
+    assert filtered[0] is td
+
+
+def _filter_time_range_reference(messages, time_keys, start_time_inclusive, end_time_exclusive):
+    """
+    The time range filter from before it was done in a single pass, which validated every message's time keys before
+    filtering any of them.
+    """
+    for td in messages:
+        matching_time_keys = 0
+        for time_key in time_keys:
+            if time_key in td:
+                matching_time_keys += 1
+        assert matching_time_keys == 1, matching_time_keys
+
+    filtered = []
+    for td in messages:
+        for time_key in time_keys:
+            if time_key in td and start_time_inclusive <= isoparse(td[time_key]) < end_time_exclusive:
+                filtered.append(td)
+                break
+    return filtered
+
+
+TIME_KEYS = {"rqa_s04e01_time", "rqa_s04e02_time"}
+START_TIME = isoparse("2019-08-27T00:00:00+03:00")
+END_TIME = isoparse("2019-09-03T00:00:00+03:00")
+
+
+def test_filter_time_range_matches_two_pass_filter():
+    timestamps = [
+        "2019-08-27T00:00:00+03:00",  # Start of the range, which is kept
+        "2019-08-26T23:59:59+03:00",  # Just before the start
+        "2019-08-26T21:00:00Z",  # The start of the range, in another time zone
+        "2019-08-30T12:30:00.123456+03:00",
+        "2019-09-02T20:59:59.999999Z",  # Just before the end, in another time zone
+        "2019-09-03T00:00:00+03:00",  # End of the range, which is dropped
+        "2019-10-01T00:00:00+03:00",
+        "2019-08-30T12:30:00.123456+03:00"  # Repeated timestamp
+    ]
+    messages = [
+        _make_td({"uid": i, sorted(TIME_KEYS)[i % 2]: timestamp}) for i, timestamp in enumerate(timestamps)
+    ]
+
+    expected = _filter_time_range_reference(messages, TIME_KEYS, START_TIME, END_TIME)
+    actual = MessageFilters.filter_time_range(messages, TIME_KEYS, START_TIME, END_TIME)
+
+    assert [td["uid"] for td in actual] == [td["uid"] for td in expected]
+    assert [td["uid"] for td in actual] == [0, 2, 3, 4, 7]
+
+
+@pytest.mark.parametrize("invalid_message, expected_exception", [
+    ({"uid": "malformed"}, AssertionError),  # No time key
+    ({"uid": "malformed", "rqa_s04e01_time": "2019-08-28T10:00:00+03:00",
+      "rqa_s04e02_time": "2019-08-28T10:00:00+03:00"}, AssertionError),  # Both time keys
+    ({"uid": "malformed", "rqa_s04e01_time": "28/08/2019 10:00"}, ValueError),  # Not ISO 8601
+])
+def test_filter_time_range_with_malformed_messages_fails_like_two_pass_filter(invalid_message, expected_exception):
+    messages = [
+        _make_td({"uid": "in range", "rqa_s04e01_time": "2019-08-28T10:00:00+03:00"}),
+        _make_td({"uid": "out of range", "rqa_s04e02_time": "2019-07-28T10:00:00+03:00"}),
+        _make_td(invalid_message)
+    ]
+
+    with pytest.raises(expected_exception):
+        _filter_time_range_reference(messages, TIME_KEYS, START_TIME, END_TIME)
+    with pytest.raises(expected_exception):
+        MessageFilters.filter_time_range(messages, TIME_KEYS, START_TIME, END_TIME)
+
+
+class _RecordingLog(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+
+def _make_recording_predicate(calls, name, predicate):
+    def recording_predicate(td):
+        calls.append((name, td["uid"]))
+        return predicate(td)
+    return recording_predicate
+
+
+def _make_chain_messages():
+    return [
+        _make_td({"uid": "test", "test_run": True, "rqa_s04e01_raw": "message"}),
+        _make_td({"uid": "empty"}),
+        _make_td({"uid": "kept 1", "rqa_s04e01_raw": "message"}),
+        _make_td({"uid": "test and empty", "test_run": True}),
+        _make_td({"uid": "kept 2", "rqa_s04e02_raw": "message"})
+    ]
+
+
+def _make_chain(messages, calls):
+    return (MessageFilterChain(messages)
+            .add_filter("test messages", _make_recording_predicate(calls, "test", MessageFilters.is_not_test_message()))
+            .add_filter("empty messages", _make_recording_predicate(
+                calls, "empty", MessageFilters.is_not_empty_message(MESSAGE_KEYS))))
+
+
+def test_message_filter_chain_applies_filters_in_order_and_stops_at_the_first_drop():
+    calls = []
+    chain = _make_chain(_make_chain_messages(), calls)
+
+    assert [td["uid"] for td in chain] == ["kept 1", "kept 2"]
+    assert calls == [
+        ("test", "test"),
+        ("test", "empty"), ("empty", "empty"),
+        ("test", "kept 1"), ("empty", "kept 1"),
+        ("test", "test and empty"),
+        ("test", "kept 2"), ("empty", "kept 2")
+    ]
+    assert (chain.input_count, chain.output_count, chain.dropped_counts) == (5, 2, [2, 1])
+
+
+def test_message_filter_chain_matches_filtering_each_predicate_in_turn():
+    messages = _make_chain_messages()
+    expected = MessageFilters.filter_empty_messages(MessageFilters.filter_test_messages(messages), MESSAGE_KEYS)
+
+    assert _make_chain(messages, []).to_list() == expected
+
+
+def test_message_filter_chain_log_stats(monkeypatch):
+    recording_log = _RecordingLog()
+    monkeypatch.setattr(message_filters_module, "log", recording_log)
+    chain = _make_chain(_make_chain_messages(), [])
+
+    chain.to_list()
+
+    assert recording_log.messages == [
+        "Filtered out 2 messages: test messages",
+        "Filtered out 1 messages: empty messages",
+        "Returning 2/5 messages."
+    ]
+
+
+def test_message_filter_chain_can_be_iterated_again():
+    calls = []
+    chain = _make_chain(_make_chain_messages(), calls)
+
+    first = list(chain)
+    first_calls = list(calls)
+    second = list(chain)
+
+    assert second == first
+    assert calls == first_calls + first_calls
+    # The counts are reset at the start of each iteration, rather than accumulating.
+    assert (chain.input_count, chain.output_count, chain.dropped_counts) == (5, 2, [2, 1])
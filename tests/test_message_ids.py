@@ -0,0 +1,23 @@
+import time
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataCodaV2IO
+
+from src.lib import MessageIds
+
+TEXTS = ["hello", "", "Hello", "hello", "waan ku faraxsanahay", "hello"]
+
+
+def _make_data():
+    return [TracedData({"text": text}, Metadata("test", Metadata.get_call_location(), time.time())) for text in TEXTS]
+
+
+def test_message_ids_match_coda_message_ids():
+    expected = _make_data()
+    TracedDataCodaV2IO.compute_message_ids("test", expected, "text", "text_id")
+
+    actual = _make_data()
+    MessageIds.compute_message_ids("test", actual, [("text", "text_id"), ("missing", "missing_id")])
+
+    assert [td["text_id"] for td in actual] == [td["text_id"] for td in expected]
+    assert all("missing_id" not in td for td in actual)
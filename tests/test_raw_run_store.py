@@ -0,0 +1,189 @@
+import json
+import os
+
+import pytest
+from temba_client.v2 import Run
+
+from src.lib import RawRunStore
+from src.lib import raw_run_store as raw_run_store_module
+
+
+def _make_run(run_id, modified_on_day, value="answer"):
+    return Run.deserialize({
+        "id": run_id,
+        "uuid": f"run-uuid-{run_id}",
+        "flow": {"uuid": "flow-uuid", "name": "test_flow"},
+        "contact": {"uuid": f"contact-uuid-{run_id % 3}", "name": None},
+        "responded": True,
+        "values": {},
+        "path": [],
+        "created_on": "2019-08-01T00:00:00.000000Z",
+        "modified_on": f"2019-08-{modified_on_day:02d}T10:00:00.000000Z",
+        "exited_on": None,
+        "exit_type": None,
+        "start": {"uuid": value}
+    })
+
+
+def _serialize(runs):
+    return [run.serialize() for run in runs]
+
+
+def _manifest_log_path(store_dir):
+    return os.path.join(store_dir, RawRunStore.MANIFEST_LOG_FILE_NAME)
+
+
+def _segment_file_names(store_dir):
+    return sorted(f for f in os.listdir(store_dir) if f.startswith("segment-"))
+
+
+def test_empty_store(tmp_path):
+    store = RawRunStore(str(tmp_path / "store"))
+
+    assert len(store) == 0
+    assert store.last_modified_on is None
+    assert list(store.iter_runs()) == []
+    assert store.read_runs([]) == []
+
+
+def test_append_and_reopen(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1), _make_run(2, 3)])
+    store.append_runs([_make_run(3, 2)])
+
+    reopened = RawRunStore(store_dir)
+    assert len(reopened) == 3
+    assert reopened.last_modified_on == _make_run(2, 3).modified_on
+    assert _serialize(reopened.iter_runs()) == _serialize([_make_run(1, 1), _make_run(2, 3), _make_run(3, 2)])
+    assert list(reopened.iter_run_metadata()) == [
+        (run.id, run.modified_on.isoformat(), run.contact.uuid)
+        for run in [_make_run(1, 1), _make_run(2, 3), _make_run(3, 2)]
+    ]
+
+    # Appending only writes a new segment and a line of the manifest log, so the snapshot isn't re-written.
+    assert not os.path.exists(os.path.join(store_dir, RawRunStore.MANIFEST_FILE_NAME))
+    with open(_manifest_log_path(store_dir)) as f:
+        assert len(f.readlines()) == 2
+
+
+def test_modified_runs_replace_stored_versions(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1), _make_run(2, 1), _make_run(3, 1), _make_run(4, 1)])
+    store.append_runs([_make_run(2, 5, "updated"), _make_run(2, 6, "updated again")])
+
+    reopened = RawRunStore(store_dir)
+    assert len(reopened) == 4
+    # Updated runs move to the end, in the order they are stored in the segments.
+    assert _serialize(reopened.iter_runs()) == _serialize(
+        [_make_run(1, 1), _make_run(3, 1), _make_run(4, 1), _make_run(2, 6, "updated again")])
+
+
+def test_read_runs_across_segments(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1), _make_run(2, 1), _make_run(3, 1), _make_run(4, 1)])
+    store.append_runs([_make_run(5, 2), _make_run(6, 2)])
+    store.append_runs([_make_run(3, 3, "updated"), _make_run(7, 3)])
+    assert len(_segment_file_names(store_dir)) == 3
+
+    reopened = RawRunStore(store_dir)
+    assert _serialize(reopened.read_runs([7, 1, 3, 6])) == \
+        _serialize([_make_run(7, 3), _make_run(1, 1), _make_run(3, 3, "updated"), _make_run(6, 2)])
+
+
+def test_compaction_when_most_runs_are_superseded(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1), _make_run(2, 1)])
+    store.append_runs([_make_run(1, 2), _make_run(2, 2)])
+    assert len(_segment_file_names(store_dir)) == 2
+
+    # This makes 4 of the 6 stored runs superseded, which triggers a compaction.
+    store.append_runs([_make_run(1, 3), _make_run(2, 3)])
+
+    assert len(_segment_file_names(store_dir)) == 1
+    assert not os.path.exists(_manifest_log_path(store_dir))
+    reopened = RawRunStore(store_dir)
+    assert _serialize(reopened.iter_runs()) == _serialize([_make_run(1, 3), _make_run(2, 3)])
+    assert reopened.last_modified_on == _make_run(1, 3).modified_on
+
+    # Appends after a compaction go to the manifest log of the new generation.
+    reopened.append_runs([_make_run(3, 4)])
+    assert _serialize(RawRunStore(store_dir).iter_runs()) == \
+        _serialize([_make_run(1, 3), _make_run(2, 3), _make_run(3, 4)])
+
+
+def test_compaction_when_there_are_too_many_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(RawRunStore, "MAX_SEGMENTS", 3)
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    for run_id in range(1, 4):
+        store.append_runs([_make_run(run_id, run_id)])
+    assert len(_segment_file_names(store_dir)) == 3
+
+    store.append_runs([_make_run(4, 4)])
+
+    assert len(_segment_file_names(store_dir)) == 1
+    assert _serialize(RawRunStore(store_dir).iter_runs()) == _serialize([_make_run(i, i) for i in range(1, 5)])
+
+
+def test_torn_manifest_log_line_is_truncated(tmp_path):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1)])
+    store.append_runs([_make_run(2, 2)])
+
+    # Simulate a crash part way through appending a third line to the manifest log.
+    with open(_manifest_log_path(store_dir)) as f:
+        valid_log = f.read()
+    with open(_manifest_log_path(store_dir), "a") as f:
+        f.write('{"Generation": 0, "NextSegmentNumber": 3, "Segment": {"FileName": "segm')
+
+    reopened = RawRunStore(store_dir)
+    assert _serialize(reopened.iter_runs()) == _serialize([_make_run(1, 1), _make_run(2, 2)])
+    with open(_manifest_log_path(store_dir)) as f:
+        assert f.read() == valid_log
+
+    # The next append starts on a new line, so is read back after reopening.
+    reopened.append_runs([_make_run(3, 3)])
+    assert _serialize(RawRunStore(store_dir).iter_runs()) == \
+        _serialize([_make_run(1, 1), _make_run(2, 2), _make_run(3, 3)])
+
+
+def test_compaction_interrupted_after_the_snapshot_is_written(tmp_path, monkeypatch):
+    store_dir = str(tmp_path / "store")
+    store = RawRunStore(store_dir)
+    store.append_runs([_make_run(1, 1), _make_run(2, 1)])
+    store.append_runs([_make_run(1, 2)])
+
+    # Crash after the new snapshot is written, but before the manifest log and old segments are removed.
+    def crash(path):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(raw_run_store_module.os, "remove", crash)
+    with pytest.raises(KeyboardInterrupt):
+        store.compact()
+    monkeypatch.undo()
+    assert os.path.exists(_manifest_log_path(store_dir))
+
+    # The lines left in the manifest log are from the previous generation, so only the snapshot is used.
+    reopened = RawRunStore(store_dir)
+    assert len(reopened) == 2
+    assert _serialize(reopened.iter_runs()) == _serialize([_make_run(2, 1), _make_run(1, 2)])
+
+    reopened.append_runs([_make_run(3, 3)])
+    reopened = RawRunStore(store_dir)
+    assert _serialize(reopened.iter_runs()) == _serialize([_make_run(2, 1), _make_run(1, 2), _make_run(3, 3)])
+    assert _serialize(reopened.read_runs([1, 3])) == _serialize([_make_run(1, 2), _make_run(3, 3)])
+
+
+def test_import_raw_runs_file(tmp_path):
+    raw_runs_path = str(tmp_path / "flow_raw.json")
+    with open(raw_runs_path, "w") as f:
+        json.dump(_serialize([_make_run(1, 1), _make_run(2, 2)]), f)
+
+    store_dir = str(tmp_path / "store")
+    RawRunStore(store_dir).import_raw_runs_file(raw_runs_path)
+
+    assert _serialize(RawRunStore(store_dir).iter_runs()) == _serialize([_make_run(1, 1), _make_run(2, 2)])
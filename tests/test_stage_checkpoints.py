@@ -0,0 +1,82 @@
+import os
+import time
+
+import pytest
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.lib import StageCheckpoints
+from src.lib import stage_checkpoints as stage_checkpoints_module
+
+
+def _write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _make_data():
+    return [
+        TracedData({"uid": f"avf-phone-uuid-{i}", "rqa_s04e01_raw": f"message {i}"},
+                   Metadata("test", Metadata.get_call_location(), time.time()))
+        for i in range(3)
+    ]
+
+
+def test_save_and_load(tmp_path):
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    outputs_dir = str(tmp_path / "outputs")
+    production_csv_path = os.path.join(outputs_dir, "production.csv")
+    coded_dir_path = os.path.join(outputs_dir, "Coda Files")
+    _write_file(production_csv_path, "uid,rqa_s04e01_raw\n")
+    _write_file(os.path.join(coded_dir_path, "s04e01.json"), "[]")
+    _write_file(os.path.join(coded_dir_path, "ICR", "s04e01_icr.csv"), "message\n")
+
+    data = _make_data()
+    checkpoints.save("auto_code", "inputs-hash", data, [production_csv_path, coded_dir_path])
+    assert checkpoints.get_checkpoint_hash("auto_code") == "inputs-hash"
+    assert checkpoints.get_checkpoint_hash("production_file") is None
+
+    # Loading restores the files the stage wrote, as well as its TracedData.
+    _write_file(production_csv_path, "edited after the checkpoint was saved\n")
+    os.remove(os.path.join(coded_dir_path, "ICR", "s04e01_icr.csv"))
+    loaded_data = checkpoints.load("auto_code", [production_csv_path, coded_dir_path])
+
+    assert [dict(td.items()) for td in loaded_data] == [dict(td.items()) for td in data]
+    assert _read_file(production_csv_path) == "uid,rqa_s04e01_raw\n"
+    assert _read_file(os.path.join(coded_dir_path, "s04e01.json")) == "[]"
+    assert _read_file(os.path.join(coded_dir_path, "ICR", "s04e01_icr.csv")) == "message\n"
+
+
+def test_load_to_a_different_number_of_output_paths_fails(tmp_path):
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    production_csv_path = str(tmp_path / "outputs" / "production.csv")
+    _write_file(production_csv_path, "uid\n")
+    checkpoints.save("production_file", "inputs-hash", [], [production_csv_path])
+
+    with pytest.raises(AssertionError):
+        checkpoints.load("production_file", [])
+
+
+def test_interrupted_save_leaves_no_checkpoint(tmp_path, monkeypatch):
+    checkpoints = StageCheckpoints(str(tmp_path / "checkpoints"))
+    checkpoints.save("auto_code", "old-inputs-hash", _make_data(), [])
+
+    # Crash while writing the new checkpoint's data, after the old checkpoint's metadata file has been deleted.
+    def crash(data, f):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(stage_checkpoints_module.TracedDataJsonIO, "export_traced_data_iterable_to_jsonl", crash)
+    with pytest.raises(KeyboardInterrupt):
+        checkpoints.save("auto_code", "new-inputs-hash", _make_data(), [])
+    monkeypatch.undo()
+
+    assert not os.path.exists(
+        os.path.join(str(tmp_path / "checkpoints"), "auto_code", StageCheckpoints.METADATA_FILE_NAME))
+    assert checkpoints.get_checkpoint_hash("auto_code") is None
+
+    checkpoints.save("auto_code", "new-inputs-hash", _make_data(), [])
+    assert checkpoints.get_checkpoint_hash("auto_code") == "new-inputs-hash"
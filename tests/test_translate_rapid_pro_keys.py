@@ -0,0 +1,234 @@
+import json
+import os
+from datetime import datetime
+
+import pytz
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.util import TimeUtils
+from dateutil.parser import isoparse
+
+from src.lib import PipelineConfiguration
+from src.lib.pipeline_configuration import RapidProKeyRemapping, TimestampRemapping
+from src.translate_rapid_pro_keys import TranslateRapidProKeys
+
+USER = "test"
+PIPELINE_CONFIGURATION_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           "pipeline_config.json")
+
+
+class _Configuration(object):
+    def __init__(self, rapid_pro_key_remappings, timestamp_remappings):
+        self.rapid_pro_key_remappings = rapid_pro_key_remappings
+        self.timestamp_remappings = timestamp_remappings
+
+
+def _translate_rapid_pro_keys_reference(user, data, pipeline_configuration):
+    """
+    The five-pass implementation of TranslateRapidProKeys.translate_rapid_pro_keys which the single-pass
+    implementation replaced, to check that the single-pass implementation is equivalent to it.
+    """
+    def metadata():
+        return Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+
+    # Set show ids
+    for td in data:
+        show_dict = dict()
+        for remapping in pipeline_configuration.rapid_pro_key_remappings:
+            if not remapping.is_activation_message:
+                continue
+            if td.get(remapping.rapid_pro_key) is not None:
+                assert "rqa_message" not in show_dict
+                show_dict["rqa_message"] = td[remapping.rapid_pro_key]
+                show_dict["show_pipeline_key"] = remapping.pipeline_key
+        td.append_data(show_dict, metadata())
+
+    # Remap radio shows
+    for remapping in pipeline_configuration.timestamp_remappings:
+        for td in data:
+            if remapping.time_key in td and \
+                    remapping.range_start_inclusive <= isoparse(td[remapping.time_key]) < remapping.range_end_exclusive:
+                remapped = {"show_pipeline_key": remapping.show_pipeline_key_to_remap_to}
+                if remapping.time_to_adjust_to is not None:
+                    remapped[remapping.time_key] = remapping.time_to_adjust_to.isoformat()
+                td.append_data(remapped, metadata())
+
+    # Remap key names
+    for td in data:
+        remapped = dict()
+        for remapping in pipeline_configuration.rapid_pro_key_remappings:
+            if remapping.is_activation_message:
+                continue
+            old_key = remapping.rapid_pro_key
+            new_key = remapping.pipeline_key
+            if old_key in td and new_key not in td:
+                if td[old_key] is None and remapped.get(new_key) is not None:
+                    continue
+                remapped[new_key] = td[old_key]
+        td.append_data(remapped, metadata())
+
+    # Set rqa raw keys from show ids
+    for td in data:
+        if "show_pipeline_key" in td:
+            td.append_data({td["show_pipeline_key"]: td["rqa_message"]}, metadata())
+
+    # Hide null messages
+    for td in data:
+        null_keys = set()
+        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
+            if plan.raw_field in td and td[plan.raw_field] is None:
+                null_keys.update({plan.raw_field, plan.time_field})
+        td.hide_keys(null_keys, metadata())
+
+    return data
+
+
+def _load_rapid_pro_key_remappings():
+    with open(PIPELINE_CONFIGURATION_PATH) as f:
+        configuration_dict = json.load(f)
+    return [RapidProKeyRemapping.from_configuration_dict(remapping_dict)
+            for remapping_dict in configuration_dict["RapidProKeyRemappings"]]
+
+
+def _eat(timestamp):
+    return pytz.timezone("Africa/Mogadishu").localize(datetime.strptime(timestamp, "%Y-%m-%d %H:%M"))
+
+
+def _make_timestamp_remappings():
+    return [
+        # Adjusts its messages into the ranges of both of the next two remappings, so all three apply in turn.
+        TimestampRemapping("received_on", "recovered_raw", _eat("2019-08-28 13:46"), _eat("2019-08-30 11:48"),
+                           _eat("2019-09-02 12:00")),
+        TimestampRemapping("received_on", "rqa_s04e02_raw", _eat("2019-09-01 00:00"), _eat("2019-09-03 00:00")),
+        # Overlaps the previous remapping, so applies after it to messages in both ranges.
+        TimestampRemapping("received_on", "rqa_s04e01_raw", _eat("2019-09-02 00:00"), _eat("2019-09-05 00:00")),
+        TimestampRemapping("Rqa_S04E02 (Time) - csap_s04e02_activation", "rqa_s04e01_raw",
+                           _eat("2019-09-04 00:00"), _eat("2019-09-06 00:00")),
+        # Adjusts its messages into the range of an earlier remapping, which therefore doesn't apply to them.
+        TimestampRemapping("received_on", "rqa_s04e02_raw", _eat("2019-09-10 00:00"), _eat("2019-09-11 00:00"),
+                           _eat("2019-08-29 09:00")),
+    ]
+
+
+def _make_data():
+    data_dicts = [
+        # Activation messages outside of every remapping's time range.
+        {"avf_phone_id": "avf-phone-uuid-1", "Rqa_S04E01 (Text) - csap_s04e01_activation": "s04e01 message",
+         "Rqa_S04E01 (Run ID) - csap_s04e01_activation": 1,
+         "Rqa_S04E01 (Time) - csap_s04e01_activation": "2019-08-26T10:00:00.123456+03:00"},
+        {"avf_phone_id": "avf-phone-uuid-2", "Rqa_S04E02 (Text) - csap_s04e02_activation": "s04e02 message",
+         "Rqa_S04E02 (Run ID) - csap_s04e02_activation": 2,
+         "Rqa_S04E02 (Time) - csap_s04e02_activation": "2019-09-02T10:00:00.123456+03:00"},
+        # Activation message remapped by the time of its Rapid Pro time key.
+        {"avf_phone_id": "avf-phone-uuid-3", "Rqa_S04E02 (Text) - csap_s04e02_activation": "late s04e02 message",
+         "Rqa_S04E02 (Run ID) - csap_s04e02_activation": 3,
+         "Rqa_S04E02 (Time) - csap_s04e02_activation": "2019-09-05T10:00:00.123456+03:00"},
+        # Recovered messages: remapped by the chain of the first three remappings, by only the third remapping, by
+        # only the last remapping, and by no remappings.
+        {"avf_phone_id": "avf-phone-uuid-4", "message": "recovered message 1", "run_id": 4,
+         "received_on": "2019-08-29T10:00:00+03:00"},
+        {"avf_phone_id": "avf-phone-uuid-5", "message": "recovered message 2", "run_id": 5,
+         "received_on": "2019-09-04T10:00:00+03:00"},
+        {"avf_phone_id": "avf-phone-uuid-6", "message": "recovered message 3", "run_id": 6,
+         "received_on": "2019-09-10T10:00:00+03:00"},
+        {"avf_phone_id": "avf-phone-uuid-7", "message": "recovered message 4", "run_id": 7,
+         "received_on": "2019-08-20T10:00:00+03:00"},
+        # Null activation message, which doesn't set a show.
+        {"avf_phone_id": "avf-phone-uuid-8", "Rqa_S04E01 (Text) - csap_s04e01_activation": None,
+         "Rqa_S04E01 (Run ID) - csap_s04e01_activation": 8,
+         "Rqa_S04E01 (Time) - csap_s04e01_activation": "2019-08-26T10:00:00+03:00"},
+        # Demographics answered in several flows, where the newest answer is kept unless it is null, and a null
+        # answer with no other answer is hidden.
+        {"avf_phone_id": "avf-phone-uuid-9",
+         "Mog_Sub_District (Text) - csap_demog": None,
+         "Mog_Sub_District (Time) - csap_demog": "2019-08-27T10:00:00+03:00",
+         "Gender (Text) - csap_demog": "male", "Gender (Time) - csap_demog": "2019-08-27T10:01:00+03:00",
+         "Gender (Text) - csap_s02_demog": None, "Gender (Time) - csap_s02_demog": "2019-08-28T10:01:00+03:00",
+         "Age (Text) - csap_demog": None, "Age (Time) - csap_demog": "2019-08-27T10:02:00+03:00",
+         "Age (Text) - csap_s02_demog": "23", "Age (Time) - csap_s02_demog": "2019-08-28T10:02:00+03:00"},
+        # Demographics which are null in every flow.
+        {"avf_phone_id": "avf-phone-uuid-10",
+         "Age (Text) - csap_demog": None, "Age (Time) - csap_demog": "2019-08-27T10:02:00+03:00",
+         "Age (Text) - csap_s02_demog": None, "Age (Time) - csap_s02_demog": "2019-08-28T10:02:00+03:00"},
+    ]
+    return [TracedData(d, Metadata(USER, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            for d in data_dicts]
+
+
+def _assert_translations_equal(pipeline_configuration, data_factory):
+    expected = _translate_rapid_pro_keys_reference(USER, data_factory(), pipeline_configuration)
+    actual = TranslateRapidProKeys.translate_rapid_pro_keys(USER, data_factory(), pipeline_configuration)
+
+    assert [dict(td.items()) for td in actual] == [dict(td.items()) for td in expected]
+
+
+def test_translate_rapid_pro_keys_matches_reference():
+    pipeline_configuration = _Configuration(_load_rapid_pro_key_remappings(), _make_timestamp_remappings())
+    _assert_translations_equal(pipeline_configuration, _make_data)
+
+
+def test_translate_rapid_pro_keys_matches_reference_without_timestamp_remappings():
+    pipeline_configuration = _Configuration(_load_rapid_pro_key_remappings(), [])
+    _assert_translations_equal(pipeline_configuration, _make_data)
+
+
+def test_translate_rapid_pro_keys_remaps_timestamp_chains():
+    pipeline_configuration = _Configuration(_load_rapid_pro_key_remappings(), _make_timestamp_remappings())
+    translated = {td["uid"]: td for td in
+                  TranslateRapidProKeys.translate_rapid_pro_keys(USER, _make_data(), pipeline_configuration)}
+
+    chained = translated["avf-phone-uuid-4"]
+    assert chained["show_pipeline_key"] == "rqa_s04e01_raw"
+    assert chained["rqa_s04e01_raw"] == "recovered message 1"
+    assert chained["sent_on"] == _eat("2019-09-02 12:00").isoformat()
+
+    adjusted_backwards = translated["avf-phone-uuid-6"]
+    assert adjusted_backwards["show_pipeline_key"] == "rqa_s04e02_raw"
+    assert adjusted_backwards["sent_on"] == _eat("2019-08-29 09:00").isoformat()
+
+    demographics = translated["avf-phone-uuid-9"]
+    assert "location_raw" not in demographics and "location_time" not in demographics
+    assert demographics["gender_raw"] == "male"
+    assert demographics["age_raw"] == "23"
+    assert "age_raw" not in translated["avf-phone-uuid-10"]
+
+
+def _make_key_remapping_data():
+    data_dicts = [
+        # Several Rapid Pro keys for the same pipeline key, where null answers only replace null answers.
+        {"avf_phone_id": "avf-phone-uuid-1", "Gender (Text) - csap_demog": "male",
+         "Gender (Text) - csap_s02_demog": None, "Gender (Text) - csap_s03_demog": "female"},
+        {"avf_phone_id": "avf-phone-uuid-2", "Gender (Text) - csap_demog": "male",
+         "Gender (Text) - csap_s02_demog": None, "Gender (Text) - csap_s03_demog": None},
+        {"avf_phone_id": "avf-phone-uuid-3", "Gender (Text) - csap_demog": None,
+         "Gender (Text) - csap_s02_demog": "female", "Gender (Text) - csap_s03_demog": None},
+        {"avf_phone_id": "avf-phone-uuid-4", "Gender (Text) - csap_s03_demog": None},
+        # Pipeline keys which are already present, so aren't remapped.
+        {"avf_phone_id": "avf-phone-uuid-5", "uid": "existing-uid", "gender_raw": "existing gender",
+         "Gender (Text) - csap_demog": "male"},
+        # No keys to remap.
+        {"other_key": "value"},
+    ]
+    return [TracedData(d, Metadata(USER, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            for d in data_dicts]
+
+
+def test_remap_key_names_matches_reference():
+    rapid_pro_key_remappings = _load_rapid_pro_key_remappings() + [
+        # A Rapid Pro key which maps to several pipeline keys.
+        RapidProKeyRemapping(False, "Gender (Text) - csap_demog", "first_gender_raw"),
+        RapidProKeyRemapping(False, "avf_phone_id", "avf_phone_id_copy"),
+        # Several Rapid Pro keys for a pipeline key, one of which also maps to another pipeline key.
+        RapidProKeyRemapping(False, "Gender (Text) - csap_s03_demog", "latest_answer"),
+        RapidProKeyRemapping(False, "Gender (Text) - csap_demog", "latest_answer"),
+    ]
+    pipeline_configuration = _Configuration(rapid_pro_key_remappings, [])
+    _assert_translations_equal(pipeline_configuration, _make_key_remapping_data)
+
+    translated = TranslateRapidProKeys.translate_rapid_pro_keys(USER, _make_key_remapping_data(),
+                                                                pipeline_configuration)
+    assert [td.get("gender_raw") for td in translated] == \
+        ["female", "male", "female", None, "existing gender", None]
+    assert translated[0]["first_gender_raw"] == "male"
+    assert translated[0]["latest_answer"] == "male"
+    assert translated[4]["uid"] == "existing-uid"
+    assert translated[4]["avf_phone_id_copy"] == "avf-phone-uuid-5"
@@ -0,0 +1,77 @@
+import random
+import time
+
+import pytest
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.lib.code_schemes import CodeSchemes
+from src.ws_correction import WSCorrection
+
+USER = "test"
+SURVEY_FIELDS = [("location_raw", "location_time"), ("gender_raw", "gender_time"), ("age_raw", "age_time")]
+RQA_FIELDS = ["rqa_s04e01_raw", "rqa_s04e02_raw"]
+
+# 'WS - Correct Dataset' labels to draw from: mostly not WS, with moves to RQA and survey fields, and codes which have
+# no coding plan in this project.
+WS_CORRECT_DATASET_VALUES = ["NR", "NR", "NR", "NR", "s04e01", "s04e02", "gender", "age", "s01e01"]
+
+
+def _ws_label(rng):
+    value = rng.choice(WS_CORRECT_DATASET_VALUES)
+    if value == "NR":
+        code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(value)
+    else:
+        code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_match_value(value)
+    return {"CodeID": code.code_id}
+
+
+def _make_groups(uid_count):
+    """
+    Makes the TracedData for `uid_count` uids, grouped by uid, where each uid sent between 1 and 3 RQA messages and
+    some answered the surveys.
+    """
+    rng = random.Random(0)
+    groups = []
+    for uid in range(uid_count):
+        survey = {"uid": f"avf-phone-uuid-{uid}"}
+        for raw_field, time_field in SURVEY_FIELDS:
+            if rng.random() < 0.7:
+                survey[raw_field] = f"{raw_field} answer {uid}"
+                survey[time_field] = f"2019-08-27T10:{uid % 60:02d}:00+03:00"
+                survey[f"{raw_field}_WS_correct_dataset"] = _ws_label(rng)
+
+        group = []
+        for message in range(rng.randint(1, 3)):
+            rqa_field = rng.choice(RQA_FIELDS)
+            d = dict(survey)
+            d[rqa_field] = f"message {message} from {uid}"
+            d["sent_on"] = f"2019-08-28T{message:02d}:{uid % 60:02d}:00+03:00"
+            d[f"{rqa_field}_WS_correct_dataset"] = _ws_label(rng)
+            group.append(TracedData(d, Metadata(USER, Metadata.get_call_location(), time.time())))
+        groups.append(group)
+    return groups
+
+
+def test_sharded_correction_matches_serial_correction():
+    serial_data, serial_unknown_target_code_counts = WSCorrection._correct_uid_groups(USER, _make_groups(200))
+    sharded_data, sharded_unknown_target_code_counts = WSCorrection._correct_uid_groups_in_parallel(
+        USER, _make_groups(200), max_workers=3)
+
+    assert len(sharded_data) == len(serial_data)
+    assert [dict(td.items()) for td in sharded_data] == [dict(td.items()) for td in serial_data]
+    assert sharded_unknown_target_code_counts == serial_unknown_target_code_counts
+    assert len(serial_unknown_target_code_counts) > 0
+
+
+def test_sharded_correction_with_more_workers_than_groups():
+    serial_data, _ = WSCorrection._correct_uid_groups(USER, _make_groups(2))
+    sharded_data, _ = WSCorrection._correct_uid_groups_in_parallel(USER, _make_groups(2), max_workers=4)
+
+    assert [dict(td.items()) for td in sharded_data] == [dict(td.items()) for td in serial_data]
+
+
+def test_missing_coda_file_raises_file_not_found_error(tmp_path):
+    data = [td for group in _make_groups(2) for td in group]
+
+    with pytest.raises(FileNotFoundError, match="does not exist"):
+        WSCorrection.move_wrong_scheme_messages(USER, data, str(tmp_path))